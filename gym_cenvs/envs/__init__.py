@@ -1,3 +1,6 @@
 from gym_cenvs.envs.double_pendulum import DoublePendulumEnv
 from gym_cenvs.envs.reacher import ReacherEnv
-from gym_cenvs.envs.continuous_cartpole import ContinuousCartPoleEnv, ContinuousCartPoleSwingupEnv
\ No newline at end of file
+from gym_cenvs.envs.continuous_cartpole import ContinuousCartPoleEnv, ContinuousCartPoleSwingupEnv
+from gym_cenvs.envs.vector_continuous_cartpole import VectorContinuousCartPoleEnv, VectorContinuousCartPoleSwingupEnv
+from gym_cenvs.envs.vector_double_pendulum import VectorDoublePendulumEnv
+from gym_cenvs.envs.vector_reacher import VectorReacherEnv
@@ -223,7 +223,7 @@ class DoublePendulumEnv(core.Env):
 
 def wrap(x, m, M):
     """
-    :param x: a scalar
+    :param x: a scalar, or an array that is wrapped elementwise
     :param m: minimum possible value in range
     :param M: maximum possible value in range
     Wraps ``x`` so m <= x <= M; but unlike ``bound()`` which
@@ -231,6 +231,13 @@ def wrap(x, m, M):
     For example, m = -180, M = 180 (degrees), x = 360 --> returns 0.
     """
     diff = M - m
+    if np.ndim(x) > 0:
+        x = np.array(x, dtype=np.float64)
+        while np.any(x > M):
+            x = np.where(x > M, x - diff, x)
+        while np.any(x < m):
+            x = np.where(x < m, x + diff, x)
+        return x
     while x > M:
         x = x - diff
     while x < m:
@@ -0,0 +1,138 @@
+"""
+Batch of continuous cart-poles stepped together with NumPy arrays.
+
+Same dynamics as ContinuousCartPoleEnv, with per-instance parameters and reset masks. render draws one instance
+through a ContinuousCartPoleEnv.
+"""
+
+import numpy as np
+
+from gym_cenvs.envs.continuous_cartpole import ContinuousCartPoleEnv
+from gym_cenvs.envs.double_pendulum import wrap
+
+
+class VectorContinuousCartPoleEnv(ContinuousCartPoleEnv):
+    """
+    Steps num_envs cart-poles at once. States are (num_envs, 4), actions (num_envs,) or (num_envs, 1).
+
+    With autoreset, instances that are done are reset inside step() and their last observation
+    is returned in info['terminal_observation'].
+    """
+
+    def __init__(self, num_envs=1, autoreset=False):
+        self.num_envs = num_envs
+        self.autoreset = autoreset
+        self.render_env = None
+        super(VectorContinuousCartPoleEnv, self).__init__()
+        self.set_params(self.masspole, self.length * 2, self.masscart, self.angular_damping)
+
+    def set_params(self, pole_mass, pole_length, cart_mass, damping=0.0, idx=None):
+        """ sets the parameters of the instances in idx (all if None), scalars or one value per instance """
+        if idx is None:
+            idx = slice(None)
+        if not isinstance(getattr(self, 'masscart', None), np.ndarray):
+            n = self.num_envs
+            self.masscart, self.masspole, self.length = np.zeros(n), np.zeros(n), np.zeros(n)
+            self.angular_damping, self.linear_damping = np.zeros(n), np.zeros(n)
+        self.masscart[idx] = cart_mass
+        self.masspole[idx] = pole_mass
+        self.angular_damping[idx] = damping
+        self.linear_damping[idx] = 0.0
+        self.length[idx] = np.asarray(pole_length) * 0.5  # actually half the pole's length
+        self.total_mass = (self.masspole + self.masscart)
+        self.polemass_length = (self.masspole * self.length)
+
+    def stepPhysics(self, force):
+        x, x_dot, theta, theta_dot = self.state.T
+        theta = theta - (self.theta_offset - np.pi)
+
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        mc = self.masscart
+        mp = self.masspole
+        l = self.length
+        g = self.gravity
+        b1 = self.linear_damping
+        b2 = self.angular_damping
+
+        # Inertia matrix
+        tmp = l * (mc + mp * sintheta * sintheta)
+
+        thetaacc = (-force * costheta -
+                    mp * l * theta_dot * theta_dot * sintheta * costheta -
+                    (mc + mp) * g * sintheta + b1 * x_dot * costheta - (mc + mp) * b2 * theta_dot / (mp * l)) / tmp
+
+        xacc = (force * l + mp * l * sintheta * (l * theta_dot * theta_dot + g * costheta) +
+                costheta * b2 * theta_dot - l * b1 * x_dot) / tmp
+
+        x = x + self.tau * x_dot
+        x_dot = x_dot + self.tau * xacc
+        theta = theta + self.tau * theta_dot
+        theta_dot = theta_dot + self.tau * thetaacc
+        theta += self.theta_offset - np.pi
+        return np.stack((x, x_dot, theta, theta_dot), axis=1)
+
+    def step(self, action):
+        action = np.clip(np.asarray(action, dtype=np.float64).reshape(self.num_envs), -self.action_space.high[0],
+                         self.action_space.high[0])
+        force = self.force_mag * action
+
+        self.state = self.stepPhysics(force)
+        self.state[:, 2] = wrap(self.state[:, 2], -np.pi, np.pi)
+
+        x = self.state[:, 0]
+        theta = wrap(self.state[:, 2] - self.theta_offset, -np.pi, np.pi)
+        done = (x < -self.x_threshold) | (x > self.x_threshold) \
+            | (theta < -self.theta_threshold_radians) | (theta > self.theta_threshold_radians)
+
+        # steps_beyond_done is -1 while an instance has not finished
+        reward = np.where(done & (self.steps_beyond_done >= 0), 0.0, 1.0)
+        self.steps_beyond_done = np.where(done, self.steps_beyond_done + 1, self.steps_beyond_done)
+
+        if self.swingup:
+            done = np.zeros(self.num_envs, dtype=bool)
+
+        observation = np.array(self.state)
+        info = {}
+        if self.autoreset and done.any():
+            info['terminal_observation'] = observation.copy()
+            observation = self.reset(mask=done)
+        return observation, reward, done, info
+
+    def reset(self, mask=None):
+        """ resets the instances where mask is True (all if None) and returns the observations of all instances """
+        if mask is None:
+            mask = np.ones(self.num_envs, dtype=bool)
+        if self.state is None:
+            self.state = np.zeros((self.num_envs, 4))
+            self.steps_beyond_done = np.full(self.num_envs, -1)
+        n = int(np.count_nonzero(mask))
+
+        state = self.np_random.uniform(low=-0.05, high=0.05, size=(n, 4))
+        state[:, 2] = self.np_random.uniform(low=-np.pi, high=np.pi, size=(n,))
+
+        if self.swingup:
+            state[:, 2] += np.pi
+
+        state[:, 2] += self.theta_offset
+        state[:, 2] = wrap(state[:, 2], -np.pi, np.pi)
+        self.state[mask] = state
+        self.steps_beyond_done[mask] = -1
+        return np.array(self.state)
+
+    def render(self, mode='human', idx=0):
+        """ renders instance idx in a ContinuousCartPoleEnv """
+        if self.render_env is None:
+            self.render_env = ContinuousCartPoleEnv()
+            self.render_env.theta_offset = self.theta_offset
+        self.render_env.state = None if self.state is None else self.state[idx].copy()
+        return self.render_env.render(mode)
+
+    def close(self):
+        if self.render_env is not None:
+            self.render_env.close()
+            self.render_env = None
+
+
+class VectorContinuousCartPoleSwingupEnv(VectorContinuousCartPoleEnv):
+    swingup = True
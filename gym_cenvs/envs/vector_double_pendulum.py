@@ -0,0 +1,177 @@
+"""Batch of double pendulums stepped together with NumPy arrays.
+
+Same dynamics as DoublePendulumEnv, with per-instance parameters and reset masks. render draws one instance
+through a DoublePendulumEnv.
+"""
+import numpy as np
+from numpy import pi
+
+from gym_cenvs.envs.double_pendulum import DoublePendulumEnv, wrap
+
+
+class VectorDoublePendulumEnv(DoublePendulumEnv):
+
+    """
+    Steps num_envs double pendulums at once. States are (num_envs, 4), actions (num_envs, action_dim).
+    The 2x2 manipulator equations are solved in closed form for all instances together.
+    """
+
+    def __init__(self, num_envs=1):
+        self.num_envs = num_envs
+        super(VectorDoublePendulumEnv, self).__init__()
+        n = num_envs
+        self.link_length_1 = np.full(n, self.LINK_LENGTH_1)
+        self.link_length_2 = np.full(n, self.LINK_LENGTH_2)
+        self.link_mass_1 = np.full(n, self.LINK_MASS_1)
+        self.link_mass_2 = np.full(n, self.LINK_MASS_2)
+        self.link_com_pos_1 = np.full(n, self.LINK_COM_POS_1)
+        self.link_com_pos_2 = np.full(n, self.LINK_COM_POS_2)
+        self.link_moi = np.full(n, self.LINK_MOI)
+        self.history_start = np.zeros(n, dtype=int) # step of the last reset of every instance
+        self.render_env = None
+
+    def set_params(self, link_length_1=None, link_length_2=None, link_mass_1=None, link_mass_2=None, link_moi=None,
+                   idx=None):
+        """
+        sets the parameters of the instances in idx (all if None), scalars or one value per instance.
+        Parameters left as None are unchanged, the centre of mass of a link moves to half its new length
+        """
+        if idx is None:
+            idx = slice(None)
+        if link_length_1 is not None:
+            self.link_length_1[idx] = link_length_1
+            self.link_com_pos_1[idx] = np.asarray(link_length_1) / 2
+        if link_length_2 is not None:
+            self.link_length_2[idx] = link_length_2
+            self.link_com_pos_2[idx] = np.asarray(link_length_2) / 2
+        if link_mass_1 is not None:
+            self.link_mass_1[idx] = link_mass_1
+        if link_mass_2 is not None:
+            self.link_mass_2[idx] = link_mass_2
+        if link_moi is not None:
+            self.link_moi[idx] = link_moi
+
+    def reset(self, state=None, mask=None):
+        """ resets the instances where mask is True (all if None) and returns the observations of all instances """
+        mask = np.ones(self.num_envs, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+        if self.state is None:
+            self.state = np.zeros((self.num_envs, 4))
+        n = int(np.count_nonzero(mask))
+        if state is None:
+            state = self._sample_state(n)
+        self.state[mask] = state
+
+        # Reset history, end_effector_history holds the (num_envs, 2) positions of every step
+        if mask.all():
+            self.end_effector_history = []
+        self.history_start[mask] = len(self.end_effector_history)
+        return self._get_ob()
+
+    def _sample_state(self, n):
+        high = np.array([np.pi / 2.0, np.pi / 2.0, 0.5, .5])
+        state = self.np_random.uniform(low=-high, high=high, size=(n, 4))
+        if self.swingup:
+            state[:, 0] += np.pi
+        return state
+
+    def step(self, a):
+        s = self.state.copy()
+        a = np.asarray(a, dtype=np.float64).reshape(self.num_envs, self.action_dim)
+
+        # Perform step
+        s[:, 0] += np.pi
+        ns = s + self.dt * self._dsdt(s, a)
+        ns[:, 0] -= np.pi
+        ns[:, 0] = wrap(ns[:, 0], -pi, pi)
+        ns[:, 1] = wrap(ns[:, 1], -pi, pi)
+
+        # Bound to max velocity
+        ns[:, 2] = np.clip(ns[:, 2], -self.MAX_VEL_1, self.MAX_VEL_1)
+        ns[:, 3] = np.clip(ns[:, 3], -self.MAX_VEL_2, self.MAX_VEL_2)
+        self.state = ns
+        terminal = np.zeros(self.num_envs, dtype=bool)
+        reward = None
+
+        self.end_effector_history.append(self.get_env_effector_pos())
+        return (self._get_ob(), reward, terminal, {})
+
+    def _get_ob(self):
+        s = self.state
+        return np.stack([np.cos(s[:, 0]), np.sin(s[:, 0]), np.cos(s[:, 1]), np.sin(s[:, 1]), s[:, 2], s[:, 3]], axis=1)
+
+    def _terminal(self):
+        s = self.state
+        return -np.cos(s[:, 0]) - np.cos(s[:, 1] + s[:, 0]) > 1.
+
+    def set_state(self, state):
+        state = np.asarray(state, dtype=np.float64).reshape(self.num_envs, 4)
+        self.state = np.stack([state[:, 0] - np.pi / 2.0, state[:, 1], state[:, 2], state[:, 3]], axis=1)
+
+    def _dsdt(self, s, u):
+        m1 = self.link_mass_1
+        m2 = self.link_mass_2
+        l1 = self.link_length_1
+        l2 = self.link_length_2
+        lc1 = self.link_com_pos_1
+        lc2 = self.link_com_pos_2
+        I1 = self.link_moi
+        I2 = self.link_moi
+        g = self.g
+
+        theta1 = s[:, 0]
+        theta2 = s[:, 1]
+        dtheta1 = s[:, 2]
+        dtheta2 = s[:, 3]
+
+        # Trigonometric identities
+        c2 = np.cos(theta2)
+        s1 = np.sin(theta1)
+        s2 = np.sin(theta2)
+        s12 = np.sin(theta1 + theta2)
+
+        # Entries of the manipulator equation matrices
+        H11 = I1 + I2 + m2 * np.square(l1) + 2 * m2 * l1 * lc2 * c2
+        H12 = I2 + m2 * l1 * lc2 * c2
+        H22 = I2
+
+        Cdq1 = -2 * m2 * l1 * lc2 * s2 * dtheta2 * dtheta1 - m2 * l1 * lc2 * s2 * dtheta2 * dtheta2
+        Cdq2 = m2 * l1 * lc2 * s2 * dtheta1 * dtheta1
+
+        G1 = (m1 * lc1 + m2 * l1) * g * s1 + m2 * g * l2 * s12
+        G2 = m2 * g * l2 * s12
+
+        if self.action_dim == 1:
+            Bu1, Bu2 = u[:, 0], 0.0
+        else:
+            Bu1, Bu2 = u[:, 0], u[:, 1]
+
+        # Solve manipulator equations for angular accelerations
+        lhs1 = Bu1 - (Cdq1 + G1)
+        lhs2 = Bu2 - (Cdq2 + G2)
+        det = H11 * H22 - H12 * H12
+        ddtheta1 = (H22 * lhs1 - H12 * lhs2) / det
+        ddtheta2 = (H11 * lhs2 - H12 * lhs1) / det
+
+        return np.stack([dtheta1, dtheta2, ddtheta1, ddtheta2], axis=1)
+
+    def get_env_effector_pos(self):
+        l1 = self.link_length_1
+        l2 = self.link_length_2
+        x = l1 * np.cos(self.state[:, 0] - np.pi / 2.0) + l2 * np.cos(self.state[:, 0] + self.state[:, 1] - np.pi / 2.0)
+        y = l1 * np.sin(self.state[:, 0] - np.pi / 2.0) + l2 * np.sin(self.state[:, 0] + self.state[:, 1] - np.pi / 2.0)
+        return np.stack([-x, -y], axis=1)
+
+    def render(self, mode='human', idx=0):
+        """ renders instance idx, with its link lengths and end effector history, in a DoublePendulumEnv """
+        if self.render_env is None:
+            self.render_env = DoublePendulumEnv()
+        env = self.render_env
+        env.LINK_LENGTH_1, env.LINK_LENGTH_2 = self.link_length_1[idx], self.link_length_2[idx]
+        env.state = None if self.state is None else self.state[idx].copy()
+        env.end_effector_history = [pos[idx] for pos in self.end_effector_history[self.history_start[idx]:]]
+        return env.render(mode)
+
+    def close(self):
+        if self.render_env is not None:
+            self.render_env.close()
+            self.render_env = None
@@ -0,0 +1,22 @@
+""" Batch of reachers stepped together with NumPy arrays, see VectorDoublePendulumEnv
+"""
+import numpy as np
+from gym import spaces
+from gym_cenvs.envs.vector_double_pendulum import VectorDoublePendulumEnv
+
+
+class VectorReacherEnv(VectorDoublePendulumEnv):
+
+    """
+    Vectorized ReacherEnv: both joints actuated and no gravity
+
+    """
+    def __init__(self, num_envs=1):
+        super(VectorReacherEnv, self).__init__(num_envs)
+        self.action_dim = 2
+        self.g = 0.0
+        self.action_space = spaces.Box(low=-self.MAX_TORQUE, high=self.MAX_TORQUE, shape=(2,),  dtype=np.float32)
+
+    def _sample_state(self, n):
+        high = np.array([np.pi, np.pi, 0., 0.])
+        return self.np_random.uniform(low=-high, high=high, size=(n, 4))
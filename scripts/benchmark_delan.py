@@ -0,0 +1,190 @@
+'''
+
+    Benchmark of the DeLaN_Network forward and forward + backward pass against a feed forward baseline of the same
+    width, over the degrees of freedom d, the batch size and the hidden width. Reports the median latency, the
+    throughput and the memory of the tensors saved for the backward pass (the peak allocation on CUDA), and saves
+    the results as a JSON baseline that later runs can be compared against to catch regressions
+
+        python benchmark_delan.py --threads 1 --save ../benchmarks/cpu_1thread.json
+        python benchmark_delan.py --threads 1 --compare ../benchmarks/cpu_1thread.json
+
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import numpy as np
+import torch
+from torch import nn
+import torch.nn.functional as F
+from delan_network import DeLaN_Network
+
+
+class FF_Network(nn.Module):
+    ''' the feed forward baseline of the network scripts, [q, q_dot, q_ddot] (n x 3d) to tau (n x d) '''
+    def __init__(self, input_dim, hidden_dim=64):
+        super().__init__()
+        self.fc1 = nn.Linear(3 * input_dim, hidden_dim)
+        self.fc2 = nn.Linear(hidden_dim, hidden_dim)
+        self.fc_last = nn.Linear(hidden_dim, input_dim)
+
+    def forward(self, x):
+        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc2(x))
+        return self.fc_last(x)
+
+
+def make_model(name, d, width, device):
+    if name == 'delan':
+        return DeLaN_Network(input_dim=d, num_layers=2, hidden_dim=width, device=device).to(device)
+    if name == 'ff':
+        return FF_Network(d, width).to(device)
+    raise ValueError("Unknown model '{}', choose from delan, ff".format(name))
+
+
+def saved_tensor_mb(fn):
+    ''' runs fn() and returns the MB of the (distinct) tensors autograd keeps for the backward pass '''
+    saved = {}
+
+    def pack(t):
+        saved[(t.untyped_storage().data_ptr(), t.device)] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        fn()
+    return sum(saved.values()) / 2**20
+
+
+def median_time(fn, device, min_time=0.2, min_iters=3, max_iters=1000):
+    ''' median seconds per call of fn, repeating it for at least min_time seconds '''
+    fn() # warm up
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_iters or (time.perf_counter() - start < min_time and len(times) < max_iters):
+        t = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+
+def estimated_memory_mb(model, n, d, device, probe_size=1000):
+    ''' memory of the backward pass at batch size n, extrapolated linearly from a batch of probe_size '''
+    probe = torch.randn(min(n, probe_size), 3 * d, device=device)
+    return saved_tensor_mb(lambda: model(probe)) * n / len(probe)
+
+
+def benchmark(name, d, n, width, device, max_memory_mb=None):
+    '''
+        one result row per pass ('forward', 'backward' = forward + backward) of one configuration, or no rows if
+        the backward pass would need more than max_memory_mb
+    '''
+    model = make_model(name, d, width, device)
+    if max_memory_mb is not None and estimated_memory_mb(model, n, d, device) > max_memory_mb:
+        return []
+    x = torch.randn(n, 3 * d, device=device)
+
+    def forward():
+        with torch.no_grad():
+            model(x)
+
+    def backward():
+        out = model(x)
+        (out[0] if isinstance(out, tuple) else out).sum().backward()
+
+    rows = []
+    for pass_name, fn in [('forward', forward), ('backward', backward)]:
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        seconds = median_time(fn, device)
+        if device.type == 'cuda':
+            memory_mb = torch.cuda.max_memory_allocated(device) / 2**20
+        else:
+            memory_mb = saved_tensor_mb(lambda: model(x)) if pass_name == 'backward' else None # nothing saved
+        rows.append({'model': name, 'd': d, 'batch_size': n, 'width': width, 'pass': pass_name,
+                     'latency_ms': 1e3 * seconds, 'samples_per_s': n / seconds, 'memory_mb': memory_mb})
+    return rows
+
+
+def result_key(row):
+    return (row['model'], row['d'], row['batch_size'], row['width'], row['pass'])
+
+
+def compare(results, baseline, tolerance):
+    ''' prints the latency relative to the baseline, returns the rows slower than tolerance x the baseline '''
+    base = {result_key(row): row for row in baseline['results']}
+    regressions = []
+    print("{:>6} {:>3} {:>7} {:>6} {:>9} {:>12} {:>12} {:>7}".format('model', 'd', 'batch', 'width', 'pass',
+                                                                     'base (ms)', 'now (ms)', 'ratio'))
+    for row in results:
+        if result_key(row) not in base:
+            continue
+        ratio = row['latency_ms'] / base[result_key(row)]['latency_ms']
+        flag = ' REGRESSION' if ratio > tolerance else ''
+        if flag:
+            regressions.append(row)
+        print("{:>6} {:>3} {:>7} {:>6} {:>9} {:>12.3f} {:>12.3f} {:>6.2f}x{}".format(
+            *result_key(row), base[result_key(row)]['latency_ms'], row['latency_ms'], ratio, flag))
+    return regressions
+
+
+def int_list(s):
+    return [int(v) for v in s.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the DeLaN and FF forward / backward pass')
+    parser.add_argument('--models', default='delan,ff')
+    parser.add_argument('--dofs', type=int_list, default=list(range(2, 11)))
+    parser.add_argument('--batch-sizes', type=int_list, default=[1, 10, 100, 1000, 10000, 100000])
+    parser.add_argument('--widths', type=int_list, default=[64, 128, 256])
+    parser.add_argument('--threads', type=int, default=1, help='torch CPU threads')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--max-memory-mb', type=float, default=2048,
+                        help='skip configurations whose backward pass needs more memory than this')
+    parser.add_argument('--save', help='write the results to this JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare against, exits with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='allowed latency ratio to the baseline')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    print("torch {} on {}, {} thread(s)".format(torch.__version__, device, torch.get_num_threads()))
+    print("{:>6} {:>3} {:>7} {:>6} {:>9} {:>12} {:>14} {:>10}".format('model', 'd', 'batch', 'width', 'pass',
+                                                                      'latency (ms)', 'samples/s', 'mem (MB)'))
+    results = []
+    for name in args.models.split(','):
+        for d in args.dofs:
+            for width in args.widths:
+                for n in args.batch_sizes:
+                    rows = benchmark(name, d, n, width, device, args.max_memory_mb)
+                    if not rows:
+                        print("{:>6} {:>3} {:>7} {:>6}  skipped, over --max-memory-mb".format(name, d, n, width))
+                    for row in rows:
+                        results.append(row)
+                        memory = '-' if row['memory_mb'] is None else '{:.2f}'.format(row['memory_mb'])
+                        print("{:>6} {:>3} {:>7} {:>6} {:>9} {:>12.3f} {:>14.0f} {:>10}".format(
+                            *result_key(row), row['latency_ms'], row['samples_per_s'], memory))
+
+    if args.save:
+        if os.path.dirname(args.save):
+            os.makedirs(os.path.dirname(args.save), exist_ok=True)
+        meta = {'torch': torch.__version__, 'device': str(device), 'threads': torch.get_num_threads(),
+                'machine': platform.machine(), 'processor': platform.processor(), 'python': platform.python_version()}
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+        print("Saved baseline to {}".format(args.save))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['meta']['threads'] != torch.get_num_threads() or baseline['meta']['device'] != str(device):
+            print("Warning: baseline was measured on {} with {} thread(s)".format(baseline['meta']['device'],
+                                                                                  baseline['meta']['threads']))
+        regressions = compare(results, baseline, args.tolerance)
+        print("{} regression(s) slower than {}x the baseline".format(len(regressions), args.tolerance))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,48 @@
+'''
+
+    Per-call latency of single-sample DeLaN inverse dynamics on the CPU, eager vs the exported TorchScript
+    function (delan_export.py), as p50 / p99 / max over many calls. A 1 kHz control loop needs well under 1 ms
+
+'''
+import time
+import numpy as np
+import torch
+from cartpole_delan_network import CartPole_DeLaN_Network
+from reacher_delan_network import Reacher_DeLaN_Network
+from delan_export import export_inverse_dynamics
+
+
+def call_latencies(fn, inputs, num_calls=10000, num_warmup=500):
+    ''' seconds taken by each of num_calls calls fn(*inputs) '''
+    times = np.zeros(num_calls)
+    with torch.inference_mode():
+        for _ in range(num_warmup):
+            fn(*inputs)
+        for i in range(num_calls):
+            start = time.perf_counter()
+            fn(*inputs)
+            times[i] = time.perf_counter() - start
+    return times
+
+
+def eager_inverse_dynamics(model):
+    ''' the same single-sample call in eager PyTorch '''
+    return lambda q, q_dot, q_ddot: model(torch.cat((q, q_dot, q_ddot)).view(1, -1))[0].view(-1)
+
+
+if __name__ == '__main__':
+    torch.set_num_threads(1) # a control loop runs on one core
+    print("{:>24} {:>8} {:>10} {:>10} {:>10}".format('model', 'mode', 'p50 (us)', 'p99 (us)', 'max (us)'))
+    for name, model in [('CartPole_DeLaN_Network', CartPole_DeLaN_Network()), ('Reacher_DeLaN_Network', Reacher_DeLaN_Network())]:
+        model.eval()
+        exported = export_inverse_dynamics(model)
+        d = model.input_dim
+        inputs = (torch.randn(d), torch.randn(d), torch.randn(d))
+        eager = eager_inverse_dynamics(model)
+        with torch.no_grad():
+            assert torch.allclose(eager(*inputs), exported(*inputs), atol=1e-5)
+
+        for mode, fn in [('eager', eager), ('script', exported)]:
+            us = call_latencies(fn, inputs) * 1e6
+            print("{:>24} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(name, mode, np.percentile(us, 50),
+                                                                     np.percentile(us, 99), us.max()))
@@ -0,0 +1,105 @@
+'''
+
+    Load generator for inference_server.py: num_clients controller processes each send single-sample inverse
+    dynamics requests in a closed loop. Compares the coalescing server, the same server without batching
+    (max_batch_size 1) and every controller running its own copy of the model, by per-request latency
+    (p50 / p99) and the total number of requests per second
+
+    usage: python benchmark_inference_server.py --clients 1,4,16 --requests 2000
+
+'''
+import os
+import time
+import argparse
+import multiprocessing as mp
+import numpy as np
+import torch
+from cartpole_delan_network import CartPole_DeLaN_Network
+from inference_server import InferenceClient, serve
+
+
+def client_loop(call, d, num_requests, start, seed):
+    ''' seconds taken by each of num_requests calls with random inputs, after all clients passed start '''
+    rng = np.random.default_rng(seed)
+    inputs = rng.standard_normal((num_requests, 3, d)).astype(np.float32)
+    times = np.zeros(num_requests)
+    start.wait()
+    for i in range(num_requests):
+        t = time.perf_counter()
+        call(*inputs[i])
+        times[i] = time.perf_counter() - t
+    return times
+
+
+def server_client(path, num_requests, start, results, seed):
+    client = InferenceClient(path)
+    results.put(client_loop(client, client.d, num_requests, start, seed))
+    client.close()
+
+
+def local_client(state, num_requests, start, results, seed):
+    ''' the controller holds its own copy of the model, as without the server '''
+    torch.set_num_threads(1)
+    model = CartPole_DeLaN_Network()
+    model.load_state_dict(state)
+    model.eval()
+
+    def call(q, q_dot, q_ddot):
+        with torch.inference_mode():
+            return model(torch.from_numpy(np.concatenate((q, q_dot, q_ddot))).view(1, -1))
+
+    results.put(client_loop(call, model.input_dim, num_requests, start, seed))
+
+
+def run_clients(target, args, num_clients, num_requests):
+    ''' latencies of all requests and the requests per second of num_clients processes running target '''
+    start = mp.Barrier(num_clients + 1)
+    results = mp.Queue()
+    procs = [mp.Process(target=target, args=(args, num_requests, start, results, seed)) for seed in range(num_clients)]
+    for p in procs:
+        p.start()
+    start.wait()
+    t = time.perf_counter()
+    times = np.concatenate([results.get() for _ in procs])
+    elapsed = time.perf_counter() - t
+    for p in procs:
+        p.join()
+    return times, len(times) / elapsed
+
+
+def start_server(model, path, max_batch_size, max_delay):
+    proc = mp.Process(target=serve, args=(model, path), kwargs={'max_batch_size': max_batch_size, 'max_delay': max_delay},
+                      daemon=True)
+    proc.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    time.sleep(0.2)
+    return proc
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', default='1,4,16')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per client')
+    parser.add_argument('--max-delay-ms', type=float, default=0.0, help='batching deadline of the coalescing server')
+    parser.add_argument('--socket', default='/tmp/delan_benchmark.sock')
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    torch.manual_seed(0)
+    model = CartPole_DeLaN_Network()
+    print("{:>12} {:>8} {:>10} {:>10} {:>10}".format('mode', 'clients', 'p50 (us)', 'p99 (us)', 'req/s'))
+    for num_clients in [int(c) for c in args.clients.split(',')]:
+        for mode in ['local', 'unbatched', 'coalesced']:
+            if mode == 'local':
+                times, rate = run_clients(local_client, model.state_dict(), num_clients, args.requests)
+            else:
+                max_batch_size = 1 if mode == 'unbatched' else 256
+                server = start_server(model, args.socket, max_batch_size, args.max_delay_ms / 1e3)
+                times, rate = run_clients(server_client, args.socket, num_clients, args.requests)
+                server.terminate()
+                server.join()
+                os.remove(args.socket)
+            us = times * 1e6
+            print("{:>12} {:>8} {:>10.1f} {:>10.1f} {:>10.0f}".format(mode, num_clients, np.percentile(us, 50),
+                                                                     np.percentile(us, 99), rate))
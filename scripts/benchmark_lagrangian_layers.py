@@ -0,0 +1,51 @@
+'''
+
+    Compares the per-column loop and the vectorized tril scatter construction of H(q) and c(q, q_dot)
+    for an increasing number of degrees of freedom d
+
+'''
+import time
+import torch
+from lagrangian_layers import lagrangian_terms, lagrangian_terms_loop, tril_flat_indices
+
+
+def random_inputs(n, d, device):
+    ''' random L entries, Jacobians and joint velocities for a batch of n samples '''
+    m = d * (d - 1) // 2
+    ld = torch.rand(n, d, device=device, requires_grad=True)
+    lo = torch.randn(n, m, device=device, requires_grad=True)
+    dld_dq = torch.randn(n, d, d, device=device, requires_grad=True)
+    dlo_dq = torch.randn(n, m, d, device=device, requires_grad=True)
+    q_dot = torch.randn(n, d, device=device)
+    return ld, lo, dld_dq, dlo_dq, q_dot
+
+
+def time_fn(fn, inputs, num_iters=50, backward=True):
+    ''' average seconds per call of fn(*inputs), including the backward pass if requested '''
+    for _ in range(5):
+        H, c = fn(*inputs)
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        H, c = fn(*inputs)
+        if backward:
+            (H.sum() + c.sum()).backward()
+    return (time.perf_counter() - start) / num_iters
+
+
+if __name__ == '__main__':
+    device = "cuda" if torch.cuda.is_available() else "cpu" # Configure device
+    n = 1000
+    print("batch size {} on {}".format(n, device))
+    print("{:>3} {:>14} {:>14} {:>9} {:>10}".format('d', 'loop (samp/s)', 'vec (samp/s)', 'speedup', 'max diff'))
+    for d in range(2, 11):
+        inputs = random_inputs(n, d, device)
+        tril_idx = tril_flat_indices(d, device=device)
+        vectorized = lambda *args: lagrangian_terms(*args, flat_idx=tril_idx)
+
+        H_loop, c_loop = lagrangian_terms_loop(*inputs)
+        H_vec, c_vec = vectorized(*inputs)
+        max_diff = max((H_loop - H_vec).abs().max().item(), (c_loop - c_vec).abs().max().item())
+
+        t_loop = time_fn(lagrangian_terms_loop, inputs)
+        t_vec = time_fn(vectorized, inputs)
+        print("{:>3} {:>14.0f} {:>14.0f} {:>8.2f}x {:>10.2e}".format(d, n / t_loop, n / t_vec, t_loop / t_vec, max_diff))
@@ -1,13 +1,23 @@
+import os
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.io import loadmat
 from tqdm import tqdm # Displays a progress bar
 import torch
 from torch import nn
 from torch import optim
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from dataset import TrajectoryDataset
+from dataset import sample_loader, ensemble_sample_loader
+import ensemble
+from ensemble import Ensemble
+from trajectory_store import MmapTrajectoryDataset, load_dataset
+from checkpoint import Checkpointer
+from model_cache import cached_train, checkpoint_path
+from training_metrics import TrainingMonitor
+from metrics_accumulator import MetricsAccumulator
+from early_stopping import validation_loss
+from streaming_evaluation import evaluate_streaming
 from trajectory_selection import random_train_test_trajectories, select_train_test_trajectories
 # torch.manual_seed(0) # Fix random seed for reproducibility
 
@@ -29,37 +39,67 @@ class CartPole_FF_Network(nn.Module):
         # The loss layer will be applied outside Network class
         return x
 
-def train(model, criterion, loader, device, optimizer, scheduler, num_epoch = 10): # Train the model
+def train(model, criterion, loader, device, optimizer, scheduler, num_epoch=10, checkpoint=None, monitor=None, mixed_precision=False,
+          valloader=None, early_stopping=None): # Train the model
     print("Start training...")
+    if valloader is None and (early_stopping is not None or isinstance(scheduler, optim.lr_scheduler.ReduceLROnPlateau)):
+        raise ValueError("Early stopping and ReduceLROnPlateau need a valloader")
+    monitor = TrainingMonitor(device=device) if monitor is None else monitor # per phase timings of every epoch
+    autocast_device = torch.device(device).type
     model.train() # Set the model to training mode
-    for i in range(num_epoch):
-        running_loss = []
-        for state, tau, _, _, _, _ in tqdm(loader):
-            state = state.to(device)
-            tau = tau.to(device)
-            optimizer.zero_grad() # Clear gradients from the previous iteration
-            pred = model(state) # This will call Network.forward() that you implement
-            loss = criterion(pred, tau) # Calculate the loss
-            running_loss.append(loss.item())
-            loss.backward() # Backprop gradients to all tensors in the network
-            torch.nn.utils.clip_grad_norm(model.parameters(), 10.0)
-            optimizer.step() # Update trainable weights
-
-        scheduler.step()
-        print("Epoch {} loss:{}".format(i+1,np.mean(running_loss))) # Print the average loss for this epoch
+    start_epoch = checkpoint.load(model, optimizer, scheduler, early_stopping) if checkpoint is not None else 0 # resume
+    for i in range(start_epoch, num_epoch):
+        for state, tau, _, _, _, _ in monitor.batches(tqdm(loader)):
+            with monitor.phase('data'):
+                state = state.to(device)
+                tau = tau.to(device)
+            # bfloat16 autocast if mixed_precision is set
+            with monitor.phase('forward'), torch.autocast(autocast_device, torch.bfloat16, enabled=mixed_precision):
+                pred = model(state) # This will call Network.forward() that you implement
+                loss = criterion(pred, tau) # Calculate the loss
+            with monitor.phase('backward'):
+                loss.backward() # Backprop gradients to all tensors in the network
+            with monitor.phase('optimizer'):
+                torch.nn.utils.clip_grad_norm(model.parameters(), 10.0)
+                optimizer.step() # Update trainable weights
+                optimizer.zero_grad() # Clear gradients for the next iteration
+            monitor.step(len(state), loss) # summed on the device, no sync
+
+        val_loss = validation_loss(model, criterion, valloader, device) if valloader is not None else None
+        if isinstance(scheduler, optim.lr_scheduler.ReduceLROnPlateau):
+            scheduler.step(val_loss) # lower the learning rate when the validation loss stops improving
+        else:
+            scheduler.step()
+        loss = monitor.epoch(i+1, validation_loss=val_loss)
+        print("Epoch {} loss:{}".format(i+1,loss) + ("" if val_loss is None else " validation loss:{}".format(val_loss))) # Print the average loss for this epoch (one sync)
+        stop = early_stopping is not None and early_stopping.step(i+1, val_loss, model)
+        if checkpoint is not None:
+            checkpoint.step(i+1, model, optimizer, scheduler, num_epoch, early_stopping)
+        if stop:
+            print("No improvement in {} epochs, stopping after epoch {}".format(early_stopping.patience, i+1))
+            break
+
+    if early_stopping is not None:
+        early_stopping.restore(model) # continue with the best model
+        if checkpoint is not None:
+            checkpoint.save(num_epoch, model, optimizer, scheduler, early_stopping) # saved as finished
+            checkpoint.wait()
     print("Done!")
 
-def evaluate(model, criterion, loader, device, show_plots=False, num_plots=1): # Evaluate accuracy on validation / test set
+def evaluate(model, criterion, loader, device, show_plots=False, num_plots=1, monitor=None, plot_dir=None, metrics=None): # Evaluate accuracy on validation / test set, plots are saved to plot_dir if given
     model.eval() # Set the model to evaluation mode
-    MSEs = []
+    monitor = TrainingMonitor(device=device) if monitor is None else monitor
+    metrics = MetricsAccumulator() if metrics is None else metrics # errors per label, component and joint
     i = 0
     with torch.no_grad(): # Do not calculate grident to speed up computation
-        for state, tau, _, _, _, label in tqdm(loader):
+        for state, tau, _, _, _, label in monitor.batches(tqdm(loader)):
             state = state.to(device)
             tau = tau.to(device)
-            pred = model(state)
+            with monitor.phase('forward'):
+                pred = model(state)
             MSE_error = criterion(pred, tau)
-            MSEs.append(MSE_error.item())
+            monitor.step(len(state), MSE_error)
+            metrics.update(label, {'tau': pred}, {'tau': tau})
             # if label == 3:
             #     np.savetxt('cartpole_ff_3_traj.txt', np.concatenate((tau,pred),axis=1))
             if show_plots:
@@ -74,46 +114,88 @@ def evaluate(model, criterion, loader, device, show_plots=False, num_plots=1): #
                     axs[1].set_xlabel('Time Step')
                     axs[1].set_ylabel(r'$\tau_2\,(N-m)$')
                     fig.suptitle('CartPole FF NN Trajectory {}'.format(label))
-                    plt.show()
+                    if plot_dir is None:
+                        plt.show()
+                    else: # headless
+                        fig.savefig(os.path.join(plot_dir, 'trajectory_{}.png'.format(i)))
                     plt.close()
                     i += 1
 
-    Ave_MSE = np.mean(np.array(MSEs))
+    monitor.epoch(0, kind='evaluate')
+    Ave_MSE = metrics.mse('tau') # weighted by samples, not by trajectories
     print("Average Evaluation MSE: {}".format(Ave_MSE))
     return Ave_MSE
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ensemble', action='store_true', help='train all trials at once as one Ensemble, each with its own shuffling')
+    args = parser.parse_args()
+
     # Load the dataset and train and test splits
     print("Loading dataset...")
     # fname = '../cartpole_traj_gen/data/cartpole_all.mat'
     fname = '../cartpole_traj_gen/data/cartpole_all_200hz.mat'
+    data = load_dataset(fname)
 
     num_trials = 10
+    use_ensemble = args.ensemble
     MSEs = np.zeros(num_trials)
-    for i in range(num_trials):
-        data = loadmat(fname)
-        # train_trajectories, train_labels, test_trajectories, test_labels  = random_train_test_trajectories(data, num_train_labels=1, num_samples_per_label=5)
+    if use_ensemble:
         train_trajectories, train_labels, test_trajectories, test_labels  = select_train_test_trajectories(data, train_label_types=[2,3,4], num_samples_per_label=5)
-
-        TRAJ_train = TrajectoryDataset(data, train_trajectories, train_labels)
-        TRAJ_test = TrajectoryDataset(data, test_trajectories, test_labels)
+        TRAJ_train = MmapTrajectoryDataset(data, train_trajectories, train_labels)
+        TRAJ_test = MmapTrajectoryDataset(data, test_trajectories, test_labels)
         print("Done!")
-        trainloader = DataLoader(TRAJ_train, batch_size=None)
+        trainloader = ensemble_sample_loader(TRAJ_train, num_trials, batch_size=1000)
         testloader = DataLoader(TRAJ_test, batch_size=None)
 
-        # create model and specify hyperparameters
         device = "cuda" if torch.cuda.is_available() else "cpu" # Configure device
-
-        model = CartPole_FF_Network().to(device)
+        torch.manual_seed(0)
+        model = Ensemble([CartPole_FF_Network() for _ in range(num_trials)]).to(device)
         criterion = nn.MSELoss() # Specify the loss layer
-        # Modify the line below, experiment with different optimizers and parameters (such as learning rate)
-        optimizer = optim.Adam(model.parameters(), lr=5e-3, weight_decay=1e-4) # Specify optimizer and assign trainable parameters to it, weight_decay is L2 regularization strength
+        optimizer = optim.Adam(model.parameters(), lr=5e-3, weight_decay=1e-4)
         scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=40, gamma=0.5)
-        num_epoch = 200 # Choose an appropriate number of training epochs
+        num_epoch = 200
+        mixed_precision = False # train under bfloat16 autocast
+
+        config = {'model': 'Ensemble', 'members': 'CartPole_FF_Network', 'num_models': num_trials, 'optimizer': optimizer.defaults,
+                  'step_size': 40, 'gamma': 0.5, 'num_epoch': num_epoch, 'batch_size': 1000,
+                  'mixed_precision': mixed_precision}
+        cached_train(model, lambda: ensemble.train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, checkpoint=Checkpointer(checkpoint_path('cartpole_ff_ensemble', config, fname, train_trajectories, 0)),
+                     monitor=TrainingMonitor('cartpole_ff_ensemble.metrics.jsonl', device), mixed_precision=mixed_precision),
+                     config, fname, train_trajectories, seed=0)
+        MSEs = ensemble.evaluate(model, evaluate, criterion, testloader, device)
+    else:
+        for i in range(num_trials):
+            # train_trajectories, train_labels, test_trajectories, test_labels  = random_train_test_trajectories(data, num_train_labels=1, num_samples_per_label=5)
+            train_trajectories, train_labels, test_trajectories, test_labels  = select_train_test_trajectories(data, train_label_types=[2,3,4], num_samples_per_label=5)
+
+            torch.manual_seed(i) # trial i is reproducible and cached under seed i
+            TRAJ_train = MmapTrajectoryDataset(data, train_trajectories, train_labels)
+            TRAJ_test = MmapTrajectoryDataset(data, test_trajectories, test_labels)
+            print("Done!")
+            trainloader = sample_loader(TRAJ_train, batch_size=1000) # shuffled mini-batches of samples
+            testloader = DataLoader(TRAJ_test, batch_size=None)
+
+            # create model and specify hyperparameters
+            device = "cuda" if torch.cuda.is_available() else "cpu" # Configure device
+
+            model = CartPole_FF_Network().to(device)
+            criterion = nn.MSELoss() # Specify the loss layer
+            # Modify the line below, experiment with different optimizers and parameters (such as learning rate)
+            optimizer = optim.Adam(model.parameters(), lr=5e-3, weight_decay=1e-4) # Specify optimizer and assign trainable parameters to it, weight_decay is L2 regularization strength
+            scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=40, gamma=0.5)
+            num_epoch = 200 # Choose an appropriate number of training epochs
+            mixed_precision = False # train under bfloat16 autocast
 
-        # train and evaluate network
-        train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch)
-        MSEs[i] = evaluate(model, criterion, testloader, device, show_plots=False)
+            # train and evaluate network
+            config = {'model': 'CartPole_FF_Network', 'optimizer': optimizer.defaults, 'step_size': 40, 'gamma': 0.5,
+                      'num_epoch': num_epoch, 'batch_size': 1000,
+                      'mixed_precision': mixed_precision}
+            cached_train(model, lambda: train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, checkpoint=Checkpointer(checkpoint_path('cartpole_ff_trial{}'.format(i), config, fname, train_trajectories, i)),
+                         monitor=TrainingMonitor('cartpole_ff_trial{}.metrics.jsonl'.format(i), device), mixed_precision=mixed_precision),
+                         config, fname, train_trajectories, seed=i)
+            MSEs[i] = evaluate(model, criterion, testloader, device, show_plots=False)
+            evaluate_streaming(model, testloader, device, path='cartpole_ff_trial{}.predictions.npz'.format(i))
 
     print('MSEs',MSEs)
     print('Mean MSE =',np.mean(MSEs))
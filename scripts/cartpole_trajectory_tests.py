@@ -1,91 +1,185 @@
+import argparse
+from functools import partial
 import cartpole_delan_network as cdn
 import cartpole_ff_network as cffn
-import torch
-from scipy.io import loadmat
-from tqdm import tqdm
 from torch import nn, optim
 import numpy as np
 import matplotlib.pyplot as plt
-from dataset import TrajectoryDataset
+from dataset import sample_loader, stacked_sample_loader
+from trajectory_store import MmapTrajectoryDataset, TrajectoryStore, load_dataset, store_path
 from torch.utils.data import DataLoader
-from trajectory_selection import random_train_test_trajectories
-np.random.seed(0)
+from trajectory_selection import random_train_test_trajectories, validation_trajectories
+from sweep_runner import run_sweep, config_key, member_results, results_array, row_results, seed_everything
+from metrics_accumulator import MetricsAccumulator, merge_all
+from model_cache import cached_train
+from early_stopping import EarlyStopping
+import ensemble
+from ensemble import Ensemble
 
-# Load the dataset and choose test parameters
-print("Loading dataset...")
+# Choose test parameters
 fname = '../cartpole_traj_gen/data/cartpole_all.mat'
-data = loadmat(fname)
-print("Done!")
 num_epoch = 200
 num_samples_per_traj = 1
 seeds = np.arange(2)
 train_traj_range = np.arange(1,4)
-cdn_loss = np.zeros((len(train_traj_range),len(seeds)))
-cffn_loss = np.zeros(cdn_loss.shape)
+models = ['delan', 'ff']
+plateau_patience = 10 # epochs without improvement of the validation loss before the learning rate is halved
+early_stopping_patience = 10 # and before training stops (num_epoch is the maximum)
+early_stopping_min_delta = 0.01 # relative improvement that counts
+learning_rates = {'delan': 5e-3, 'ff': 5e-3}
+weight_decay = 1e-3
+batch_size = 1000
+# everything the cells are trained with, results of cells trained with other settings are not reused
+sweep_config = {'num_epoch': num_epoch, 'num_samples_per_traj': num_samples_per_traj, 'learning_rates': learning_rates,
+                'weight_decay': weight_decay, 'batch_size': batch_size, 'scheduler': 'ReduceLROnPlateau', 'factor': 0.5,
+                'plateau_patience': plateau_patience, 'early_stopping_patience': early_stopping_patience,
+                'early_stopping_min_delta': early_stopping_min_delta}
 
-# device = "cuda" if torch.cuda.is_available() else "cpu" # Configure device
-device = "cpu" # Configure device
 
-criterion = nn.MSELoss() # Specify the loss layer
+def cell_data(num_train_trajs, seed):
+    '''
+        train, validation and test datasets of the (num_train_trajs, seed) split, and the train and validation
+        trajectory indices. Seeds everything first, so the split and the initialization that follows only depend on
+        the seed
+    '''
+    seed_everything(seed)
+    data = TrajectoryStore(store_path(fname))
+    train_trajectories, train_labels, test_trajectories, test_labels  = random_train_test_trajectories(data, num_train_labels=num_train_trajs, num_samples_per_label=num_samples_per_traj)
+    TRAJ_train = MmapTrajectoryDataset(data, train_trajectories, train_labels)
+    TRAJ_test = MmapTrajectoryDataset(data, test_trajectories, test_labels)
+    val_trajectories, val_labels = validation_trajectories(data, train_trajectories, train_labels, num_samples_per_traj)
+    TRAJ_val = MmapTrajectoryDataset(data, val_trajectories, val_labels)
+    return TRAJ_train, TRAJ_val, TRAJ_test, train_trajectories, val_trajectories
 
-i = 0
-for num_train_trajs in tqdm(train_traj_range):
-    for seed in seeds:
-        torch.manual_seed(seed)
-        train_trajectories, train_labels, test_trajectories, test_labels  = random_train_test_trajectories(data, num_train_labels=num_train_trajs, num_samples_per_label=1)
-        TRAJ_train = TrajectoryDataset(data, train_trajectories, train_labels)
-        TRAJ_test = TrajectoryDataset(data, test_trajectories, test_labels)
-        trainloader = DataLoader(TRAJ_train, batch_size=None)
-        testloader = DataLoader(TRAJ_test, batch_size=None)
 
+def make_model(model_name, device):
+    ''' network script module and new model of model_name '''
+    if model_name == 'delan':
         # create model for cartpole delan network and specify hyperparameters
-        cdn_model = cdn.CartPole_DeLaN_Network().to(device)
-        cdn_optimizer = optim.Adam(cdn_model.parameters(), lr=5e-3, weight_decay=1e-3)
-        cdn_scheduler = optim.lr_scheduler.StepLR(cdn_optimizer, step_size=40, gamma=0.5)
-
-        # create model for cartpole ff network and specify hyperparameters
-        cffn_model = cffn.CartPole_FF_Network().to(device)
-        cffn_optimizer = optim.Adam(cffn_model.parameters(), lr=5e-3, weight_decay=1e-3)
-        cffn_scheduler = optim.lr_scheduler.StepLR(cffn_optimizer, step_size=40, gamma=0.5)
-
-        # train and evaluate cartpole delan network
-        cdn.train(cdn_model, criterion, trainloader, device, cdn_optimizer, cdn_scheduler, num_epoch)
-        cdn_loss[i,seed] = cdn.evaluate(cdn_model, criterion, testloader, device)
-
-        # train and evaluate cartpole ff network
-        cffn.train(cffn_model, criterion, trainloader, device, cffn_optimizer, cffn_scheduler, num_epoch)
-        cffn_loss[i,seed] = cffn.evaluate(cffn_model, criterion, testloader, device)
-    i += 1
-
-# statistics for cartpole delan
-cdn_mean = np.mean(cdn_loss, axis=1)
-cdn_sigma = np.std(cdn_loss, axis=1)
-cdn_upper_95conf = cdn_mean + 2 * cdn_sigma
-cdn_lower_95conf = np.maximum(cdn_mean - 2 * cdn_sigma, np.zeros(cdn_mean.shape))
-
-# statistics for cartpole ff-nn
-cffn_mean = np.mean(cffn_loss, axis=1)
-cffn_sigma = np.std(cffn_loss, axis=1)
-cffn_upper_95conf = cffn_mean + 2 * cffn_sigma
-cffn_lower_95conf = np.maximum(cffn_mean - 2 * cffn_sigma, np.zeros(cffn_mean.shape))
-
-# generate test error plot
-plt.plot(train_traj_range, np.mean(cdn_loss, axis=1), c='red',label='CartPole DeLaN')
-plt.plot(train_traj_range, np.mean(cffn_loss, axis=1), c='blue',label='CartPole FF-NN')
-plt.fill_between(train_traj_range,cdn_lower_95conf,cdn_upper_95conf,where=cdn_upper_95conf >= cdn_lower_95conf, facecolor='red', interpolate=True, alpha=0.5)
-plt.fill_between(train_traj_range,cffn_lower_95conf,cffn_upper_95conf,where=cffn_upper_95conf >= cffn_lower_95conf, facecolor='blue', interpolate=True, alpha=0.5)
-plt.yscale('log')
-plt.xticks(train_traj_range)
-plt.ylabel('MSE')
-plt.xlabel('Unique Trajectory Types')
-plt.legend()
-plt.title('CartPole DeLaN vs FF-NN Test Error')
-plt.savefig('cartpole_delan_vs_ff_test_error.png')
-# plt.show()
-plt.close()
-
-np.savetxt('cdn_loss.txt',cdn_loss)
-np.savetxt('cffn_loss.txt',cffn_loss)
+        return cdn, cdn.CartPole_DeLaN_Network().to(device)
+    # create model for cartpole ff network and specify hyperparameters
+    return cffn, cffn.CartPole_FF_Network().to(device)
+
+
+def run_cell(cell, device="cpu"):
+    ''' trains and evaluates one model on the (num_train_trajs, seed) split of cell, returns the test errors as a MetricsAccumulator state '''
+    num_train_trajs, seed, model_name = cell
+    TRAJ_train, TRAJ_val, TRAJ_test, train_trajectories, val_trajectories = cell_data(num_train_trajs, seed)
+    criterion = nn.MSELoss() # Specify the loss layer
+    trainloader = sample_loader(TRAJ_train, batch_size=batch_size) # shuffled mini-batches of samples
+    testloader = DataLoader(TRAJ_test, batch_size=None)
+    valloader = DataLoader(TRAJ_val, batch_size=None)
+
+    module, model = make_model(model_name, device)
+    optimizer = optim.Adam(model.parameters(), lr=learning_rates[model_name], weight_decay=weight_decay)
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.5, patience=plateau_patience)
+
+    # train (or load the cached model of an identical earlier run) and evaluate
+    config = {'model': type(model).__name__, 'optimizer': optimizer.defaults, 'scheduler': 'ReduceLROnPlateau', 'factor': 0.5,
+              'plateau_patience': plateau_patience, 'early_stopping_patience': early_stopping_patience,
+              'early_stopping_min_delta': early_stopping_min_delta, 'validation_trajectories': val_trajectories,
+              'num_epoch': num_epoch, 'batch_size': batch_size}
+    cached_train(model, lambda: module.train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, valloader=valloader,
+                                          early_stopping=EarlyStopping(early_stopping_patience, early_stopping_min_delta)),
+                 config, fname, train_trajectories, seed)
+    metrics = MetricsAccumulator()
+    module.evaluate(model, criterion, testloader, device, metrics=metrics)
+    return metrics.state_dict()
+
+
+def run_ensemble_cell(cell, device="cpu"):
+    '''
+        trains the models of all seeds of the (num_train_trajs, model) cell as one Ensemble, each on the split of its seed
+        with its own learning rate schedule and early stopping. Returns the test errors of every seed (in the order of
+        seeds) as MetricsAccumulator states
+    '''
+    num_train_trajs, model_name = cell
+    criterion = nn.MSELoss()
+    cells, members = [], []
+    for seed in seeds:
+        cells.append(cell_data(num_train_trajs, int(seed)))
+        module, member = make_model(model_name, device) # initialized as in run_cell
+        members.append(member)
+    model = Ensemble(members).to(device)
+    trainloader = stacked_sample_loader([c[0] for c in cells], batch_size=batch_size) # one split per model
+    valloaders = [DataLoader(c[1], batch_size=None) for c in cells]
+    optimizer = optim.Adam(model.parameters(), lr=learning_rates[model_name], weight_decay=weight_decay)
+    scheduler = ensemble.PlateauScheduler(len(seeds), factor=0.5, patience=plateau_patience)
+
+    config = {'model': 'Ensemble', 'members': type(members[0]).__name__, 'optimizer': optimizer.defaults,
+              'scheduler': 'PlateauScheduler', 'factor': 0.5, 'plateau_patience': plateau_patience,
+              'early_stopping_patience': early_stopping_patience, 'early_stopping_min_delta': early_stopping_min_delta,
+              'validation_trajectories': [c[4] for c in cells], 'num_epoch': num_epoch, 'batch_size': batch_size}
+    cached_train(model, lambda: ensemble.train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, valloader=valloaders,
+                                               early_stopping=ensemble.EnsembleEarlyStopping(len(seeds), early_stopping_patience, early_stopping_min_delta)),
+                 config, fname, [c[3] for c in cells], [int(seed) for seed in seeds])
+    results = []
+    for k, c in enumerate(cells):
+        metrics = MetricsAccumulator()
+        module.evaluate(model.member(k), criterion, DataLoader(c[2], batch_size=None), device, metrics=metrics)
+        results.append(metrics.state_dict())
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None, help='parallel cells, defaults to the number of CPUs / threads')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker')
+    parser.add_argument('--results', default='cartpole_sweep_metrics.jsonl', help='completed cells are skipped on restart')
+    parser.add_argument('--device', default="cpu")
+    parser.add_argument('--ensemble', action='store_true', help='train the seeds of a cell as one Ensemble')
+    args = parser.parse_args()
+
+    # Convert the dataset once, before the workers open it
+    print("Loading dataset...")
+    load_dataset(fname)
+    print("Done!")
+
+    if args.ensemble:
+        # one cell per (n, model), its result lists the results of the seeds
+        cells = [(int(n), model) for n in train_traj_range for model in models]
+        config = config_key(dict(sweep_config, ensemble=True, seeds=seeds.tolist()), fname)
+        results = run_sweep(cells, partial(run_ensemble_cell, device=args.device), args.results, args.workers, args.threads,
+                            config=config)
+        results = member_results(results, [int(seed) for seed in seeds])
+    else:
+        cells = [(int(n), int(seed), model) for n in train_traj_range for seed in seeds for model in models]
+        results = run_sweep(cells, partial(run_cell, device=args.device), args.results, args.workers, args.threads,
+                            config=config_key(sweep_config, fname))
+    # test MSE of every seed, and of the test samples of all seeds together
+    test_mse = lambda result: MetricsAccumulator.from_state_dict(result).mse()
+    pooled_mse = lambda cells: merge_all(MetricsAccumulator.from_state_dict(result) for result in cells).mse()
+    cdn_loss = results_array(results, train_traj_range, seeds, 'delan', value=test_mse)
+    cffn_loss = results_array(results, train_traj_range, seeds, 'ff', value=test_mse)
+    cdn_pooled = np.array([pooled_mse(cells) for cells in row_results(results, train_traj_range, seeds, 'delan')])
+    cffn_pooled = np.array([pooled_mse(cells) for cells in row_results(results, train_traj_range, seeds, 'ff')])
+
+    # statistics for cartpole delan
+    cdn_mean = cdn_pooled # weighted by test samples, not by seeds
+    cdn_sigma = np.std(cdn_loss, axis=1)
+    cdn_upper_95conf = cdn_mean + 2 * cdn_sigma
+    cdn_lower_95conf = np.maximum(cdn_mean - 2 * cdn_sigma, np.zeros(cdn_mean.shape))
 
+    # statistics for cartpole ff-nn
+    cffn_mean = cffn_pooled
+    cffn_sigma = np.std(cffn_loss, axis=1)
+    cffn_upper_95conf = cffn_mean + 2 * cffn_sigma
+    cffn_lower_95conf = np.maximum(cffn_mean - 2 * cffn_sigma, np.zeros(cffn_mean.shape))
 
+    # generate test error plot
+    plt.plot(train_traj_range, cdn_mean, c='red',label='CartPole DeLaN')
+    plt.plot(train_traj_range, cffn_mean, c='blue',label='CartPole FF-NN')
+    plt.fill_between(train_traj_range,cdn_lower_95conf,cdn_upper_95conf,where=cdn_upper_95conf >= cdn_lower_95conf, facecolor='red', interpolate=True, alpha=0.5)
+    plt.fill_between(train_traj_range,cffn_lower_95conf,cffn_upper_95conf,where=cffn_upper_95conf >= cffn_lower_95conf, facecolor='blue', interpolate=True, alpha=0.5)
+    plt.yscale('log')
+    plt.xticks(train_traj_range)
+    plt.ylabel('MSE')
+    plt.xlabel('Unique Trajectory Types')
+    plt.legend()
+    plt.title('CartPole DeLaN vs FF-NN Test Error')
+    plt.savefig('cartpole_delan_vs_ff_test_error.png')
+    # plt.show()
+    plt.close()
 
+    np.savetxt('cdn_loss.txt',cdn_loss)
+    np.savetxt('cffn_loss.txt',cffn_loss)
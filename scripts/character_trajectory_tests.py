@@ -1,89 +1,185 @@
+import argparse
+from functools import partial
 import reacher_delan_network as rdn
 import reacher_ff_network as rffn
-import torch
-from tqdm import tqdm
 from torch import nn, optim
 import numpy as np
 import matplotlib.pyplot as plt
-from dataset import TrajectoryDataset
+from dataset import sample_loader, stacked_sample_loader
+from trajectory_store import MmapTrajectoryDataset, TrajectoryStore, load_dataset, store_path
 from torch.utils.data import DataLoader
-from trajectory_selection import random_train_test_chars
-np.random.seed(0)
+from trajectory_selection import random_train_test_chars, validation_chars
+from sweep_runner import run_sweep, config_key, member_results, results_array, row_results, seed_everything
+from metrics_accumulator import MetricsAccumulator, merge_all
+from model_cache import cached_train
+from early_stopping import EarlyStopping
+import ensemble
+from ensemble import Ensemble
 
-# Load the dataset and choose test parameters
-print("Loading dataset...")
-data = np.load('../data/trajectories_joint_space.npz', allow_pickle=True)
-print("Done!")
+# Choose test parameters
+fname = '../data/trajectories_joint_space.npz'
 num_epoch = 150
 num_samples_per_char = 1
 seeds = np.arange(2)
 train_chars_range = np.concatenate((np.array([1]),np.arange(2,19,step=2)))
-rdn_loss = np.zeros((len(train_chars_range),len(seeds)))
-rffn_loss = np.zeros(rdn_loss.shape)
+models = ['delan', 'ff']
+plateau_patience = 10 # epochs without improvement of the validation loss before the learning rate is halved
+early_stopping_patience = 10 # and before training stops (num_epoch is the maximum)
+early_stopping_min_delta = 0.01 # relative improvement that counts
+learning_rates = {'delan': 5e-3, 'ff': 5e-2}
+weight_decay = 1e-3
+batch_size = 1000
+# everything the cells are trained with, results of cells trained with other settings are not reused
+sweep_config = {'num_epoch': num_epoch, 'num_samples_per_char': num_samples_per_char, 'learning_rates': learning_rates,
+                'weight_decay': weight_decay, 'batch_size': batch_size, 'scheduler': 'ReduceLROnPlateau', 'factor': 0.5,
+                'plateau_patience': plateau_patience, 'early_stopping_patience': early_stopping_patience,
+                'early_stopping_min_delta': early_stopping_min_delta}
 
-# device = "cuda" if torch.cuda.is_available() else "cpu" # Configure device
-device = "cpu" # Configure device
 
-criterion = nn.MSELoss() # Specify the loss layer
+def cell_data(num_train_chars, seed):
+    '''
+        train, validation and test datasets of the (num_train_chars, seed) split, and the train and validation
+        trajectory indices. Seeds everything first, so the split and the initialization that follows only depend on
+        the seed
+    '''
+    seed_everything(seed)
+    data = TrajectoryStore(store_path(fname))
+    train_trajectories, train_labels, test_trajectories, test_labels = random_train_test_chars(data, num_train_chars=num_train_chars, num_samples_per_char=num_samples_per_char)
+    TRAJ_train = MmapTrajectoryDataset(data, train_trajectories, train_labels)
+    TRAJ_test = MmapTrajectoryDataset(data, test_trajectories, test_labels)
+    val_trajectories, val_labels = validation_chars(data, train_trajectories, train_labels, num_samples_per_char)
+    TRAJ_val = MmapTrajectoryDataset(data, val_trajectories, val_labels)
+    return TRAJ_train, TRAJ_val, TRAJ_test, train_trajectories, val_trajectories
 
-i = 0
-for num_train_chars in tqdm(train_chars_range):
-    for seed in seeds:
-        torch.manual_seed(seed)
-        train_trajectories, train_labels, test_trajectories, test_labels = random_train_test_chars(data, num_train_chars=num_train_chars, num_samples_per_char=1)
-        TRAJ_train = TrajectoryDataset(data,train_trajectories, train_labels)
-        TRAJ_test = TrajectoryDataset(data,test_trajectories, test_labels)
-        trainloader = DataLoader(TRAJ_train, batch_size=None)
-        testloader = DataLoader(TRAJ_test, batch_size=None)
 
+def make_model(model_name, device):
+    ''' network script module and new model of model_name '''
+    if model_name == 'delan':
         # create model for reacher delan network and specify hyperparameters
-        rdn_model = rdn.Reacher_DeLaN_Network().to(device)
-        rdn_optimizer = optim.Adam(rdn_model.parameters(), lr=5e-3, weight_decay=1e-3)
-        rdn_scheduler = optim.lr_scheduler.StepLR(rdn_optimizer, step_size=40, gamma=0.5)
-
-        # create model for reacher ff network and specify hyperparameters
-        rffn_model = rffn.Reacher_FF_Network().to(device)
-        rffn_optimizer = optim.Adam(rffn_model.parameters(), lr=5e-2, weight_decay=1e-3)
-        rffn_scheduler = optim.lr_scheduler.StepLR(rffn_optimizer, step_size=40, gamma=0.5)
-
-        # train and evaluate reacher delan network
-        rdn.train(rdn_model, criterion, trainloader, device, rdn_optimizer, rdn_scheduler, num_epoch)
-        rdn_loss[i,seed] = rdn.evaluate(rdn_model, criterion, testloader, device)
-
-        # train and evaluate reacher ff network
-        rffn.train(rffn_model, criterion, trainloader, device, rffn_optimizer, rffn_scheduler, num_epoch)
-        rffn_loss[i,seed] = rffn.evaluate(rffn_model, criterion, testloader, device)
-    i += 1
-
-# statistics for reacher delan
-rdn_mean = np.mean(rdn_loss, axis=1)
-rdn_sigma = np.std(rdn_loss, axis=1)
-rdn_upper_95conf = rdn_mean + 2 * rdn_sigma
-rdn_lower_95conf = rdn_mean - 2 * rdn_sigma
-
-# statistics for reacher ff-nn
-rffn_mean = np.mean(rffn_loss, axis=1)
-rffn_sigma = np.std(rffn_loss, axis=1)
-rffn_upper_95conf = rffn_mean + 2 * rffn_sigma
-rffn_lower_95conf = rffn_mean - 2 * rffn_sigma
-
-# generate test error plot
-plt.plot(train_chars_range, np.mean(rdn_loss, axis=1), c='red',label='Reacher DeLaN')
-plt.plot(train_chars_range, np.mean(rffn_loss, axis=1), c='blue',label='Reacher FF-NN')
-plt.fill_between(train_chars_range,rdn_lower_95conf,rdn_upper_95conf,where=rdn_upper_95conf >= rdn_lower_95conf, facecolor='red', interpolate=True, alpha=0.5)
-plt.fill_between(train_chars_range,rffn_lower_95conf,rffn_upper_95conf,where=rffn_upper_95conf >= rffn_lower_95conf, facecolor='blue', interpolate=True, alpha=0.5)
-# plt.yscale('log')
-plt.xticks(train_chars_range)
-plt.ylabel('MSE')
-plt.xlabel('Unique Training Characters')
-plt.legend()
-plt.title('Reacher DeLaN vs FF-NN Test Error')
-plt.savefig('delan_vs_ff_test_error.png')
-# plt.show()
-plt.close()
-
-np.savetxt('rdn_loss.txt',rdn_loss)
-np.savetxt('rffn_loss.txt',rffn_loss)
+        return rdn, rdn.Reacher_DeLaN_Network().to(device)
+    # create model for reacher ff network and specify hyperparameters
+    return rffn, rffn.Reacher_FF_Network().to(device)
+
+
+def run_cell(cell, device="cpu"):
+    ''' trains and evaluates one model on the (num_train_chars, seed) split of cell, returns the test errors as a MetricsAccumulator state '''
+    num_train_chars, seed, model_name = cell
+    TRAJ_train, TRAJ_val, TRAJ_test, train_trajectories, val_trajectories = cell_data(num_train_chars, seed)
+    criterion = nn.MSELoss() # Specify the loss layer
+    trainloader = sample_loader(TRAJ_train, batch_size=batch_size) # shuffled mini-batches of samples
+    testloader = DataLoader(TRAJ_test, batch_size=None)
+    valloader = DataLoader(TRAJ_val, batch_size=None)
+
+    module, model = make_model(model_name, device)
+    optimizer = optim.Adam(model.parameters(), lr=learning_rates[model_name], weight_decay=weight_decay)
+    scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.5, patience=plateau_patience)
+
+    # train (or load the cached model of an identical earlier run) and evaluate
+    config = {'model': type(model).__name__, 'optimizer': optimizer.defaults, 'scheduler': 'ReduceLROnPlateau', 'factor': 0.5,
+              'plateau_patience': plateau_patience, 'early_stopping_patience': early_stopping_patience,
+              'early_stopping_min_delta': early_stopping_min_delta, 'validation_trajectories': val_trajectories,
+              'num_epoch': num_epoch, 'batch_size': batch_size}
+    cached_train(model, lambda: module.train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, valloader=valloader,
+                                          early_stopping=EarlyStopping(early_stopping_patience, early_stopping_min_delta)),
+                 config, fname, train_trajectories, seed)
+    metrics = MetricsAccumulator()
+    module.evaluate(model, criterion, testloader, device, metrics=metrics)
+    return metrics.state_dict()
+
+
+def run_ensemble_cell(cell, device="cpu"):
+    '''
+        trains the models of all seeds of the (num_train_chars, model) cell as one Ensemble, each on the split of its seed
+        with its own learning rate schedule and early stopping. Returns the test errors of every seed (in the order of
+        seeds) as MetricsAccumulator states
+    '''
+    num_train_chars, model_name = cell
+    criterion = nn.MSELoss()
+    cells, members = [], []
+    for seed in seeds:
+        cells.append(cell_data(num_train_chars, int(seed)))
+        module, member = make_model(model_name, device) # initialized as in run_cell
+        members.append(member)
+    model = Ensemble(members).to(device)
+    trainloader = stacked_sample_loader([c[0] for c in cells], batch_size=batch_size) # one split per model
+    valloaders = [DataLoader(c[1], batch_size=None) for c in cells]
+    optimizer = optim.Adam(model.parameters(), lr=learning_rates[model_name], weight_decay=weight_decay)
+    scheduler = ensemble.PlateauScheduler(len(seeds), factor=0.5, patience=plateau_patience)
+
+    config = {'model': 'Ensemble', 'members': type(members[0]).__name__, 'optimizer': optimizer.defaults,
+              'scheduler': 'PlateauScheduler', 'factor': 0.5, 'plateau_patience': plateau_patience,
+              'early_stopping_patience': early_stopping_patience, 'early_stopping_min_delta': early_stopping_min_delta,
+              'validation_trajectories': [c[4] for c in cells], 'num_epoch': num_epoch, 'batch_size': batch_size}
+    cached_train(model, lambda: ensemble.train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, valloader=valloaders,
+                                               early_stopping=ensemble.EnsembleEarlyStopping(len(seeds), early_stopping_patience, early_stopping_min_delta)),
+                 config, fname, [c[3] for c in cells], [int(seed) for seed in seeds])
+    results = []
+    for k, c in enumerate(cells):
+        metrics = MetricsAccumulator()
+        module.evaluate(model.member(k), criterion, DataLoader(c[2], batch_size=None), device, metrics=metrics)
+        results.append(metrics.state_dict())
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None, help='parallel cells, defaults to the number of CPUs / threads')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads per worker')
+    parser.add_argument('--results', default='character_sweep_metrics.jsonl', help='completed cells are skipped on restart')
+    parser.add_argument('--device', default="cpu")
+    parser.add_argument('--ensemble', action='store_true', help='train the seeds of a cell as one Ensemble')
+    args = parser.parse_args()
+
+    # Convert the dataset once, before the workers open it
+    print("Loading dataset...")
+    load_dataset(fname)
+    print("Done!")
+
+    if args.ensemble:
+        # one cell per (n, model), its result lists the results of the seeds
+        cells = [(int(n), model) for n in train_chars_range for model in models]
+        config = config_key(dict(sweep_config, ensemble=True, seeds=seeds.tolist()), fname)
+        results = run_sweep(cells, partial(run_ensemble_cell, device=args.device), args.results, args.workers, args.threads,
+                            config=config)
+        results = member_results(results, [int(seed) for seed in seeds])
+    else:
+        cells = [(int(n), int(seed), model) for n in train_chars_range for seed in seeds for model in models]
+        results = run_sweep(cells, partial(run_cell, device=args.device), args.results, args.workers, args.threads,
+                            config=config_key(sweep_config, fname))
+    # test MSE of every seed, and of the test samples of all seeds together
+    test_mse = lambda result: MetricsAccumulator.from_state_dict(result).mse()
+    pooled_mse = lambda cells: merge_all(MetricsAccumulator.from_state_dict(result) for result in cells).mse()
+    rdn_loss = results_array(results, train_chars_range, seeds, 'delan', value=test_mse)
+    rffn_loss = results_array(results, train_chars_range, seeds, 'ff', value=test_mse)
+    rdn_pooled = np.array([pooled_mse(cells) for cells in row_results(results, train_chars_range, seeds, 'delan')])
+    rffn_pooled = np.array([pooled_mse(cells) for cells in row_results(results, train_chars_range, seeds, 'ff')])
+
+    # statistics for reacher delan
+    rdn_mean = rdn_pooled # weighted by test samples, not by seeds
+    rdn_sigma = np.std(rdn_loss, axis=1)
+    rdn_upper_95conf = rdn_mean + 2 * rdn_sigma
+    rdn_lower_95conf = rdn_mean - 2 * rdn_sigma
 
+    # statistics for reacher ff-nn
+    rffn_mean = rffn_pooled
+    rffn_sigma = np.std(rffn_loss, axis=1)
+    rffn_upper_95conf = rffn_mean + 2 * rffn_sigma
+    rffn_lower_95conf = rffn_mean - 2 * rffn_sigma
 
+    # generate test error plot
+    plt.plot(train_chars_range, rdn_mean, c='red',label='Reacher DeLaN')
+    plt.plot(train_chars_range, rffn_mean, c='blue',label='Reacher FF-NN')
+    plt.fill_between(train_chars_range,rdn_lower_95conf,rdn_upper_95conf,where=rdn_upper_95conf >= rdn_lower_95conf, facecolor='red', interpolate=True, alpha=0.5)
+    plt.fill_between(train_chars_range,rffn_lower_95conf,rffn_upper_95conf,where=rffn_upper_95conf >= rffn_lower_95conf, facecolor='blue', interpolate=True, alpha=0.5)
+    # plt.yscale('log')
+    plt.xticks(train_chars_range)
+    plt.ylabel('MSE')
+    plt.xlabel('Unique Training Characters')
+    plt.legend()
+    plt.title('Reacher DeLaN vs FF-NN Test Error')
+    plt.savefig('delan_vs_ff_test_error.png')
+    # plt.show()
+    plt.close()
 
+    np.savetxt('rdn_loss.txt',rdn_loss)
+    np.savetxt('rffn_loss.txt',rffn_loss)
@@ -0,0 +1,101 @@
+'''
+
+    Periodic, atomic training checkpoints (model, optimizer, scheduler, RNG states, epoch and early stopping) with resume.
+    The state is copied to the CPU at the end of an epoch and written by a background thread, so training
+    continues while the file is saved. A checkpoint file is only ever replaced by a complete one
+
+'''
+import os
+import random
+import threading
+import numpy as np
+import torch
+
+
+def _to_cpu(state):
+    ''' deep copy of a state dict with every tensor on the CPU '''
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: _to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(v) for v in state)
+    return state
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer:
+    def __init__(self, path, every=10):
+        '''
+            saves to path every `every` epochs (and after the last one). Resumes from path if it exists
+        '''
+        self.path = path
+        self.every = every
+        self._thread = None
+
+    def load(self, model, optimizer=None, scheduler=None, early_stopping=None):
+        ''' restores the states from the checkpoint if there is one, returns the number of epochs already done '''
+        if not os.path.exists(self.path):
+            return 0
+        state = torch.load(self.path, map_location='cpu', weights_only=False)
+        model.load_state_dict(state['model'])
+        if optimizer is not None:
+            optimizer.load_state_dict(state['optimizer'])
+        if scheduler is not None:
+            scheduler.load_state_dict(state['scheduler'])
+        if early_stopping is not None and state.get('early_stopping') is not None:
+            early_stopping.load_state_dict(state['early_stopping'])
+        set_rng_state(state['rng'])
+        print("Resuming from {} after epoch {}".format(self.path, state['epoch']))
+        return state['epoch']
+
+    def step(self, epoch, model, optimizer, scheduler, num_epoch, early_stopping=None):
+        ''' call after every epoch (counting from 1), saves on every `every`-th and the last one '''
+        if epoch % self.every == 0 or epoch == num_epoch:
+            self.save(epoch, model, optimizer, scheduler, early_stopping)
+        if epoch == num_epoch:
+            self.wait()
+
+    def save(self, epoch, model, optimizer=None, scheduler=None, early_stopping=None):
+        # the copy is taken now, before the next optimizer step changes the tensors
+        state = {'epoch': epoch, 'model': _to_cpu(model.state_dict()), 'rng': rng_state(),
+                 'optimizer': _to_cpu(optimizer.state_dict()) if optimizer is not None else None,
+                 'scheduler': scheduler.state_dict() if scheduler is not None else None,
+                 'early_stopping': early_stopping.state_dict() if early_stopping is not None else None}
+        self.wait() # one write at a time, in order
+        self._thread = threading.Thread(target=self._write, args=(state,))
+        self._thread.start()
+
+    def _write(self, state):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def wait(self):
+        ''' blocks until the last checkpoint is on disk '''
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def load_model(path, model):
+    ''' loads the weights of a checkpoint (e.g. of a finished training run) into model for evaluation '''
+    model.load_state_dict(torch.load(path, map_location='cpu', weights_only=False)['model'])
+    return model
@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler, Sampler
 from torch.utils.data.dataset import Dataset
 
 class TrajectoryDataset(Dataset):
@@ -16,6 +17,9 @@ class TrajectoryDataset(Dataset):
         return len(self.indices)
 
     def __getitem__(self, idx):
+        if isinstance(idx, (list, tuple, np.ndarray)):
+            return self._get_trajectories(idx)
+
         trajTensor = torch.from_numpy(self.trajectories[self.indices[idx]]).float()
         torqueTensor = torch.from_numpy(self.torques[self.indices[idx]]).float()
         gTensor = torch.from_numpy(self.g[self.indices[idx]]).float()
@@ -24,3 +28,169 @@ class TrajectoryDataset(Dataset):
         label = self.labels[idx]
 
         return (trajTensor, torqueTensor, gTensor, cTensor, HTensor, label)
+
+    def _get_trajectories(self, idxs):
+        ''' concatenates several trajectories into one batch of samples, with one label per sample '''
+        items = [self[i] for i in idxs]
+        lengths = [len(item[0]) for item in items]
+        tensors = [torch.cat([item[k] for item in items]) for k in range(5)]
+        labels = np.repeat(np.asarray([item[5] for item in items]), lengths)
+        return tuple(tensors) + (labels,)
+
+    def lengths(self):
+        ''' number of samples in each trajectory '''
+        return [len(self.trajectories[i]) for i in self.indices]
+
+
+class SampleDataset(Dataset):
+    '''
+        Flattens the trajectories of a TrajectoryDataset into individual samples, converted to float32 once.
+        Indexing with a list of sample indices returns a whole batch, use with sample_loader
+    '''
+    def __init__(self, trajectory_dataset):
+        items = [trajectory_dataset[i] for i in range(len(trajectory_dataset))]
+        lengths = [len(item[0]) for item in items]
+        self.trajectories, self.torques, self.g, self.c, self.H = [torch.cat([item[k] for item in items]) for k in range(5)]
+        self.labels = np.repeat(np.asarray([item[5] for item in items]), lengths)
+
+    def __len__(self):
+        return len(self.trajectories)
+
+    def __getitem__(self, idx):
+        labels = self.labels[idx.numpy() if torch.is_tensor(idx) else idx]
+        return (self.trajectories[idx], self.torques[idx], self.g[idx], self.c[idx], self.H[idx], labels)
+
+
+class LengthBucketSampler(Sampler):
+    '''
+        Yields lists of trajectory indices of similar length, so whole trajectories can be batched together
+        with little imbalance between batches. Batches are formed from the length-sorted trajectories and
+        visited in random order when shuffle is set
+    '''
+    def __init__(self, lengths, batch_size, shuffle=True):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            # random tie-breaking between trajectories of the same length
+            perm = torch.randperm(len(self.lengths)).numpy()
+            order = perm[np.argsort(self.lengths[perm], kind='stable')]
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+        batches = [order[i:i + self.batch_size].tolist() for i in range(0, len(order), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return iter(batches)
+
+
+def sample_loader(trajectory_dataset, batch_size=1000, shuffle=True, drop_last=False, num_workers=0, pin_memory=False):
+    '''
+        DataLoader over the individual samples of a TrajectoryDataset in (shuffled) mini-batches. Each batch is
+        fetched with a single indexing operation, also inside worker processes
+    '''
+    samples = SampleDataset(trajectory_dataset)
+    sampler = RandomSampler(samples) if shuffle else SequentialSampler(samples)
+    return DataLoader(samples, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last),
+                      num_workers=num_workers, pin_memory=pin_memory)
+
+
+class EnsembleBatchSampler(Sampler):
+    '''
+        Yields num_models x batch_size index tensors, a batch for every model of an ensemble drawn from its own
+        permutation of the samples, so the models see the same data in a different order
+    '''
+    def __init__(self, num_samples, num_models, batch_size, shuffle=True, drop_last=False):
+        self.num_samples = num_samples
+        self.num_models = num_models
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.stack([torch.randperm(self.num_samples) for _ in range(self.num_models)])
+        else:
+            order = torch.arange(self.num_samples).expand(self.num_models, -1)
+        for i in range(len(self)):
+            yield order[:, i * self.batch_size:(i + 1) * self.batch_size]
+
+
+def ensemble_sample_loader(trajectory_dataset, num_models, batch_size=1000, shuffle=True, drop_last=False,
+                           num_workers=0, pin_memory=False):
+    '''
+        sample_loader for an Ensemble, batches are num_models x batch_size x ...
+    '''
+    samples = SampleDataset(trajectory_dataset)
+    sampler = EnsembleBatchSampler(len(samples), num_models, batch_size, shuffle, drop_last)
+    return DataLoader(samples, batch_size=None, sampler=sampler, num_workers=num_workers, pin_memory=pin_memory)
+
+
+class StackedSampleDataset(Dataset):
+    '''
+        The samples of one TrajectoryDataset per model of an ensemble (e.g. the splits of different seeds). Indexing
+        with a num_models x batch_size index tensor returns row k of the batch from the samples of model k
+    '''
+    def __init__(self, trajectory_datasets):
+        self.members = [SampleDataset(dataset) for dataset in trajectory_datasets]
+
+    def __len__(self):
+        return max(len(member) for member in self.members)
+
+    def __getitem__(self, idx):
+        batches = [member[i] for member, i in zip(self.members, idx)]
+        return tuple(torch.stack([batch[k] for batch in batches]) for k in range(5)) + \
+               (np.stack([batch[5] for batch in batches]),)
+
+
+class StackedBatchSampler(Sampler):
+    '''
+        Yields num_models x batch_size index tensors for a StackedSampleDataset, row k drawn from a permutation of
+        the num_samples[k] samples of model k. An epoch has as many batches as the largest dataset needs and every
+        batch is full: a dataset that runs out continues with a new permutation
+    '''
+    def __init__(self, num_samples, batch_size, shuffle=True):
+        self.num_samples = list(num_samples)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (max(self.num_samples) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        length = len(self) * self.batch_size
+        order = []
+        for n in self.num_samples:
+            passes = [torch.randperm(n) if self.shuffle else torch.arange(n) for _ in range((length + n - 1) // n)]
+            order.append(torch.cat(passes)[:length])
+        order = torch.stack(order)
+        for i in range(len(self)):
+            yield order[:, i * self.batch_size:(i + 1) * self.batch_size]
+
+
+def stacked_sample_loader(trajectory_datasets, batch_size=1000, shuffle=True, num_workers=0, pin_memory=False):
+    '''
+        sample_loader for an Ensemble whose models train on different data, one TrajectoryDataset per model.
+        Batches are num_models x batch_size x ...
+    '''
+    samples = StackedSampleDataset(trajectory_datasets)
+    sampler = StackedBatchSampler([len(member) for member in samples.members], batch_size, shuffle)
+    return DataLoader(samples, batch_size=None, sampler=sampler, num_workers=num_workers, pin_memory=pin_memory)
+
+
+def bucketed_trajectory_loader(trajectory_dataset, batch_size=4, shuffle=True, num_workers=0, pin_memory=False):
+    '''
+        DataLoader over batches of batch_size whole trajectories of similar length, concatenated along the sample axis
+    '''
+    sampler = LengthBucketSampler(trajectory_dataset.lengths(), batch_size, shuffle)
+    return DataLoader(trajectory_dataset, batch_size=None, sampler=sampler,
+                      num_workers=num_workers, pin_memory=pin_memory)
@@ -0,0 +1,46 @@
+'''
+
+    Export of a trained DeLaN_Network as a TorchScript function tau = f(q, q_dot, q_ddot) for one sample,
+    e.g. as the feed-forward torque of a control loop. The trace bakes the configuration branches (vectorized,
+    actuation) into the graph and freezing inlines the weights, so a call runs no Python
+
+    usage: python delan_export.py model.pt cartpole_delan.ts
+
+'''
+import sys
+import torch
+from torch import nn
+
+
+class SingleSampleInverseDynamics(nn.Module):
+    ''' wraps a DeLaN_Network to take q, q_dot, q_ddot (d each) and return tau (d) '''
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, q, q_dot, q_ddot):
+        x = torch.cat((q, q_dot, q_ddot)).view(1, -1)
+        return self.model(x)[0].view(-1)
+
+
+def export_inverse_dynamics(model, path=None):
+    '''
+        traced and frozen single-sample inverse dynamics of model (a DeLaN_Network, on the CPU), saved to path
+        if given. Load it with torch.jit.load and call it as f(q, q_dot, q_ddot)
+    '''
+    model = model.cpu().eval()
+    d = model.input_dim
+    example = (torch.zeros(d), torch.zeros(d), torch.zeros(d))
+    with torch.no_grad():
+        traced = torch.jit.trace(SingleSampleInverseDynamics(model).eval(), example)
+    exported = torch.jit.freeze(traced)
+    if path is not None:
+        torch.jit.save(exported, path)
+    return exported
+
+
+if __name__ == '__main__':
+    # model.pt is a whole DeLaN model saved with torch.save(model, 'model.pt')
+    model = torch.load(sys.argv[1], weights_only=False)
+    export_inverse_dynamics(model, sys.argv[2])
+    print("Wrote", sys.argv[2])
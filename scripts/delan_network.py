@@ -0,0 +1,208 @@
+'''
+
+    Deep Lagrangian Network (Lutter et al. ICLR 2019) for any number of degrees of freedom.
+    The robot specific networks (cartpole, reacher) are configurations of DeLaN_Network
+
+'''
+from contextlib import nullcontext
+import torch
+from torch import nn
+import torch.nn.functional as F
+from lagrangian_layers import assemble_lower_triangular, lagrangian_terms, lagrangian_terms_loop, leaky_relu_slope, row_scaled_jacobian, tril_flat_indices
+
+# quantities forward can compute, see DeLaN_Network.forward
+MODES = ('inverse_dynamics', 'gravity', 'mass_matrix', 'energy')
+
+# activation functions and their derivatives w.r.t. the pre-activation
+ACTIVATIONS = {
+    'leaky_relu': (F.leaky_relu, lambda a: leaky_relu_slope(a, 0.01)),
+    'relu': (F.relu, lambda a: (a > 0).type_as(a)),
+    'softplus': (F.softplus, torch.sigmoid),
+    'tanh': (torch.tanh, lambda a: 1.0 - torch.tanh(a) ** 2),
+}
+
+
+def full_precision(x):
+    ''' turns autocast off on the device of x (if it is on), for the parts that need float32 '''
+    if torch.is_autocast_enabled(x.device.type):
+        return torch.autocast(device_type=x.device.type, enabled=False)
+    return nullcontext()
+
+
+class DeLaN_Network(nn.Module):
+    def __init__(self, input_dim, num_layers=2, hidden_dim=64, activation='leaky_relu', actuation=None,
+                 device=None, vectorized=True):
+        '''
+            input_dim is the number of degrees of freedom d, the network takes [q, q_dot, q_ddot] (n x 3d).
+            actuation selects which torques are controlled: None for fully actuated, a length d vector of 0/1
+            or a d x d selection matrix. Uncontrolled torques are set to zero
+        '''
+        super().__init__()
+        self.device = device
+        self.vectorized = vectorized # build L with a tril scatter instead of the per-column loop
+        self.input_dim = input_dim
+        num_off_diagonals = input_dim * (input_dim - 1) // 2
+
+        if activation not in ACTIVATIONS:
+            raise ValueError("Unknown activation '{}', choose from {}".format(activation, list(ACTIVATIONS)))
+        self.act_fn, self.act_deriv = ACTIVATIONS[activation]
+
+        # joint angle input layer and hidden layers
+        dims = [input_dim] + [hidden_dim] * num_layers
+        self.layers = nn.ModuleList([nn.Linear(dims[i], dims[i + 1]) for i in range(num_layers)])
+
+        # gravity layer
+        self.fc_g = nn.Linear(hidden_dim, input_dim)
+
+        # ld layer
+        self.fc_ld = nn.Linear(hidden_dim, input_dim)
+
+        # lo layer
+        self.fc_lo = nn.Linear(hidden_dim, num_off_diagonals)
+
+        # flat indices of the diagonal and off-diagonal entries of L
+        self.register_buffer('tril_idx', tril_flat_indices(input_dim), persistent=False)
+
+        # a diagonal selection matrix is applied as a mask, anything else as a matrix
+        actuation_mask = None
+        actuation_matrix = None
+        if actuation is not None:
+            actuation = torch.as_tensor(actuation, dtype=torch.float32)
+            if actuation.dim() == 2 and torch.equal(actuation, torch.diag(torch.diagonal(actuation))):
+                actuation = torch.diagonal(actuation)
+            if actuation.dim() == 1:
+                actuation_mask = actuation.clone()
+            else:
+                actuation_matrix = actuation.clone()
+        self.register_buffer('actuation_mask', actuation_mask, persistent=False)
+        self.register_buffer('actuation_matrix', actuation_matrix, persistent=False)
+
+    def hidden(self, q, jacobian=True):
+        '''
+            output of the hidden layers (n x hidden_dim) and, if jacobian is set, its Jacobian w.r.t. q
+            (n x hidden_dim x d, otherwise None). The Jacobian is only needed for the Coriolis terms. Under autocast
+            the layers only run in low precision without the Jacobian: it is built from the activation slopes, and
+            bfloat16 pre-activations flip the slope of the units near zero, which puts ~5 % errors into dh/dq and c
+        '''
+        with full_precision(q) if jacobian else nullcontext():
+            h = q.to(torch.promote_types(q.dtype, torch.float32)) if jacobian else q
+            dh_dq = None
+            for layer in self.layers:
+                a = layer(h)
+                h = self.act_fn(a)
+                if jacobian:
+                    # scale the rows by the activation slopes
+                    dh_dq = row_scaled_jacobian(self.act_deriv(a), layer.weight, dh_dq)
+        return h, dh_dq
+
+    def lagrangian(self, q, q_dot):
+        '''
+            L (n x d x d), H = L L^T (n x d x d), c (n x d x 1) and g (n x d) at the joint positions and velocities.
+            Everything is computed in (at least) float32, also under autocast, since c needs the Jacobians of the
+            hidden layers (see hidden). gravity, mass_matrix and kinetic_energy run the hidden layers in low precision
+        '''
+        h, dh_dq = self.hidden(q)
+
+        with full_precision(q):
+            dtype = torch.promote_types(q.dtype, torch.float32)
+            h, dh_dq, q_dot = h.to(dtype), dh_dq.to(dtype), q_dot.to(dtype)
+
+            # Gravity torque
+            g = self.fc_g(h)
+
+            # ld is vector of diagonal L terms, lo is vector of off-diagonal L terms
+            h_ld = self.fc_ld(h)
+            ld = F.softplus(h_ld)
+            lo = self.fc_lo(h)
+
+            dld_dq = row_scaled_jacobian(torch.sigmoid(h_ld), self.fc_ld.weight, dh_dq) # derivative of softplus
+            dlo_dq = torch.einsum('oi,nid->nod', self.fc_lo.weight, dh_dq)
+
+            if self.vectorized:
+                H, c, L = lagrangian_terms(ld, lo, dld_dq, dlo_dq, q_dot, self.tril_idx, return_factor=True)
+            else:
+                H, c = lagrangian_terms_loop(ld, lo, dld_dq, dlo_dq, q_dot)
+                L = assemble_lower_triangular(ld, lo, self.tril_idx)
+        return L, H, c, g
+
+    def gravity(self, q):
+        ''' g(q) (n x d) alone, e.g. for gravity compensation: one pass through the hidden layers and fc_g '''
+        h, _ = self.hidden(q, jacobian=False)
+        with full_precision(q):
+            return self.fc_g(h.to(torch.promote_types(q.dtype, torch.float32)))
+
+    def cholesky_factor(self, q):
+        ''' L(q) (n x d x d) without the Jacobians, the Coriolis terms or g '''
+        h, _ = self.hidden(q, jacobian=False)
+        with full_precision(q):
+            h = h.to(torch.promote_types(q.dtype, torch.float32))
+            return assemble_lower_triangular(F.softplus(self.fc_ld(h)), self.fc_lo(h), self.tril_idx)
+
+    def mass_matrix(self, q):
+        ''' H(q) = L L^T (n x d x d) alone, e.g. for impedance control '''
+        L = self.cholesky_factor(q)
+        with full_precision(q):
+            eye = torch.eye(self.input_dim, device=L.device, dtype=L.dtype)
+            return L @ L.transpose(1, 2) + 1e-9 * eye
+
+    def kinetic_energy(self, q, q_dot):
+        ''' T = 1/2 q_dot^T H q_dot = 1/2 |L^T q_dot|^2 (n), from L alone '''
+        L = self.cholesky_factor(q)
+        with full_precision(q):
+            Lt_qdot = torch.einsum('nrc,nr->nc', L, q_dot.to(L.dtype))
+            return 0.5 * (Lt_qdot ** 2).sum(dim=1)
+
+    def actuate(self, tau):
+        ''' sets uncontrolled torques to zero '''
+        if self.actuation_mask is not None:
+            return tau * self.actuation_mask
+        elif self.actuation_matrix is not None:
+            return tau @ self.actuation_matrix.t()
+        return tau
+
+    def forward(self, x, mode='inverse_dynamics'):
+        '''
+            x holds [q, q_dot, q_ddot] (n x 3d). mode selects what is computed, only the parts of the network it
+            needs are evaluated (and only the columns of x it needs are read):
+              'inverse_dynamics'  (tau, H q_ddot, c, g), each n x d
+              'gravity'           g(q) (n x d), x can be just q
+              'mass_matrix'       H(q) (n x d x d), x can be just q
+              'energy'            kinetic energy 1/2 q_dot^T H q_dot (n), x can be [q, q_dot]
+        '''
+        d = self.input_dim
+        n = x.shape[0]
+        if mode == 'gravity':
+            return self.gravity(x[:, :d])
+        if mode == 'mass_matrix':
+            return self.mass_matrix(x[:, :d])
+        if mode == 'energy':
+            return self.kinetic_energy(x[:, :d], x[:, d:2 * d])
+        if mode != 'inverse_dynamics':
+            raise ValueError("Unknown mode '{}', choose from {}".format(mode, list(MODES)))
+        q, q_dot, q_ddot = torch.split(x, [d, d, d], dim=1)
+
+        L, H, c, g = self.lagrangian(q, q_dot)
+
+        with full_precision(x):
+            Hq_ddot = H @ q_ddot.to(H.dtype).view(n, d, 1)
+            tau = (Hq_ddot + c).view(n, d) + g
+
+            #set uncontrolled torque to zero
+            tau = self.actuate(tau)
+
+        # The loss layer will be applied outside Network class
+        return (tau, Hq_ddot.view(n, d), c.view(n, d), g)
+
+    def forward_dynamics(self, q, q_dot, tau):
+        '''
+            joint accelerations q_ddot = H^-1 (tau - c - g) (n x d) for torques tau (n x d), with two triangular
+            solves against the learned factor L (H = L L^T, up to the 1e-9 jitter). Uncontrolled torques are
+            ignored as in forward
+        '''
+        n, d = q.shape
+        L, H, c, g = self.lagrangian(q, q_dot)
+        with full_precision(q):
+            rhs = (self.actuate(tau.to(L.dtype)) - g).view(n, d, 1) - c
+            y = torch.linalg.solve_triangular(L, rhs, upper=False)
+            q_ddot = torch.linalg.solve_triangular(L.transpose(1, 2), y, upper=True)
+        return q_ddot.view(n, d)
@@ -0,0 +1,118 @@
+'''
+
+    Batched rollouts of the learned forward dynamics q_ddot = H^-1 (tau - c - g) of a DeLaN_Network, and the same
+    rollouts in the gym environments (ContinuousCartPoleEnv, DoublePendulumEnv, ReacherEnv) as ground truth
+
+'''
+import numpy as np
+import torch
+from gym_cenvs.envs.vector_continuous_cartpole import VectorContinuousCartPoleEnv
+from gym_cenvs.envs.vector_double_pendulum import VectorDoublePendulumEnv
+from gym_cenvs.envs.vector_reacher import VectorReacherEnv
+
+
+def integrate(q, q_dot, q_ddot_fn, tau, dt, method='euler'):
+    '''
+        one step of q_dot = d/dt q, q_ddot = q_ddot_fn(q, q_dot, tau). 'euler' is the explicit Euler step of the
+        environments, 'semi_implicit' updates q with the new velocity, 'rk4' holds tau over the step
+    '''
+    if method == 'euler':
+        q_ddot = q_ddot_fn(q, q_dot, tau)
+        return q + dt * q_dot, q_dot + dt * q_ddot
+    if method == 'semi_implicit':
+        q_dot = q_dot + dt * q_ddot_fn(q, q_dot, tau)
+        return q + dt * q_dot, q_dot
+    if method == 'rk4':
+        k1_q, k1_v = q_dot, q_ddot_fn(q, q_dot, tau)
+        k2_q, k2_v = q_dot + 0.5 * dt * k1_v, q_ddot_fn(q + 0.5 * dt * k1_q, q_dot + 0.5 * dt * k1_v, tau)
+        k3_q, k3_v = q_dot + 0.5 * dt * k2_v, q_ddot_fn(q + 0.5 * dt * k2_q, q_dot + 0.5 * dt * k2_v, tau)
+        k4_q, k4_v = q_dot + dt * k3_v, q_ddot_fn(q + dt * k3_q, q_dot + dt * k3_v, tau)
+        return (q + dt / 6 * (k1_q + 2 * k2_q + 2 * k3_q + k4_q),
+                q_dot + dt / 6 * (k1_v + 2 * k2_v + 2 * k3_v + k4_v))
+    raise ValueError("Unknown integration method '{}', choose from euler, semi_implicit, rk4".format(method))
+
+
+def rollout(model, q0, q_dot0, torques, dt, method='euler', num_steps=None):
+    '''
+        rolls out n trajectories in parallel from q0, q_dot0 (n x d). torques is either a tensor (n x T x d) applied
+        open loop or a function tau = torques(t, q, q_dot) for closed loop control over num_steps = T steps.
+        Returns q and q_dot (n x T+1 x d) including the initial state
+    '''
+    if callable(torques):
+        policy = torques
+    else:
+        policy, num_steps = (lambda t, q, q_dot: torques[:, t]), torques.shape[1]
+
+    q, q_dot = q0, q_dot0
+    qs, q_dots = [q], [q_dot]
+    with torch.no_grad():
+        for t in range(num_steps):
+            q, q_dot = integrate(q, q_dot, model.forward_dynamics, policy(t, q, q_dot), dt, method)
+            qs.append(q)
+            q_dots.append(q_dot)
+    return torch.stack(qs, dim=1), torch.stack(q_dots, dim=1)
+
+
+def env_q_ddot_fn(env):
+    '''
+        q_ddot(q, q_dot, tau) of a vectorized environment in the coordinates the datasets use: cartpole q = [x, theta]
+        with tau = [force, 0], double pendulum / reacher q = [theta1, theta2]
+    '''
+    if isinstance(env, VectorContinuousCartPoleEnv):
+        def q_ddot(q, q_dot, tau):
+            # the velocity update of one Euler step is exactly the acceleration
+            env.state = np.stack((q[:, 0], q_dot[:, 0], q[:, 1], q_dot[:, 1]), axis=1)
+            z = env.stepPhysics(tau[:, 0])
+            return (z[:, [1, 3]] - env.state[:, [1, 3]]) / env.tau
+    else:
+        def q_ddot(q, q_dot, tau):
+            # the dynamics of the environments measure theta1 from the other end of the link, see their step()
+            s = np.concatenate((q + np.array([np.pi, 0.0]), q_dot), axis=1)
+            return env._dsdt(s, tau[:, :env.action_dim])[:, 2:]
+    return q_ddot
+
+
+def env_rollout(env, q0, q_dot0, torques, method='euler'):
+    '''
+        ground truth rollout of the same form as rollout in a vectorized environment with num_envs = n, without the
+        angle wrapping and velocity limits of its step(). numpy arrays in and out, dt is that of the environment
+    '''
+    dt = env.tau if isinstance(env, VectorContinuousCartPoleEnv) else env.dt
+    q_ddot = env_q_ddot_fn(env)
+    q, q_dot = np.asarray(q0, dtype=np.float64), np.asarray(q_dot0, dtype=np.float64)
+    qs, q_dots = [q], [q_dot]
+    for t in range(torques.shape[1]):
+        q, q_dot = integrate(q, q_dot, q_ddot, torques[:, t], dt, method)
+        qs.append(q)
+        q_dots.append(q_dot)
+    return np.stack(qs, axis=1), np.stack(q_dots, axis=1)
+
+
+def make_env(name, num_envs):
+    ''' vectorized environment by name (cartpole with the parameters of the cartpole datasets) '''
+    if name == 'cartpole':
+        env = VectorContinuousCartPoleEnv(num_envs)
+        env.set_params(pole_mass=1.0, pole_length=2.0, cart_mass=10.0)
+        env.gravity = 9.81
+        env.tau = 1.0 / 200
+        return env
+    if name == 'double_pendulum':
+        return VectorDoublePendulumEnv(num_envs)
+    if name == 'reacher':
+        return VectorReacherEnv(num_envs)
+    raise ValueError("Unknown environment '{}'".format(name))
+
+
+def compare_rollouts(model, env, q0, q_dot0, torques, method='euler'):
+    '''
+        rolls out model and env from the same states under the same open loop torques (numpy, n x T x d).
+        Returns the RMS error of q and q_dot at every time step (T+1), averaged over the trajectories
+    '''
+    dt = env.tau if isinstance(env, VectorContinuousCartPoleEnv) else env.dt
+    q_true, q_dot_true = env_rollout(env, q0, q_dot0, torques, method)
+    device = next(model.parameters()).device
+    as_tensor = lambda a: torch.as_tensor(a, dtype=torch.float32, device=device)
+    q_pred, q_dot_pred = rollout(model, as_tensor(q0), as_tensor(q_dot0), as_tensor(torques), dt, method)
+    q_err = np.sqrt(((q_pred.cpu().numpy() - q_true) ** 2).mean(axis=(0, 2)))
+    q_dot_err = np.sqrt(((q_dot_pred.cpu().numpy() - q_dot_true) ** 2).mean(axis=(0, 2)))
+    return q_err, q_dot_err
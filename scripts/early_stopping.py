@@ -0,0 +1,65 @@
+'''
+
+    Validation driven training: the loss on held-out trajectories (see validation_trajectories / validation_chars in
+    trajectory_selection.py) after every epoch, stopping once it has not improved for a number of epochs, and
+    restoring the weights of the best epoch at the end
+
+'''
+import torch
+
+
+def validation_loss(model, criterion, loader, device):
+    ''' mean criterion over the batches of loader, for models returning tau or a tuple starting with tau '''
+    was_training = model.training
+    model.eval()
+    total = torch.zeros((), device=device)
+    num_batches = 0
+    with torch.no_grad():
+        for state, tau, *_ in loader:
+            pred = model(state.to(device))
+            pred_tau = pred[0] if isinstance(pred, tuple) else pred
+            total += criterion(pred_tau, tau.to(device))
+            num_batches += 1
+    model.train(was_training)
+    return total.item() / max(num_batches, 1)
+
+
+class EarlyStopping:
+    def __init__(self, patience=20, min_delta=0.0):
+        '''
+            stops after patience epochs without the validation loss improving by more than the fraction min_delta
+            of the best loss so far (relative, like the threshold of ReduceLROnPlateau)
+        '''
+        self.patience = patience
+        self.min_delta = min_delta
+        self.best_loss = float('inf')
+        self.best_epoch = 0
+        self.best_state = None
+        self.num_bad_epochs = 0
+
+    def step(self, epoch, loss, model):
+        ''' call after every epoch (counting from 1), keeps a copy of the best weights. Returns True to stop '''
+        if loss < self.best_loss * (1.0 - self.min_delta):
+            self.best_loss = loss
+            self.best_epoch = epoch
+            self.best_state = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+            self.num_bad_epochs = 0
+        else:
+            self.num_bad_epochs += 1
+        return self.num_bad_epochs > self.patience
+
+    def restore(self, model):
+        ''' loads the weights of the best epoch into model '''
+        if self.best_state is not None:
+            model.load_state_dict(self.best_state)
+            print("Restored the model of epoch {} (validation loss {})".format(self.best_epoch, self.best_loss))
+
+    def state_dict(self):
+        return {'best_loss': self.best_loss, 'best_epoch': self.best_epoch, 'best_state': self.best_state,
+                'num_bad_epochs': self.num_bad_epochs}
+
+    def load_state_dict(self, state):
+        self.best_loss = state['best_loss']
+        self.best_epoch = state['best_epoch']
+        self.best_state = state['best_state']
+        self.num_bad_epochs = state['num_bad_epochs']
@@ -0,0 +1,139 @@
+'''
+
+    Energy and power consistency of a trained DeLaN_Network over whole test sets, computed in batches of
+    trajectories without plotting. For every sample:
+
+      kinetic_energy          T = 1/2 q_dot^T H q_dot with the learned H (true_kinetic_energy with the simulated H)
+      potential_energy        V, the work of the learned g along the trajectory, V(t) = int g . dq from its first
+                              sample (true_potential_energy with the simulated g). The network learns g = dV/dq and
+                              not V itself, so V is only defined up to a constant per trajectory
+      power_residual          q_dot^T (H q_ddot + c + g) - q_dot^T tau: the rate of change of the learned energy
+                              T + V minus the power put in by the simulated torques. q_dot^T c = 1/2 q_dot^T H_dot q_dot,
+                              so this is d(T + V)/dt - q_dot^T tau without differentiating in time. Uses all joints,
+                              also the unactuated ones that the masked tau of forward leaves out
+      energy_residual         T(t) - T(0) + V(t) - int tau . dq, the accumulated violation of the energy balance
+                              (true_energy_residual with the simulated H and g, the error of the integration alone:
+                              torques that switch between samples make it far from 0 on fast trajectories)
+
+    The integrals use the trapezoidal rule over the joint positions, so no time step is needed. Computing everything
+    takes one pass of the network, as evaluate does, so it is cheap enough to run after every epoch
+
+    usage: arrays, summary = energy_diagnostics(model, TRAJ_test, device)
+           print_summary(summary)
+
+'''
+import numpy as np
+import torch
+
+ARRAYS = ['kinetic_energy', 'true_kinetic_energy', 'potential_energy', 'true_potential_energy', 'power',
+          'power_residual', 'energy_residual', 'true_energy_residual']
+# per label statistics of the differences to the simulated values
+SUMMARY = {'kinetic_energy_error': lambda a: a['kinetic_energy'] - a['true_kinetic_energy'],
+           'potential_energy_error': lambda a: a['potential_energy'] - a['true_potential_energy'],
+           'power_residual': lambda a: a['power_residual'],
+           'energy_residual': lambda a: a['energy_residual'],
+           'true_energy_residual': lambda a: a['true_energy_residual']}
+
+
+def path_integral(f, q, starts):
+    '''
+        int f . dq along every trajectory of the concatenated samples f, q (n x d) with the trapezoidal rule, 0 at
+        the first sample of each trajectory. starts marks those first samples (n, bool)
+    '''
+    increments = torch.zeros(len(q), dtype=torch.float64, device=q.device)
+    increments[1:] = (0.5 * (f[1:] + f[:-1]) * (q[1:] - q[:-1])).sum(dim=1).double()
+    increments[starts] = 0.0
+    total = torch.cumsum(increments, dim=0)
+    # subtract the running total at the start of each trajectory
+    trajectory = torch.cumsum(starts.long(), dim=0) - 1
+    return (total - total[starts][trajectory]).float()
+
+
+def batch_diagnostics(model, state, tau, g, H, starts):
+    ''' ARRAYS (each n) for a batch of concatenated trajectories, see the module docstring '''
+    d = model.input_dim
+    q, q_dot, q_ddot = torch.split(state, [d, d, d], dim=1)
+    n = len(state)
+
+    _, pred_H, pred_c, pred_g = model.lagrangian(q, q_dot)
+    pred_tau = (pred_H @ q_ddot.view(n, d, 1) + pred_c).view(n, d) + pred_g
+
+    kinetic_energy = 0.5 * (q_dot.unsqueeze(1) @ pred_H @ q_dot.unsqueeze(2)).view(n)
+    true_kinetic_energy = 0.5 * (q_dot.unsqueeze(1) @ H @ q_dot.unsqueeze(2)).view(n)
+    power = (q_dot * tau).sum(dim=1)
+    work = path_integral(tau, q, starts)
+    potential_energy = path_integral(pred_g, q, starts)
+    true_potential_energy = path_integral(g, q, starts)
+
+    # kinetic energies at the first sample of each trajectory, for every sample
+    trajectory = torch.cumsum(starts.long(), dim=0) - 1
+    initial_kinetic_energy = kinetic_energy[starts][trajectory]
+    true_initial_kinetic_energy = true_kinetic_energy[starts][trajectory]
+
+    return {'kinetic_energy': kinetic_energy,
+            'true_kinetic_energy': true_kinetic_energy,
+            'potential_energy': potential_energy,
+            'true_potential_energy': true_potential_energy,
+            'power': power,
+            'power_residual': (q_dot * pred_tau).sum(dim=1) - power,
+            'energy_residual': kinetic_energy - initial_kinetic_energy + potential_energy - work,
+            'true_energy_residual': true_kinetic_energy - true_initial_kinetic_energy + true_potential_energy - work}
+
+
+def energy_diagnostics(model, dataset, device, batch_size=32):
+    '''
+        ARRAYS over all samples of dataset (a TrajectoryDataset) as numpy arrays in dataset order, together with
+        'labels' (n) and 'offsets' (the first sample of every trajectory, and the total number of samples).
+        batch_size trajectories are evaluated at once. Returns the arrays and summarize(arrays)
+    '''
+    was_training = model.training
+    model.eval()
+    lengths = dataset.lengths()
+    results = {name: [] for name in ARRAYS}
+    labels = []
+    with torch.no_grad():
+        for first in range(0, len(dataset), batch_size):
+            idxs = list(range(first, min(first + batch_size, len(dataset))))
+            state, tau, g, c, H, label = dataset[idxs]
+            starts = torch.zeros(len(state), dtype=torch.bool)
+            starts[np.cumsum([0] + [lengths[i] for i in idxs[:-1]])] = True
+
+            batch = batch_diagnostics(model, state.to(device), tau.to(device), g.to(device), H.to(device),
+                                      starts.to(device))
+            for name in ARRAYS:
+                results[name].append(batch[name].cpu())
+            labels.append(label)
+    model.train(was_training)
+
+    arrays = {name: torch.cat(values).numpy() for name, values in results.items()}
+    arrays['labels'] = np.concatenate(labels)
+    arrays['offsets'] = np.concatenate(([0], np.cumsum(lengths)))
+    return arrays, summarize(arrays)
+
+
+def summarize(arrays):
+    '''
+        mean, rms and largest absolute value of every SUMMARY quantity, per label:
+        {label: {'num_samples': n, 'num_trajectories': m, name: {'mean': .., 'rms': .., 'max_abs': ..}}}
+    '''
+    labels = arrays['labels']
+    first_labels = labels[arrays['offsets'][:-1]]
+    quantities = {name: fn(arrays).astype(np.float64) for name, fn in SUMMARY.items()}
+    summary = {}
+    for label in np.unique(labels):
+        mask = labels == label
+        summary[label.item()] = stats = {'num_samples': int(mask.sum()),
+                                         'num_trajectories': int((first_labels == label).sum())}
+        for name, values in quantities.items():
+            values = values[mask]
+            stats[name] = {'mean': values.mean(), 'rms': np.sqrt((values ** 2).mean()), 'max_abs': np.abs(values).max()}
+    return summary
+
+
+def print_summary(summary):
+    print("{:>6} {:>8} {:>24} {:>11} {:>11} {:>11}".format('label', 'samples', 'quantity', 'mean', 'rms', 'max |.|'))
+    for label, stats in summary.items():
+        for name in SUMMARY:
+            print("{:>6} {:>8} {:>24} {:>11.4g} {:>11.4g} {:>11.4g}".format(label, stats['num_samples'], name,
+                                                                            stats[name]['mean'], stats[name]['rms'],
+                                                                            stats[name]['max_abs']))
@@ -0,0 +1,229 @@
+'''
+
+    Trains K independent copies of a network (DeLaN or FF) together. The parameters of the K models are stacked
+    along a leading dimension and the forward pass is vmapped over it, so one batched matmul replaces K small ones.
+    The models can train on the same data (ensemble_sample_loader) or each on its own (stacked_sample_loader, e.g.
+    the splits of the seeds of a sweep), with a validation set per model, PlateauScheduler and
+    EnsembleEarlyStopping giving every model its own learning rate schedule and early stopping
+
+'''
+import copy
+import numpy as np
+import torch
+from torch import nn
+from torch.func import functional_call, stack_module_state, vmap
+from tqdm import tqdm
+from training_metrics import TrainingMonitor
+from early_stopping import EarlyStopping, validation_loss
+
+
+class Ensemble(nn.Module):
+    def __init__(self, models):
+        '''
+            models is a list of K networks of the same architecture, e.g. [CartPole_DeLaN_Network() for _ in range(K)].
+            Their parameters are copied into stacked (K x ...) parameters, buffers are shared
+        '''
+        super().__init__()
+        self.num_models = len(models)
+        # template module for functional_call, not registered so its tensors are not part of the ensemble
+        self._template = [copy.deepcopy(models[0])]
+
+        params, _ = stack_module_state(models)
+        self.param_names = {}
+        for name, value in params.items():
+            self.param_names[name] = name.replace('.', '_')
+            self.register_parameter(self.param_names[name], nn.Parameter(value.detach().clone()))
+        self.buffer_names = {}
+        for name, value in models[0].named_buffers():
+            self.buffer_names[name] = 'buffer_' + name.replace('.', '_')
+            self.register_buffer(self.buffer_names[name], value.clone(), persistent=False)
+
+    def stacked_parameters(self):
+        return {name: getattr(self, p) for name, p in self.param_names.items()}
+
+    def forward(self, x):
+        '''
+            x is either one batch (n x input) given to every model or one batch per model (K x n x input).
+            Returns the output of the models stacked along the first dimension (tuples element-wise)
+        '''
+        buffers = {name: getattr(self, b) for name, b in self.buffer_names.items()}
+        template = self._template[0]
+
+        def call(params, x):
+            return functional_call(template, (params, buffers), (x,))
+
+        return vmap(call, in_dims=(0, 0 if x.dim() == 3 else None))(self.stacked_parameters(), x)
+
+    def member(self, k):
+        ''' standalone copy of model k, e.g. for the evaluate functions of the network scripts '''
+        model = copy.deepcopy(self._template[0])
+        state = {name: value[k].detach().clone() for name, value in self.stacked_parameters().items()}
+        model.load_state_dict(state, strict=False)
+        return model.to(next(self.parameters()).device)
+
+    def load_member_state(self, k, state):
+        ''' copies the state dict of a standalone model (e.g. saved by EarlyStopping) into model k '''
+        with torch.no_grad():
+            for name, value in self.stacked_parameters().items():
+                value[k].copy_(state[name])
+
+
+class PlateauScheduler:
+    def __init__(self, num_models, factor=0.1, patience=10, threshold=1e-4):
+        '''
+            ReduceLROnPlateau (mode 'min', relative threshold, no cooldown) for every model of an ensemble on its
+            own validation loss. The optimizer keeps one learning rate, train scales the updates of model k by
+            scales[k]
+        '''
+        self.factor = factor
+        self.patience = patience
+        self.threshold = threshold
+        self.scales = np.ones(num_models)
+        self.best = np.full(num_models, np.inf)
+        self.num_bad_epochs = np.zeros(num_models, dtype=int)
+
+    def step(self, losses):
+        improved = losses < self.best * (1.0 - self.threshold)
+        self.best = np.where(improved, losses, self.best)
+        self.num_bad_epochs = np.where(improved, 0, self.num_bad_epochs + 1)
+        reduce = self.num_bad_epochs > self.patience
+        self.scales[reduce] *= self.factor
+        self.num_bad_epochs[reduce] = 0
+
+    def state_dict(self):
+        return {'scales': self.scales.copy(), 'best': self.best.copy(), 'num_bad_epochs': self.num_bad_epochs.copy()}
+
+    def load_state_dict(self, state):
+        self.scales, self.best, self.num_bad_epochs = state['scales'], state['best'], state['num_bad_epochs']
+
+
+class EnsembleEarlyStopping:
+    def __init__(self, num_models, patience=20, min_delta=0.0):
+        '''
+            an EarlyStopping for every model of an ensemble. A model that stops is frozen (train scales its updates
+            to 0) while the others continue, training ends once all of them have stopped
+        '''
+        self.patience = patience
+        self.models = [EarlyStopping(patience, min_delta) for _ in range(num_models)]
+        self.stopped = np.zeros(num_models, dtype=bool)
+
+    def step(self, epoch, losses, ensemble):
+        ''' call after every epoch (counting from 1) with the validation loss of every model. Returns True to stop '''
+        for k, early_stopping in enumerate(self.models):
+            if not self.stopped[k]:
+                self.stopped[k] = early_stopping.step(epoch, losses[k], ensemble.member(k))
+        return bool(self.stopped.all())
+
+    def restore(self, ensemble):
+        ''' loads the weights of the best epoch of every model into the ensemble '''
+        for k, early_stopping in enumerate(self.models):
+            if early_stopping.best_state is not None:
+                ensemble.load_member_state(k, early_stopping.best_state)
+        print("Restored the models of epochs {}".format([early_stopping.best_epoch for early_stopping in self.models]))
+
+    def state_dict(self):
+        return {'models': [early_stopping.state_dict() for early_stopping in self.models], 'stopped': self.stopped.copy()}
+
+    def load_state_dict(self, state):
+        for early_stopping, model_state in zip(self.models, state['models']):
+            early_stopping.load_state_dict(model_state)
+        self.stopped = state['stopped']
+
+
+def validation_losses(ensemble, criterion, valloader, device):
+    ''' validation_loss of every model (K), valloader is one loader for all models or a list of one per model '''
+    loaders = valloader if isinstance(valloader, (list, tuple)) else [valloader] * ensemble.num_models
+    return np.array([validation_loss(ensemble.member(k), criterion, loader, device) for k, loader in enumerate(loaders)])
+
+
+def update_scales(ensemble, scheduler, early_stopping):
+    ''' factor (K) on the optimizer step of every model from its PlateauScheduler and early stopping, None if all 1 '''
+    scales = scheduler.scales.copy() if isinstance(scheduler, PlateauScheduler) else np.ones(ensemble.num_models)
+    if early_stopping is not None:
+        scales[early_stopping.stopped] = 0.0
+    if np.all(scales == 1.0):
+        return None
+    return scales
+
+
+def clip_grad_norm_per_model(ensemble, max_norm):
+    ''' clip_grad_norm applied to each model of the ensemble on its own, returns the K gradient norms '''
+    grads = [p.grad for p in ensemble.parameters() if p.grad is not None]
+    norms = torch.stack([g.pow(2).flatten(1).sum(1) for g in grads]).sum(0).sqrt()
+    scale = (max_norm / (norms + 1e-6)).clamp(max=1.0)
+    for g in grads:
+        g.mul_(scale.view(-1, *([1] * (g.dim() - 1))))
+    return norms
+
+
+def train(ensemble, criterion, loader, device, optimizer, scheduler, num_epoch=10, checkpoint=None, monitor=None, mixed_precision=False,
+          valloader=None, early_stopping=None):
+    '''
+        trains all models of the ensemble at once. criterion (mean reduced) is applied to every model and summed,
+        so the gradient of each model only depends on its own loss. With an element-wise optimizer (Adam, SGD)
+        on the stacked parameters every model keeps its own optimizer state.
+        loader yields batches for all models (n x ...) or one per model (K x n x ..., see ensemble_sample_loader
+        and stacked_sample_loader). valloader (one loader or one per model) gives the validation losses that a
+        PlateauScheduler and an EnsembleEarlyStopping are stepped with.
+        monitor (TrainingMonitor) records the mean loss over the models, mixed_precision trains under bfloat16 autocast
+    '''
+    print("Start training...")
+    if valloader is None and (early_stopping is not None or isinstance(scheduler, PlateauScheduler)):
+        raise ValueError("Early stopping and PlateauScheduler need a valloader")
+    monitor = TrainingMonitor(device=device) if monitor is None else monitor
+    autocast_device = torch.device(device).type
+    ensemble.train()
+    K = ensemble.num_models
+    start_epoch = checkpoint.load(ensemble, optimizer, scheduler, early_stopping) if checkpoint is not None else 0 # resume
+    for i in range(start_epoch, num_epoch):
+        scales = update_scales(ensemble, scheduler, early_stopping)
+        for state, tau, _, _, _, _ in monitor.batches(tqdm(loader)):
+            with monitor.phase('data'):
+                state = state.to(device)
+                tau = tau.to(device)
+            with monitor.phase('forward'), torch.autocast(autocast_device, torch.bfloat16, enabled=mixed_precision):
+                pred = ensemble(state)
+                pred_tau = pred[0] if isinstance(pred, tuple) else pred
+                loss = criterion(pred_tau, tau.expand_as(pred_tau)) * K # sum of the per-model mean losses
+            with monitor.phase('backward'):
+                loss.backward()
+            with monitor.phase('optimizer'):
+                clip_grad_norm_per_model(ensemble, 10.0)
+                if scales is not None:
+                    previous = [p.detach().clone() for p in ensemble.parameters()]
+                optimizer.step()
+                optimizer.zero_grad()
+                if scales is not None:
+                    # the learning rate of every model: scale its step (0 for the models that stopped)
+                    with torch.no_grad():
+                        for p, before in zip(ensemble.parameters(), previous):
+                            weight = torch.as_tensor(scales, dtype=p.dtype, device=p.device)
+                            p.copy_(torch.lerp(before, p, weight.view(-1, *([1] * (p.dim() - 1)))))
+            monitor.step(state.shape[-2] * K, loss.detach() / K) # samples seen by all models together
+
+        val_losses = validation_losses(ensemble, criterion, valloader, device) if valloader is not None else None
+        if isinstance(scheduler, PlateauScheduler):
+            scheduler.step(val_losses)
+        else:
+            scheduler.step()
+        val_loss = float(val_losses.mean()) if val_losses is not None else None
+        loss = monitor.epoch(i+1, validation_loss=val_loss)
+        print("Epoch {} mean loss over models:{}".format(i+1, loss) + ("" if val_loss is None else " mean validation loss:{}".format(val_loss)))
+        stop = early_stopping is not None and early_stopping.step(i+1, val_losses, ensemble)
+        if checkpoint is not None:
+            checkpoint.step(i+1, ensemble, optimizer, scheduler, num_epoch, early_stopping)
+        if stop:
+            print("No improvement of any model in {} epochs, stopping after epoch {}".format(early_stopping.patience, i+1))
+            break
+
+    if early_stopping is not None:
+        early_stopping.restore(ensemble) # continue with the best models
+        if checkpoint is not None:
+            checkpoint.save(num_epoch, ensemble, optimizer, scheduler, early_stopping) # saved as finished
+            checkpoint.wait()
+    print("Done!")
+
+
+def evaluate(ensemble, evaluate_fn, criterion, loader, device):
+    ''' test MSE of every model with the evaluate function of its network script, as an array of K values '''
+    return np.array([evaluate_fn(ensemble.member(k), criterion, loader, device) for k in range(ensemble.num_models)])
@@ -0,0 +1,277 @@
+'''
+
+    Generates the cartpole training trajectories (forwards, swingup, revolution, backwards) in Python, replacing
+    cartpole_traj_gen/traj_gen.m. Each family is simulated as one batch of VectorContinuousCartPoleEnv instances
+    under a batched controller with the costs of run_mpc_sim.m: saturated LQR for the translations, MPC by iterative
+    LQR for the swing-ups and revolutions. Writes a .mat with the same fields as cartpole_all_200hz.mat.
+    The translations match the MATLAB trajectories, the swing families follow the same course (one swing to the
+    upright, settling at x = 0) but differ in the details, since the MPC has a longer horizon and no state bounds.
+    --compare prints the ranges and end states of every family next to those of a reference file
+
+'''
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from scipy.io import loadmat, savemat
+from scipy.linalg import solve_discrete_are
+from gym_cenvs.envs.vector_continuous_cartpole import VectorContinuousCartPoleEnv
+
+# cartpole params (same as traj_gen.m)
+PARAMS = {'M': 10.0, 'm': 1.0, 'l': 1.0, 'g': 9.81}
+SAMPLE_RATE = 200
+SIM_LENGTH = 200 * 5
+
+# LQR / MPC costs (same as run_mpc_sim.m)
+Q = np.diag([10, 150, 0.01, 0.01])
+R = np.array([[0.005]])
+
+# prediction horizon of the swing-up MPC. run_mpc_sim.m predicts 30 steps with IPOPT under state bounds, the
+# iLQR below has no state bounds and needs 60 steps (0.3 s) to not stall with the pole near horizontal
+HORIZON = 60
+ILQR_ITERATIONS = 3 # per control step, warm started with the shifted solution of the previous step
+LINE_SEARCH = (1.0, 0.5, 0.25, 0.1, 0.03)
+
+# largest distance of the final x and theta from the goal (the MATLAB trajectories end within 0.03 of it)
+END_TOLERANCE = np.array([0.1, 0.05])
+
+GOAL_THETA = np.pi
+
+# env state [x, x_dot, theta, theta_dot] to the cost's [x, theta, x_dot, theta_dot] and back
+PERM = [0, 2, 1, 3]
+
+# label: (name, initial theta, goal x of every trajectory, control limit of every trajectory)
+FAMILIES = {
+    1: ('forwards', np.pi, np.round(np.arange(1.0, 2.01, 0.1), 1), np.full(11, 200.0)),
+    2: ('swingup', 2 * np.pi, np.zeros(14), np.arange(185.0, 251.0, 5.0)),
+    3: ('revolution', 3 * np.pi, np.zeros(14), np.arange(185.0, 251.0, 5.0)),
+    4: ('backwards', np.pi, np.round(np.arange(-2.0, -0.99, 0.1), 1), np.full(11, 200.0)),
+}
+
+
+def make_env(num_envs, params=PARAMS, sample_rate=SAMPLE_RATE):
+    ''' batch of cartpoles with the traj_gen.m parameters, theta = 0 is hanging straight down '''
+    env = VectorContinuousCartPoleEnv(num_envs)
+    env.set_params(pole_mass=params['m'], pole_length=2 * params['l'], cart_mass=params['M'])
+    env.gravity = params['g']
+    env.tau = 1.0 / sample_rate
+    env.theta_offset = np.pi
+    return env
+
+
+def step(env, z, u):
+    ''' one explicit Euler step of the environment dynamics from states z (n x 4, [x, x_dot, theta, theta_dot]) '''
+    env.state = z
+    return env.stepPhysics(u)
+
+
+def jacobians(env, z, u, eps=1e-6):
+    ''' A (n x 4 x 4) and B (n x 4) of the environment step at the states z (n x 4) and controls u (n) '''
+    A = np.stack([(step(env, z + dz, u) - step(env, z - dz, u)) / (2 * eps) for dz in eps * np.eye(4)], axis=-1)
+    B = (step(env, z, u + eps) - step(env, z, u - eps)) / (2 * eps)
+    return A, B
+
+
+def lqr(params=PARAMS, sample_rate=SAMPLE_RATE):
+    '''
+        discrete LQR gain K (cost order, 1 x 4) of the environment step linearized around the upright equilibrium,
+        and the cost to go P (env order, 4 x 4) that terminates the MPC horizon as in run_mpc_sim.m
+    '''
+    A, B = jacobians(make_env(1, params, sample_rate), np.array([[0.0, 0.0, np.pi, 0.0]]), np.zeros(1))
+    A, B = A[0][np.ix_(PERM, PERM)], B[0][PERM].reshape(4, 1)
+    P = np.asarray(solve_discrete_are(A, B, Q, R))
+    K = np.linalg.solve(R + B.T @ P @ B, B.T @ P @ A)
+    return K, P[np.ix_(PERM, PERM)]
+
+
+def lqr_controller(z, goal_x, goal_theta, u_max, K):
+    ''' batched saturated LQR around the upright goal, for the trajectories that start there '''
+    x, x_dot, theta, theta_dot = z.T
+    e = np.stack((x - goal_x, theta - goal_theta, x_dot, theta_dot), axis=1)
+    return np.clip(-(e @ K.T)[:, 0], -u_max, u_max)
+
+
+def rollout(env, z0, U):
+    ''' states (n x horizon+1 x 4) of the controls U (n x horizon) from z0 (n x 4) '''
+    Z = [z0]
+    for k in range(U.shape[1]):
+        Z.append(step(env, Z[-1], U[:, k]))
+    return np.stack(Z, axis=1)
+
+
+def trajectory_cost(Z, U, goal, P):
+    ''' stage costs of Q and R plus the terminal cost of P (run_mpc_sim.m), for every instance '''
+    E = Z - goal[:, None]
+    Q_env = Q[np.ix_(PERM, PERM)]
+    stage = np.einsum('nki,ij,nkj->n', E[:, :-1], Q_env, E[:, :-1]) + R[0, 0] * (U ** 2).sum(axis=1)
+    return stage + np.einsum('ni,ij,nj->n', E[:, -1], P, E[:, -1])
+
+
+def ilqr(env, model, z0, U, goal, u_max, P, iterations=ILQR_ITERATIONS, mu=1e-6):
+    '''
+        improves the controls U (n x horizon) of every instance towards goal (n x 4) with iterative LQR: a finite
+        horizon LQR backward pass around the rollout of U, then a line search over the step size. Controls are
+        clipped to u_max and get no feedback where they saturate. model is an env of n * horizon instances for the
+        Jacobians of all steps at once
+    '''
+    n, horizon = U.shape
+    Q_env, r = Q[np.ix_(PERM, PERM)], R[0, 0]
+    Z = rollout(env, z0, U)
+    J = trajectory_cost(Z, U, goal, P)
+    for _ in range(iterations):
+        A, B = jacobians(model, Z[:, :-1].reshape(-1, 4), U.reshape(-1))
+        A, B = A.reshape(n, horizon, 4, 4), B.reshape(n, horizon, 4)
+        E = Z - goal[:, None]
+
+        # backward pass, Vx and Vxx are the gradient and Hessian of the cost to go
+        Vx, Vxx = 2 * E[:, -1] @ P, np.broadcast_to(2 * P, (n, 4, 4))
+        k_ff, K_fb = np.zeros((n, horizon)), np.zeros((n, horizon, 4))
+        for k in reversed(range(horizon)):
+            a, b = A[:, k], B[:, k]
+            Vxx_b = np.einsum('nij,nj->ni', Vxx, b)
+            Qx = 2 * E[:, k] @ Q_env + np.einsum('nji,nj->ni', a, Vx)
+            Qu = 2 * r * U[:, k] + np.einsum('nj,nj->n', b, Vx)
+            Qxx = 2 * Q_env + np.einsum('nki,nkl,nlj->nij', a, Vxx, a)
+            Quu = 2 * r + np.einsum('ni,ni->n', b, Vxx_b) + mu
+            Qux = np.einsum('ni,nij->nj', Vxx_b, a)
+            dU, K = -Qu / Quu, -Qux / Quu[:, None]
+            saturated = np.abs(U[:, k] + dU) >= u_max
+            dU = np.where(saturated, np.clip(U[:, k] + dU, -u_max, u_max) - U[:, k], dU)
+            K = np.where(saturated[:, None], 0.0, K)
+            k_ff[:, k], K_fb[:, k] = dU, K
+            Vx = Qx + K * (Quu * dU)[:, None] + K * Qu[:, None] + Qux * dU[:, None]
+            Vxx = Qxx + Quu[:, None, None] * np.einsum('ni,nj->nij', K, K) + np.einsum('ni,nj->nij', K, Qux) \
+                + np.einsum('ni,nj->nij', Qux, K)
+            Vxx = 0.5 * (Vxx + Vxx.transpose(0, 2, 1))
+
+        # forward pass, every instance keeps its best step size (or its controls if none improves them)
+        Z_best, U_best = Z, U
+        for alpha in LINE_SEARCH:
+            z, U_new, Z_new = z0, np.zeros_like(U), [z0]
+            for k in range(horizon):
+                U_new[:, k] = np.clip(U[:, k] + alpha * k_ff[:, k] + np.einsum('ni,ni->n', K_fb[:, k], z - Z[:, k]),
+                                      -u_max, u_max)
+                z = step(env, z, U_new[:, k])
+                Z_new.append(z)
+            Z_new = np.stack(Z_new, axis=1)
+            J_new = trajectory_cost(Z_new, U_new, goal, P)
+            better = J_new < J
+            J = np.where(better, J_new, J)
+            Z_best = np.where(better[:, None, None], Z_new, Z_best)
+            U_best = np.where(better[:, None], U_new, U_best)
+        Z, U = Z_best, U_best
+    return U
+
+
+def simulate_family(label, sim_length=SIM_LENGTH, sample_rate=SAMPLE_RATE, params=PARAMS):
+    '''
+        closed loop simulation of every trajectory of one family as one batch. Returns the trajectories
+        [x, theta, x_dot, theta_dot, x_ddot, theta_ddot] and controls u (n x sim_length)
+    '''
+    name, theta0, goal_x, u_max = FAMILIES[label]
+    n = len(goal_x)
+    env = make_env(n, params, sample_rate)
+    K, P = lqr(params, sample_rate)
+
+    z = np.zeros((n, 4))
+    z[:, 2] = theta0
+    goal = np.stack((goal_x, np.zeros(n), np.full(n, GOAL_THETA), np.zeros(n)), axis=1)
+    # every family ends at the upright theta = pi (goal_theta of traj_gen.m). The translations start there and
+    # only need LQR, the swing-ups (from 2 pi) and revolutions (from the upright 3 pi) are driven there by MPC
+    mpc = theta0 != GOAL_THETA
+    if mpc:
+        model = make_env(n * HORIZON, params, sample_rate)
+        U = np.zeros((n, HORIZON))
+
+    states = np.zeros((n, sim_length, 4))
+    accelerations = np.zeros((n, sim_length, 2))
+    controls = np.zeros((n, sim_length))
+    for k in range(sim_length):
+        if mpc:
+            U = ilqr(env, model, z, U, goal, u_max, P)
+            u = U[:, 0]
+            U = np.concatenate((U[:, 1:], U[:, -1:]), axis=1) # warm start of the next step
+        else:
+            u = lqr_controller(z, goal_x, GOAL_THETA, u_max, K)
+        z_next = step(env, z, u)
+        states[:, k] = z
+        # explicit Euler: the velocity update over one step is exactly the acceleration at (z, u)
+        accelerations[:, k] = (z_next[:, [1, 3]] - z[:, [1, 3]]) * sample_rate
+        controls[:, k] = u
+        z = z_next
+
+    end_error = np.abs(states[:, -1, [0, 2]] - goal[:, [0, 2]])
+    unsettled = (end_error > END_TOLERANCE).any(axis=1)
+    if unsettled.any():
+        print("Warning: {} of {} {} trajectories end further than (x, theta) = {} from their goal: {}".format(
+            np.count_nonzero(unsettled), n, name, END_TOLERANCE, np.flatnonzero(unsettled).tolist()))
+
+    x, x_dot, theta, theta_dot = np.moveaxis(states, 2, 0)
+    trajectories = np.stack((x, theta, x_dot, theta_dot, accelerations[..., 0], accelerations[..., 1]), axis=2)
+    return trajectories, controls
+
+
+def inverse_dynamics_labels(trajectories, controls, params=PARAMS):
+    ''' H, c (as the matrix C with c = C q_dot), g and torques for whole batches of trajectories '''
+    M, m, l, g = params['M'], params['m'], params['l'], params['g']
+    theta = trajectories[..., 1]
+    theta_dot = trajectories[..., 3]
+    shape = theta.shape
+
+    H = np.zeros(shape + (2, 2))
+    H[..., 0, 0] = m + M
+    H[..., 0, 1] = m * l * np.cos(theta)
+    H[..., 1, 0] = m * l * np.cos(theta)
+    H[..., 1, 1] = m * l**2
+
+    C = np.zeros(shape + (2, 2))
+    C[..., 0, 1] = -m * l * theta_dot * np.sin(theta)
+
+    G = np.zeros(shape + (2,))
+    G[..., 1] = m * g * l * np.sin(theta)
+
+    torques = np.stack((controls, np.zeros(shape)), axis=-1)
+    return H, C, G, torques
+
+
+def family_summary(trajectories, labels):
+    ''' {label: (x range, theta range, final x range, final theta range)} of the trajectories of every family '''
+    summary = {}
+    for label in np.unique(labels):
+        T = trajectories[labels == label]
+        summary[int(label)] = tuple((values.min(), values.max()) for values in
+                                    (T[..., 0], T[..., 1], T[:, -1, 0], T[:, -1, 1]))
+    return summary
+
+
+def generate_family(label):
+    ''' pool worker: simulated trajectories and inverse dynamics labels of one family '''
+    trajectories, controls = simulate_family(label)
+    H, c, g, torques = inverse_dynamics_labels(trajectories, controls)
+    return trajectories, torques, g, H, c, np.full(len(trajectories), label)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', default='../cartpole_traj_gen/data/cartpole_all_200hz_python.mat')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, defaults to the number of CPUs')
+    parser.add_argument('--compare', default=None, help='reference .mat, e.g. ../cartpole_traj_gen/data/cartpole_all_200hz.mat')
+    args = parser.parse_args()
+
+    with Pool(args.workers) as pool:
+        # map keeps the label order of traj_gen.m
+        results = pool.map(generate_family, sorted(FAMILIES))
+
+    trajectories, torques, g, H, c, labels = [np.concatenate(field) for field in zip(*results)]
+    savemat(args.out, {'trajectories': trajectories, 'torques': torques, 'g': g, 'H': H, 'c': c,
+                       'labels': labels.reshape(1, -1).astype(np.uint8)})
+    print("Wrote {} trajectories to {}".format(len(trajectories), args.out))
+
+    if args.compare is not None:
+        reference = loadmat(args.compare)
+        ours = family_summary(trajectories, labels)
+        theirs = family_summary(reference['trajectories'], reference['labels'].ravel())
+        print("{:>6} {:>9} {:>15} {:>15} {:>15} {:>15}".format('label', '', 'x', 'theta', 'final x', 'final theta'))
+        for label in sorted(ours):
+            for name, summary in (('python', ours), ('ref', theirs)):
+                ranges = ' '.join('{:>15}'.format('{:.2f}..{:.2f}'.format(*r)) for r in summary.get(label, ()))
+                print("{:>6} {:>9} {}".format(label, name, ranges))
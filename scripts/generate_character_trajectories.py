@@ -3,10 +3,22 @@
     Generates character reference trajectories in [q, q_dot, q_ddot]
 
 '''
+import os
+import itertools
+import argparse
+from multiprocessing import Pool
 import numpy as np
 from scipy.io import loadmat
 import copy
 
+# link lengths (l1, l2) and masses (m1, m2) for the parameter sweep
+SWEEP_PARAMS = {
+    'l1': [0.4, 0.5, 0.6],
+    'l2': [0.4, 0.5, 0.6],
+    'm1': [0.5, 1.0],
+    'm2': [0.5, 1.0],
+}
+
 def J(q, l1=0.5, l2=0.5):
     ''' gets jacobian fcn - l1 and l2 are link lengths '''
     return np.asarray([[-l1 * np.sin(q[0]) - l2 * np.sin(q[0] + q[1]), -l2 * np.sin(q[0] + q[1])],
@@ -32,6 +44,34 @@ def torque(q_ddot, M, c, g):
     ''' calculates torque, given acceleration (q_ddot), mass matrix (M), Coriolis and centripetal torques (c) and gravitational torques (g)'''
     return M @ q_ddot + c + g
 
+def J_batch(q, l1=0.5, l2=0.5):
+    ''' batched J for q of shape (..., 2), returns (..., 2, 2) '''
+    s1, c1 = np.sin(q[..., 0]), np.cos(q[..., 0])
+    s12, c12 = np.sin(q[..., 0] + q[..., 1]), np.cos(q[..., 0] + q[..., 1])
+    return np.stack((np.stack((-l1 * s1 - l2 * s12, -l2 * s12), axis=-1),
+                     np.stack((l1 * c1 + l2 * c12, l2 * c12), axis=-1)), axis=-2)
+
+def M_batch(q, l1=0.5, l2=0.5, m1 = 0.5, m2 = 0.5):
+    ''' batched M for q of shape (n, 2), returns (n, 2, 2) '''
+    c2 = np.cos(q[:, 1])
+    M11 = m1 * l1**2 + m2 * (l1**2 + 2 * l1 * l2 * c2 + l2**2)
+    M12 = m2 * (l1 * l2 * c2 + l2**2)
+    M22 = np.full_like(c2, m2 * l2**2)
+    return np.stack((np.stack((M11, M12), axis=-1), np.stack((M12, M22), axis=-1)), axis=-2)
+
+def c_batch(q, q_dot, l1=0.5, l2=0.5, m1 = 0.5, m2 = 0.5):
+    ''' batched c for q, q_dot of shape (n, 2), returns (n, 2) '''
+    s2 = np.sin(q[:, 1])
+    return np.stack((-m2 * l1 * l2 * s2 * (2 * q_dot[:, 0] * q_dot[:, 1] + q_dot[:, 1]**2),
+                     m2 * l1 * l2 * (q_dot[:, 0]**2) * s2), axis=-1)
+
+def g_batch(q, l1=0.5, l2=0.5, m1 = 0.5, m2 = 0.5):
+    ''' batched g for q of shape (n, 2), returns (n, 2) '''
+    g = 9.8
+    c12 = np.cos(q[:, 0] + q[:, 1])
+    return np.stack(((m1 + m2) * l1 * g * np.cos(q[:, 0]) + m2 * g * l2 * c12,
+                     m2 * g * l2 * c12), axis=-1)
+
 def load_data():
     data = loadmat('../data/mixoutALL_shifted.mat')
 
@@ -47,7 +87,7 @@ def load_data():
     return trajectories, char_labels, key
 
 
-def convert_trajectory(trajectory, sample_rate=200):
+def convert_trajectory(trajectory, sample_rate=200, l1=0.5, l2=0.5):
     '''
         converts trajectory from end effector v to q_dot
         -- right now assuming that we start at same position every time -- can change
@@ -58,7 +98,7 @@ def convert_trajectory(trajectory, sample_rate=200):
     for i in range(len(trajectory)):
         # q_dot
         v = trajectory[i, :2]
-        q_d = np.linalg.solve(J(q), v)
+        q_d = np.linalg.solve(J(q, l1, l2), v)
         q += q_d / sample_rate
         q_dot.append(q_d)
 
@@ -68,7 +108,53 @@ def convert_trajectory(trajectory, sample_rate=200):
 
     return np.concatenate((q, q_dot, q_ddot), axis=1)
 
-def trajectory_torque(trajectory_joint_space):
+def solve_J_batch(q, v, l1=0.5, l2=0.5):
+    ''' solves J(q) q_dot = v for q, v of shape (..., 2) with the closed form 2x2 inverse '''
+    J = J_batch(q, l1, l2)
+    J00, J01, J10, J11 = J[..., 0, 0], J[..., 0, 1], J[..., 1, 0], J[..., 1, 1]
+    det = J00 * J11 - J01 * J10
+    return np.stack(((J11 * v[..., 0] - J01 * v[..., 1]) / det,
+                     (J00 * v[..., 1] - J10 * v[..., 0]) / det), axis=-1)
+
+def convert_trajectories_batch(trajectories, sample_rate=200, l1=0.5, l2=0.5, integrator='euler'):
+    '''
+        batched convert_trajectory: integrates all trajectories (list of T_i x >=2 end effector velocities) together
+        as a (batch, T) stepped integrator. Shorter trajectories are padded with their last velocity and cropped.
+        integrator is 'euler' (same as convert_trajectory) or 'rk4' with linearly interpolated velocities
+    '''
+    if integrator not in ('euler', 'rk4'):
+        raise ValueError("integrator must be 'euler' or 'rk4'")
+    lengths = [len(trajectory) for trajectory in trajectories]
+    B, T = len(trajectories), max(lengths)
+    dt = 1.0 / sample_rate
+
+    v = np.zeros((B, T, 2))
+    for b, trajectory in enumerate(trajectories):
+        v[b, :lengths[b]] = trajectory[:, :2]
+        v[b, lengths[b]:] = trajectory[-1, :2]
+    v_next = np.concatenate((v[:, 1:], v[:, -1:]), axis=1)
+
+    q = np.tile(np.asarray([np.pi / 4.0, np.pi / 2.0]), (B, 1))
+    q_all = np.zeros((B, T, 2))
+    q_dot = np.zeros((B, T, 2))
+    for t in range(T):
+        k1 = solve_J_batch(q, v[:, t], l1, l2)
+        q_dot[:, t] = k1
+        if integrator == 'euler':
+            q = q + dt * k1
+        else:
+            v_mid = 0.5 * (v[:, t] + v_next[:, t])
+            k2 = solve_J_batch(q + 0.5 * dt * k1, v_mid, l1, l2)
+            k3 = solve_J_batch(q + 0.5 * dt * k2, v_mid, l1, l2)
+            k4 = solve_J_batch(q + dt * k3, v_next[:, t], l1, l2)
+            q = q + dt / 6.0 * (k1 + 2 * k2 + 2 * k3 + k4)
+        q_all[:, t] = q
+
+    q_ddot = np.concatenate((np.zeros((B, 1, 2)), np.diff(q_dot, axis=1)), axis=1) * sample_rate
+
+    return [np.concatenate((q_all[b, :n], q_dot[b, :n], q_ddot[b, :n]), axis=1) for b, n in enumerate(lengths)]
+
+def trajectory_torque(trajectory_joint_space, l1=0.5, l2=0.5, m1=0.5, m2=0.5):
     '''
         calculates M, c, g and tau given a trajectory of joint angles, velocities and accelerations
     '''
@@ -76,80 +162,98 @@ def trajectory_torque(trajectory_joint_space):
     q_dot = trajectory_joint_space[:,2:4]
     q_ddot = trajectory_joint_space[:,4:]
 
-    n, d = q.shape
-
-    M_list = np.zeros((n,d,d))
-    c_list = np.zeros((n,d))
-    g_list = np.zeros((n,d))
-    tau_list = np.zeros((n,d))
-
-    for i in range(n):
-
-        M_i = M(q[i,:])
-        # L_i = np.linalg.cholesky(M_i)
-        # if L_i[1,0] < 0:
-        #     print("Negative")
-        c_i = c(q[i,:], q_dot[i,:])
-        g_i = g(q[i,:])
-        tau_i = torque(q_ddot[[i],:].T, M_i, c_i, g_i)
-
-        M_list[i,:,:] = M_i
-        c_list[i,:] = c_i.reshape((1,d))
-        g_list[i,:] = g_i.reshape((1,d))
-        tau_list[i,:] = tau_i.reshape((1,d))
+    M_list = M_batch(q, l1, l2, m1, m2)
+    c_list = c_batch(q, q_dot, l1, l2, m1, m2)
+    g_list = g_batch(q, l1, l2, m1, m2)
+    tau_list = np.einsum('nij,nj->ni', M_list, q_ddot) + c_list + g_list
 
     return (M_list, c_list, g_list, tau_list)
 
+def object_array(arrays):
+    ''' 1D object array of variable length arrays, as stored in the .npz datasets '''
+    out = np.empty(len(arrays), dtype=object)
+    for i, array in enumerate(arrays):
+        out[i] = array
+    return out
+
+def convert_and_label(args):
+    ''' pool worker: joint space trajectories, M, c, g and tau of a chunk of pen trajectories '''
+    trajectories, params, sample_rate, integrator = args
+    joint_trajectories = convert_trajectories_batch([trajectory.T for trajectory in trajectories], sample_rate,
+                                                    params['l1'], params['l2'], integrator)
+    return [(trajectory_joint_space,) + trajectory_torque(trajectory_joint_space, **params)
+            for trajectory_joint_space in joint_trajectories]
+
+def write_shard(fname, results, labels, key):
+    ''' writes converted trajectories in the same format as trajectories_joint_space.npz '''
+    joint_trajectories, M_list, c_list, g_list, tau_list = zip(*results)
+    np.savez(fname, trajectories = object_array(joint_trajectories),
+                    labels = labels,
+                    keys = key,
+                    torques = object_array(tau_list),
+                    H = object_array(M_list),
+                    c = object_array(c_list),
+                    g = object_array(g_list)
+                    )
+
+def generate_shards(trajectories, labels, key, out_dir, params, num_workers=None, shard_size=256, chunk_size=32,
+                    sample_rate=200, integrator='euler'):
+    '''
+        converts trajectories in parallel, chunk_size at a time per worker, and writes them to out_dir/shard_XXX.npz
+        as they finish. Shard k holds trajectories k * shard_size to (k + 1) * shard_size so the output is deterministic
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    trajectories = trajectories.flatten()
+    shard_fnames = []
+    with Pool(num_workers) as pool:
+        results = []
+        jobs = ((trajectories[i:i + chunk_size], params, sample_rate, integrator)
+                for i in range(0, len(trajectories), chunk_size))
+        # imap returns results in submission order
+        for chunk in pool.imap(convert_and_label, jobs):
+            for result in chunk:
+                results.append(result)
+                if len(results) == shard_size or len(shard_fnames) * shard_size + len(results) == len(trajectories):
+                    start = len(shard_fnames) * shard_size
+                    fname = os.path.join(out_dir, 'shard_{:03d}.npz'.format(len(shard_fnames)))
+                    write_shard(fname, results, labels[start:start + len(results)], key)
+                    shard_fnames.append(fname)
+                    results = []
+    return shard_fnames
+
+def merge_shards(shard_fnames, fname):
+    ''' concatenates shards in order into a single dataset file '''
+    shards = [np.load(shard_fname, allow_pickle=True) for shard_fname in shard_fnames]
+    merged = {field: np.concatenate([shard[field] for shard in shards])
+              for field in ['trajectories', 'labels', 'torques', 'H', 'c', 'g']}
+    np.savez(fname, keys=shards[0]['keys'], **merged)
+
+def sweep_dirname(params):
+    return '_'.join('{}_{}'.format(name, params[name]) for name in ['l1', 'l2', 'm1', 'm2'])
+
 if __name__ =='__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, defaults to the number of CPUs')
+    parser.add_argument('--shard-size', type=int, default=256, help='trajectories per shard')
+    parser.add_argument('--sweep', action='store_true', help='also generate datasets for every combination in SWEEP_PARAMS')
+    parser.add_argument('--integrator', default='euler', choices=['euler', 'rk4'], help='differential IK integrator')
+    parser.add_argument('--sample-rate', type=int, default=200, help='sample rate of the pen trajectories (Hz)')
+    args = parser.parse_args()
 
     trajectories, labels, key = load_data()
-    joint_trajectories = []
-    M_list = []
-    c_list = []
-    g_list = []
-    tau_list = []
-
-    joint_trajectories_concat = None
-    tau_list_concat = None
-
-    # It takes a minutes or two so wanted to print out status
-    for i, trajectory in enumerate(trajectories.flatten()):
-        print("Converting trajectory #", str(i))
-        trajectory_joint_space = convert_trajectory(trajectory.T)
-        trajectory_M, trajectory_c, trajectory_g, trajectory_tau = trajectory_torque(trajectory_joint_space)
-
-        # create concatenated dataset for neural network training
-        # if i == 0:
-        #     joint_trajectories_concat = trajectory_joint_space
-        #     tau_list_concat = trajectory_tau
-        # else:
-        #     joint_trajectories_concat = np.vstack((joint_trajectories_concat,trajectory_joint_space))
-        #     tau_list_concat = np.vstack((tau_list_concat,trajectory_tau))
-
-        joint_trajectories.append(trajectory_joint_space)
-        M_list.append(trajectory_M)
-        c_list.append(trajectory_c)
-        g_list.append(trajectory_g)
-        tau_list.append(trajectory_tau)
-
-    # joint_data = dict()
-    # joint_data['M'] = M_list
-    # joint_data['c'] = c_list
-    # joint_data['g'] = g_list
-    # joint_data['torques'] = tau_list
-    # joint_data['trajectories'] = joint_trajectories
-    # joint_data['char_label'] = labels
-    # joint_data['char_keys'] = key
-
-    np.savez('../data/trajectories_joint_space.npz', trajectories = joint_trajectories, 
-                                                    labels = labels,
-                                                    keys = key,
-                                                    torques = tau_list,
-                                                    H = M_list,
-                                                    c = c_list,
-                                                    g = g_list
-                                                    )
-    # np.savez('../data/trajectories_train_joint_space.npz', trajectories = joint_trajectories_concat,
-    #                                                 torques = tau_list_concat
-    #                                                 )
 
+    default_params = {'l1': 0.5, 'l2': 0.5, 'm1': 0.5, 'm2': 0.5}
+    print("Converting {} trajectories".format(trajectories.size))
+    shard_fnames = generate_shards(trajectories, labels, key, '../data/shards/' + sweep_dirname(default_params),
+                                   default_params, args.workers, args.shard_size,
+                                   sample_rate=args.sample_rate, integrator=args.integrator)
+    merge_shards(shard_fnames, '../data/trajectories_joint_space.npz')
+
+    if args.sweep:
+        for values in itertools.product(*SWEEP_PARAMS.values()):
+            params = dict(zip(SWEEP_PARAMS.keys(), values))
+            print("Converting with", params)
+            out_dir = '../data/character_sweep/' + sweep_dirname(params)
+            shard_fnames = generate_shards(trajectories, labels, key, out_dir, params, args.workers, args.shard_size,
+                                           sample_rate=args.sample_rate, integrator=args.integrator)
+            merge_shards(shard_fnames, out_dir + '.npz')
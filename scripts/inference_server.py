@@ -0,0 +1,203 @@
+'''
+
+    Local inference service for a trained DeLaN_Network. One process holds the model; controllers connect over a
+    Unix socket (or TCP) and send q, q_dot, q_ddot. The requests that queue up while a batch is computed are merged
+    into the next batch of up to max_batch_size samples (optionally waiting up to max_delay for more), and every
+    client gets back tau and the H q_ddot, c and g terms of its own samples
+
+    protocol: on connect the server sends d (uint32). A request is the number of samples n (uint32) followed by
+    n x 3d float32 values [q, q_dot, q_ddot], the reply is n (uint32) followed by n x 4d float32 [tau, Hq_ddot, c, g].
+    A failed request, also one with n = 0 or more than max_request_size samples, is answered with 0 (uint32), the
+    length of an error message (uint32) and the UTF-8 message
+
+    usage: python inference_server.py model.pt --socket /tmp/delan.sock
+           python inference_server.py model.pt --port 5555
+
+'''
+import os
+import socket
+import traceback
+import struct
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+HEADER = struct.Struct('<I')
+
+
+def error_reply(message):
+    ''' the reply to a failed request, see the module docstring '''
+    message = message.encode()
+    return HEADER.pack(0) + HEADER.pack(len(message)) + message
+
+
+class InferenceServer:
+    def __init__(self, model, max_batch_size=256, max_delay=0.0, max_request_size=65536):
+        '''
+            model is a DeLaN_Network (on the CPU). A batch is run once it has max_batch_size samples or max_delay
+            seconds after its first request arrived. With max_delay = 0 a request waits for at most the batch that
+            is being computed when it arrives. Requests of more than max_request_size samples are rejected
+            without allocating them
+        '''
+        self.model = model.cpu().eval()
+        self.d = model.input_dim
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_request_size = max_request_size
+        # the model runs in one worker thread, so the event loop keeps reading requests during a batch
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+
+    def infer(self, x):
+        ''' [tau, Hq_ddot, c, g] (n x 4d) of the samples x (n x 3d) '''
+        with torch.inference_mode():
+            return torch.cat(self.model(torch.from_numpy(x)), dim=1).numpy()
+
+    async def handle(self, reader, writer):
+        ''' serves the requests of one connection, one at a time '''
+        loop = asyncio.get_running_loop()
+        writer.write(HEADER.pack(self.d))
+        try:
+            while True:
+                n, = HEADER.unpack(await reader.readexactly(HEADER.size))
+                if not 0 < n <= self.max_request_size:
+                    # skip the samples in bounded chunks, so the client can send all of them and read the reply
+                    remaining = n * 3 * self.d * 4
+                    while remaining:
+                        remaining -= len(await reader.readexactly(min(remaining, 1 << 16)))
+                    writer.write(error_reply("Number of samples must be between 1 and {}, got {}".format(
+                        self.max_request_size, n)))
+                    await writer.drain()
+                    continue
+                x = np.frombuffer(await reader.readexactly(n * 3 * self.d * 4), dtype=np.float32).reshape(n, 3 * self.d)
+                result = loop.create_future()
+                self.queue.put_nowait((x, result))
+                try:
+                    writer.write(HEADER.pack(n) + (await result).tobytes())
+                except Exception as e: # the model failed on the batch of this request, logged by batcher
+                    writer.write(error_reply("{}: {}".format(type(e).__name__, e)))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            pass # client disconnected
+        finally:
+            writer.close()
+
+    async def batcher(self):
+        ''' merges queued requests into batches and resolves each request with its rows of the result '''
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            num_samples = len(batch[0][0])
+            deadline = loop.time() + self.max_delay
+            while num_samples < self.max_batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self.queue.get_nowait()
+                batch.append(request)
+                num_samples += len(request[0])
+
+            x = np.concatenate([request[0] for request in batch]) # also copies the read-only request buffers
+            try:
+                out = await loop.run_in_executor(self.executor, self.infer, x)
+            except Exception as e:
+                print("Batch of {} samples in {} requests failed:".format(len(x), len(batch)))
+                traceback.print_exc()
+                for _, result in batch:
+                    if not result.cancelled():
+                        result.set_exception(e)
+                continue
+            start = 0
+            for request, result in batch:
+                if not result.cancelled():
+                    result.set_result(out[start:start + len(request)])
+                start += len(request)
+
+    async def serve(self, path=None, host='127.0.0.1', port=None):
+        ''' serves forever on the Unix socket path, or on host:port if port is given '''
+        self.queue = asyncio.Queue()
+        if port is not None:
+            server = await asyncio.start_server(self.handle, host, port)
+        else:
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(self.handle, path)
+        batcher = asyncio.ensure_future(self.batcher())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def serve(model, path=None, host='127.0.0.1', port=None, max_batch_size=256, max_delay=0.0, max_request_size=65536):
+    asyncio.run(InferenceServer(model, max_batch_size, max_delay, max_request_size).serve(path, host, port))
+
+
+class InferenceClient:
+    def __init__(self, path=None, host='127.0.0.1', port=None):
+        ''' blocking client of an InferenceServer on the Unix socket path, or on host:port if port is given '''
+        if port is not None:
+            self.sock = socket.create_connection((host, port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        self.d, = HEADER.unpack(self._recv(HEADER.size))
+
+    def _recv(self, num_bytes):
+        buf = bytearray(num_bytes)
+        view = memoryview(buf)
+        while num_bytes:
+            received = self.sock.recv_into(view, num_bytes)
+            if received == 0:
+                raise ConnectionError("Inference server closed the connection")
+            view = view[received:]
+            num_bytes -= received
+        return buf
+
+    def __call__(self, q, q_dot, q_ddot):
+        '''
+            inverse dynamics of one sample (d each) or a batch (n x d each).
+            Returns tau, Hq_ddot, c, g with the same shape as q. Raises RuntimeError if the server fails the request
+        '''
+        q = np.asarray(q, dtype=np.float32)
+        x = np.concatenate((np.atleast_2d(q), np.atleast_2d(q_dot), np.atleast_2d(q_ddot)), axis=1).astype(np.float32)
+        if len(x) == 0:
+            raise ValueError("No samples")
+        self.sock.sendall(HEADER.pack(len(x)) + x.tobytes())
+        n, = HEADER.unpack(self._recv(HEADER.size))
+        if n == 0:
+            length, = HEADER.unpack(self._recv(HEADER.size))
+            raise RuntimeError("Inference server: {}".format(self._recv(length).decode()))
+        out = np.frombuffer(self._recv(n * 4 * self.d * 4), dtype=np.float32).reshape(n, 4, self.d)
+        return tuple(out[:, i].reshape(q.shape) for i in range(4))
+
+    def close(self):
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batched DeLaN inverse dynamics server')
+    parser.add_argument('model', help='whole DeLaN model saved with torch.save(model, path)')
+    parser.add_argument('--socket', default='/tmp/delan.sock', help='Unix socket path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None, help='serve on TCP instead of the Unix socket')
+    parser.add_argument('--max-batch-size', type=int, default=256)
+    parser.add_argument('--max-delay-ms', type=float, default=0.0, help='longest wait for a batch to fill up')
+    parser.add_argument('--max-request-size', type=int, default=65536, help='most samples in one request')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    model = torch.load(args.model, weights_only=False)
+    print("Serving {} on {}".format(type(model).__name__, args.socket if args.port is None else '{}:{}'.format(args.host, args.port)))
+    serve(model, args.socket, args.host, args.port, args.max_batch_size, args.max_delay_ms / 1e3, args.max_request_size)
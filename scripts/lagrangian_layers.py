@@ -0,0 +1,133 @@
+'''
+
+    Lagrangian layers shared by the DeLaN networks: assemble the Cholesky factor L of the mass matrix
+    from the network's diagonal (ld) and off-diagonal (lo) outputs, and compute H(q) and c(q, q_dot)
+
+'''
+import torch
+
+
+def tril_flat_indices(d, device=None):
+    '''
+        flat (row * d + col) indices of the diagonal followed by the strictly lower triangle of a d x d matrix.
+        The strictly lower entries are in column-major order, i.e. the order lo is laid out in by the networks
+    '''
+    diag = torch.arange(d, device=device)
+    # triu_indices walks the upper triangle row by row, swapping rows and cols walks the lower one column by column
+    cols, rows = torch.triu_indices(d, d, offset=1, device=device)
+    return torch.cat((diag * d + diag, rows * d + cols))
+
+
+def assemble_lower_triangular(ld, lo, flat_idx):
+    '''
+        scatters ld (n x d x ...) and lo (n x d(d-1)/2 x ...) into a lower triangular n x d x d x ... tensor
+        without inplace operations on tensors that require grad
+    '''
+    n, d = ld.shape[:2]
+    entries = torch.cat((ld, lo), dim=1)
+    out = entries.new_zeros((n, d * d) + tuple(entries.shape[2:]))
+    return out.index_copy(1, flat_idx, entries).view((n, d, d) + tuple(entries.shape[2:]))
+
+
+def leaky_relu_slope(h, neg_slope):
+    ''' elementwise derivative of the leaky relu that produced h '''
+    return torch.where(h > 0, torch.ones_like(h), torch.full_like(h, neg_slope))
+
+
+def row_scaled_jacobian(slope, weight, jacobian=None):
+    '''
+        Jacobian of act(W x + b) w.r.t. q given dx/dq (n x in_dim x d), or w.r.t. x itself when jacobian is None.
+        Scales the rows of W @ dx/dq by the activation slope (n x out_dim) instead of forming diag(slope) @ W
+    '''
+    if jacobian is not None:
+        # einsum keeps W as one matrix (also under vmap) instead of broadcasting it to every sample
+        weight = torch.einsum('oi,nid->nod', weight, jacobian)
+    return slope.unsqueeze(-1) * weight
+
+
+def lagrangian_terms(ld, lo, dld_dq, dlo_dq, q_dot, flat_idx=None, epsilon=1e-9, return_factor=False):
+    '''
+        vectorized mass matrix and Coriolis/centripetal torques for any number of degrees of freedom
+
+        ld (n x d), lo (n x d(d-1)/2) are the entries of L, dld_dq (n x d x d), dlo_dq (n x d(d-1)/2 x d) their
+        Jacobians w.r.t. q. Returns H (n x d x d) and c (n x d x 1), and L (n x d x d) if return_factor is set
+    '''
+    n, d = ld.shape
+    if flat_idx is None:
+        flat_idx = tril_flat_indices(d, device=ld.device)
+
+    L = assemble_lower_triangular(ld, lo, flat_idx)
+    # dL_dq n x d x d x d -- last dim is index for qi
+    dL_dq = assemble_lower_triangular(dld_dq, dlo_dq, flat_idx)
+    dL_dt = torch.einsum('nrck,nk->nrc', dL_dq, q_dot)
+
+    H = L @ L.transpose(1, 2) + epsilon * torch.eye(d, device=ld.device, dtype=ld.dtype)
+
+    # Time derivative of Mass Matrix
+    dH_dt = L @ dL_dt.transpose(1, 2) + dL_dt @ L.transpose(1, 2)
+
+    # q_dot^T dH/dq_i q_dot = 2 (L^T q_dot) . (dL/dq_i^T q_dot) for all i at once, without forming dH/dq
+    Lt_qdot = torch.einsum('nrc,nr->nc', L, q_dot)
+    dLt_qdot = torch.einsum('nrck,nr->nck', dL_dq, q_dot)
+    quadratic_term = 2.0 * torch.einsum('nck,nc->nk', dLt_qdot, Lt_qdot)
+
+    c = dH_dt @ q_dot.view(n, d, 1) - 0.5 * quadratic_term.view(n, d, 1)
+    if return_factor:
+        return H, c, L
+    return H, c
+
+
+def lagrangian_terms_loop(ld, lo, dld_dq, dlo_dq, q_dot, epsilon=1e-9):
+    '''
+        reference implementation of lagrangian_terms that builds L column by column and the quadratic term joint
+        by joint, as the networks originally did. Kept for checking and benchmarking the vectorized version
+    '''
+    n, d = ld.shape
+    dld_dqi = dld_dq.permute(0, 2, 1).view(n, d, d, 1)
+    dlo_dqi = dlo_dq.permute(0, 2, 1).reshape(n, d, -1, 1)
+
+    dld_dt = dld_dq @ q_dot.view(n, d, 1)
+    dlo_dt = dlo_dq @ q_dot.view(n, d, 1)
+
+    # Get L, dL matrices without inplace operations
+    L = []
+    dL_dt = []
+    dL_dqi = []
+    zeros = torch.zeros_like(ld)
+    zeros_2 = torch.zeros_like(dld_dqi)
+    lo_start = 0
+    for i in range(d):
+        lo_end = lo_start + d - 1 - i
+        l = torch.cat((zeros[:, :i].view(n, -1), ld[:, i].view(-1, 1), lo[:, lo_start:lo_end]), dim=1)
+        dl_dt = torch.cat((zeros[:, :i].view(n, -1), dld_dt[:, i].view(-1, 1),
+                           dlo_dt[:, lo_start:lo_end].view(n, -1)), dim=1)
+
+        dl_dqi = torch.cat((zeros_2[:, :, :i].view(n, d, -1), dld_dqi[:, :, i].view(n, -1, 1),
+                            dlo_dqi[:, :, lo_start:lo_end].view(n, d, -1)), dim=2)
+
+        lo_start = lo_end
+        L.append(l)
+        dL_dt.append(dl_dt)
+        dL_dqi.append(dl_dqi)
+
+    L = torch.stack(L, dim=2)
+    dL_dt = torch.stack(dL_dt, dim=2)
+
+    # dL_dqi n x d x d x d -- last dim is index for qi
+    dL_dqi = torch.stack(dL_dqi, dim=3).permute(0, 2, 3, 1)
+
+    H = L @ L.transpose(1, 2) + epsilon * torch.eye(d, device=ld.device, dtype=ld.dtype)
+
+    # Time derivative of Mass Matrix
+    dH_dt = L @ dL_dt.permute(0, 2, 1) + dL_dt @ L.permute(0, 2, 1)
+
+    quadratic_term = []
+    for i in range(d):
+        qterm = q_dot.view(n, 1, d) @ (dL_dqi[:, :, :, i] @ L.transpose(1, 2) +
+                                       L @ dL_dqi[:, :, :, i].transpose(1, 2)) @ q_dot.view(n, d, 1)
+        quadratic_term.append(qterm)
+
+    quadratic_term = torch.stack(quadratic_term, dim=1)
+
+    c = dH_dt @ q_dot.view(n, d, 1) - 0.5 * quadratic_term.view(n, d, 1)
+    return H, c
@@ -0,0 +1,122 @@
+'''
+
+    Sample-weighted test errors of variable-length trajectories. MetricsAccumulator keeps the sums of squared errors
+    per label, dynamics component (tau, Hq_ddot, c, g) and joint, and the number of samples per label, so any mean
+    (over everything, one label, one component or one joint) weights every sample the same, however long its
+    trajectory. Accumulators of different workers, seeds or test shards are merged by adding their sums and counts,
+    which gives exactly the result of evaluating everything in one pass
+
+    usage: metrics = MetricsAccumulator()
+           metrics.update(labels, {'tau': pred_tau}, {'tau': tau})
+           metrics.mse('tau'), metrics.mse('tau', label=3), metrics.mse('tau', joint=0)
+           merge_all([MetricsAccumulator.from_state_dict(s) for s in states]).mse()
+
+'''
+import numpy as np
+import torch
+
+
+def _key(label):
+    ''' plain python label, so labels of numpy arrays, tensors and JSON files compare equal '''
+    return label.item() if hasattr(label, 'item') else label
+
+
+class MetricsAccumulator:
+    def __init__(self):
+        self.sums = {}   # {label: {component: squared error sums (d,), float64}}, on the device of the errors
+        self.counts = {} # {label: number of samples}
+
+    def update(self, labels, predictions, targets):
+        '''
+            adds the squared errors of a batch. labels is one label or one per sample (n), predictions and targets
+            map component names to n x d tensors. Nothing is copied to the host
+        '''
+        n = len(next(iter(targets.values())))
+        labels = np.asarray(labels)
+        if labels.ndim == 0:
+            unique, inverse = labels.reshape(1), None
+        else:
+            unique, inverse = np.unique(labels, return_inverse=True)
+            if len(unique) == 1:
+                inverse = None
+
+        counts = [n] if inverse is None else np.bincount(inverse.ravel(), minlength=len(unique)).tolist()
+        for label, count in zip(unique, counts):
+            label = _key(label)
+            self.counts[label] = self.counts.get(label, 0) + count
+            self.sums.setdefault(label, {})
+
+        for component, target in targets.items():
+            squared_errors = (predictions[component].double() - target.double()) ** 2
+            if inverse is None:
+                per_label = squared_errors.sum(dim=0, keepdim=True)
+            else:
+                index = torch.from_numpy(inverse.ravel()).to(squared_errors.device)
+                per_label = squared_errors.new_zeros((len(unique), squared_errors.shape[1])).index_add_(0, index, squared_errors)
+            for label, sums in zip(unique, per_label):
+                label_sums = self.sums[_key(label)]
+                label_sums[component] = sums if component not in label_sums else label_sums[component] + sums
+        return self
+
+    def merge(self, other):
+        ''' adds the sums and counts of another accumulator (e.g. of another worker) to this one '''
+        for label, count in other.counts.items():
+            self.counts[label] = self.counts.get(label, 0) + count
+            label_sums = self.sums.setdefault(label, {})
+            for component, sums in other.sums[label].items():
+                if component in label_sums:
+                    label_sums[component] = label_sums[component] + sums.to(label_sums[component].device)
+                else:
+                    label_sums[component] = sums.clone()
+        return self
+
+    def labels(self):
+        return list(self.counts)
+
+    def components(self):
+        return sorted({component for sums in self.sums.values() for component in sums})
+
+    def mse(self, component='tau', label=None, joint=None):
+        '''
+            mean squared error of component over all samples (and joints), or only those of label and / or joint.
+            Equal to nn.MSELoss over the same samples. NaN if there are none
+        '''
+        labels = self.labels() if label is None else [_key(label)]
+        total, num_values = 0.0, 0
+        for l in labels:
+            if component not in self.sums.get(l, {}):
+                continue
+            sums = self.sums[l][component]
+            total += float(sums.sum() if joint is None else sums[joint])
+            num_values += self.counts[l] * (len(sums) if joint is None else 1)
+        return total / num_values if num_values else float('nan')
+
+    def summary(self):
+        ''' {label: {component: MSE}} and the sample-weighted MSEs of all labels under 'all' '''
+        summary = {label: {component: self.mse(component, label) for component in self.sums[label]}
+                   for label in self.labels()}
+        summary['all'] = {component: self.mse(component) for component in self.components()}
+        return summary
+
+    def state_dict(self):
+        ''' JSON serializable state, e.g. the result of a sweep cell '''
+        return {'labels': [{'label': label, 'count': self.counts[label],
+                            'sums': {component: sums.tolist() for component, sums in self.sums[label].items()}}
+                           for label in self.labels()]}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        metrics = cls()
+        for entry in state['labels']:
+            metrics.counts[entry['label']] = entry['count']
+            metrics.sums[entry['label']] = {component: torch.tensor(sums, dtype=torch.float64)
+                                            for component, sums in entry['sums'].items()}
+        return metrics
+
+
+def merge_all(accumulators):
+    ''' one accumulator with the sums and counts of all of accumulators '''
+    merged = MetricsAccumulator()
+    for metrics in accumulators:
+        merged.merge(metrics)
+    return merged
@@ -0,0 +1,66 @@
+'''
+
+    Forward pass parity of bfloat16 autocast (mixed_precision in the train functions) with float32: for random
+    networks and samples, the relative error ||out_bf16 - out_fp32|| / ||out_fp32|| of every output of the DeLaN
+    modes and of the FF baseline. Exits with 1 if any error is above the tolerance, so it can run after changes to
+    the networks' precision handling
+
+        python mixed_precision_check.py
+        python mixed_precision_check.py --dofs 2,3,6 --batch-size 2000 --tolerance 0.02
+
+'''
+import sys
+import argparse
+import torch
+from delan_network import DeLaN_Network
+from benchmark_delan import FF_Network, int_list
+
+# outputs of every checked model and mode, in the order they are returned
+OUTPUTS = {('delan', 'inverse_dynamics'): ['tau', 'Hq_ddot', 'c', 'g'],
+           ('delan', 'gravity'): ['g'],
+           ('delan', 'mass_matrix'): ['H'],
+           ('delan', 'energy'): ['kinetic_energy'],
+           ('ff', None): ['tau']}
+
+
+def relative_errors(model, x, mode=None, device_type='cpu'):
+    ''' {output: relative error} of model(x) (model(x, mode) for DeLaN) under bfloat16 autocast '''
+    call = (lambda: model(x)) if mode is None else (lambda: model(x, mode))
+    with torch.no_grad():
+        reference = call()
+        with torch.autocast(device_type, torch.bfloat16):
+            low = call()
+    if not isinstance(reference, tuple):
+        reference, low = (reference,), (low,)
+    return [((l.float() - r).norm() / r.norm()).item() for l, r in zip(low, reference)]
+
+
+def check(dofs, batch_size, device, seed=0):
+    ''' rows (model, mode, d, output, relative error) for every d in dofs '''
+    rows = []
+    for d in dofs:
+        torch.manual_seed(seed)
+        x = torch.randn(batch_size, 3 * d, device=device)
+        for (name, mode), outputs in OUTPUTS.items():
+            model = (DeLaN_Network(d) if name == 'delan' else FF_Network(d)).to(device)
+            errors = relative_errors(model, x, mode, torch.device(device).type)
+            rows += [(name, mode or '-', d, output, error) for output, error in zip(outputs, errors)]
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='bfloat16 autocast vs float32 forward pass parity')
+    parser.add_argument('--dofs', type=int_list, default=[2, 3, 6])
+    parser.add_argument('--batch-size', type=int, default=2000)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--tolerance', type=float, default=0.02, help='largest allowed relative error')
+    args = parser.parse_args()
+
+    rows = check(args.dofs, args.batch_size, args.device)
+    print("{:>6} {:>17} {:>3} {:>15} {:>10}".format('model', 'mode', 'd', 'output', 'rel. error'))
+    failed = False
+    for name, mode, d, output, error in rows:
+        flag = '' if error <= args.tolerance else '  above tolerance'
+        failed |= error > args.tolerance
+        print("{:>6} {:>17} {:>3} {:>15} {:>10.2e}{}".format(name, mode, d, output, error, flag))
+    sys.exit(1 if failed else 0)
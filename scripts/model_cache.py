@@ -0,0 +1,117 @@
+'''
+
+    Content-addressed cache of trained weights. A model is stored under the hash of everything that determines
+    its training: the hyperparameters, the contents of the dataset file, the training trajectories and the seed.
+    Rerunning a script with an identical configuration loads the weights instead of training again
+
+'''
+import os
+import json
+import hashlib
+import torch
+
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'model_cache')
+
+_file_hashes = {}
+
+
+def file_hash(fname):
+    ''' sha256 of a file's contents, remembered per (path, size, mtime) so it is computed once per process '''
+    stat = os.stat(fname)
+    memo_key = (os.path.abspath(fname), stat.st_size, stat.st_mtime)
+    if memo_key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _file_hashes[memo_key] = h.hexdigest()
+    return _file_hashes[memo_key]
+
+
+def _plain(value):
+    ''' JSON friendly copy of numpy scalars / arrays inside lists and dicts '''
+    if isinstance(value, dict):
+        return {str(k): _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return value
+
+
+def cache_key(config, dataset_file, train_indices, seed):
+    '''
+        key of a trained model. config is a dict of the model class and its training hyperparameters
+    '''
+    record = {'config': _plain(config), 'dataset': file_hash(dataset_file),
+              'train_indices': _plain(list(train_indices)), 'seed': _plain(seed)}
+    return hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest(), record
+
+
+def checkpoint_path(name, config, dataset_file, train_indices, seed):
+    '''
+        training checkpoint file '<name>.<key>.ckpt' of a configuration, so a run only resumes the checkpoint of
+        a run with the same config, dataset, training trajectories and seed
+    '''
+    return '{}.{}.ckpt'.format(name, cache_key(config, dataset_file, train_indices, seed)[0][:16])
+
+
+class ModelCache:
+    def __init__(self, root=DEFAULT_ROOT):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.pt')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key, model):
+        ''' loads the cached weights into model, returns False if there are none '''
+        if key not in self:
+            return False
+        model.load_state_dict(torch.load(self.path(key), map_location='cpu'))
+        return True
+
+    def save(self, key, model, record=None):
+        ''' stores the weights (and the record the key was made from, next to them as JSON) '''
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if record is not None:
+            with open(path[:-3] + '.json', 'w') as f:
+                json.dump(record, f, sort_keys=True, indent=1)
+        # write then rename, so a cached file is always complete
+        torch.save({k: v.cpu() for k, v in model.state_dict().items()}, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def entries(self):
+        ''' registry of the cached models, {key: record} '''
+        out = {}
+        if os.path.isdir(self.root):
+            for sub in sorted(os.listdir(self.root)):
+                for f in sorted(os.listdir(os.path.join(self.root, sub))):
+                    if f.endswith('.json'):
+                        with open(os.path.join(self.root, sub, f)) as g:
+                            out[f[:-5]] = json.load(g)
+        return out
+
+
+def cached_train(model, train_fn, config, dataset_file, train_indices, seed, cache=None):
+    '''
+        loads model from the cache if this configuration has been trained before, otherwise calls train_fn()
+        (which trains model in place) and caches the result. Returns model
+    '''
+    cache = ModelCache() if cache is None else cache
+    key, record = cache_key(config, dataset_file, train_indices, seed)
+    device = next(model.parameters()).device
+    if cache.load(key, model):
+        print("Loaded cached model {}".format(key[:12]))
+        return model.to(device)
+    train_fn()
+    cache.save(key, model, record)
+    return model
+
+
+if __name__ == '__main__':
+    for key, record in ModelCache().entries().items():
+        print(key[:12], json.dumps(record['config']), 'seed', record['seed'], 'train', record['train_indices'])
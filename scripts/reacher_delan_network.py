@@ -1,3 +1,5 @@
+import os
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm # Displays a progress bar
@@ -6,162 +8,98 @@ from torch import nn
 from torch import optim
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from dataset import TrajectoryDataset
+from dataset import sample_loader, ensemble_sample_loader
+from trajectory_store import MmapTrajectoryDataset, load_dataset
+from checkpoint import Checkpointer
+from model_cache import cached_train, checkpoint_path
+from training_metrics import TrainingMonitor
+from metrics_accumulator import MetricsAccumulator
+from early_stopping import validation_loss
+from streaming_evaluation import evaluate_streaming
+from energy_diagnostics import energy_diagnostics, print_summary
+from sweep_runner import seed_everything
+import ensemble
+from ensemble import Ensemble
+from delan_network import DeLaN_Network
 from trajectory_selection import random_train_test_chars
 # torch.manual_seed(0) # Fix random seed for reproducibility
 
-class Reacher_DeLaN_Network(nn.Module):
-    def __init__(self, device):
-        super().__init__()
-        self.device = device
-        input_dim = 2
-        h1_dim = 64
-        h2_dim = 64
-        # joint angle input layer
-        self.fc1 = nn.Linear(input_dim, h1_dim)
+class Reacher_DeLaN_Network(DeLaN_Network):
+    ''' both joints actuated '''
+    def __init__(self, device=None, vectorized=True):
+        super().__init__(input_dim=2, num_layers=2, hidden_dim=64, activation='leaky_relu', device=device,
+                         vectorized=vectorized)
 
-        # 1st hidden layer
-        self.fc1a = nn.Linear(h1_dim, h2_dim)
 
-        # gravity layer
-        self.fc2 = nn.Linear(h2_dim, input_dim) 
-
-        # ld layer
-        self.fc3 = nn.Linear(h2_dim, input_dim)
-
-        # lo layer
-        self.fc4 = nn.Linear(h2_dim, 1)
-
-        self.act_fn = F.leaky_relu
-        self.neg_slope = -0.01
-
-
-    def forward(self,x):
-        d = x.shape[1] // 3
-        num_off_diagonals = d * (d - 1) // 2
-        n = x.shape[0]
-        q, q_dot, q_ddot = torch.split(x,[d,d,d], dim = 1)
-
-        h1 = self.act_fn(self.fc1(q))
-        h2 = self.act_fn(self.fc1a(h1))
-        
-        # Gravity torque
-        g = self.fc2(h2)
-
-        # ld is vector of diagonal L terms, lo is vector of off-diagonal L terms
-        h3 = self.fc3(h2)
-        ld = F.softplus(h3)
-        lo = self.fc4(h2)
-
-        dRelu_fc1 = torch.where(h1 > 0, torch.ones(h1.shape, device=self.device), self.neg_slope * torch.ones(h1.shape,device=self.device))
-        dh1_dq = torch.diag_embed(dRelu_fc1) @ self.fc1.weight
-
-        dRelu_fc1a = torch.where(h2 > 0, torch.ones(h2.shape, device=self.device), self.neg_slope * torch.ones(h2.shape,device=self.device))
-        dh2_dh1 = torch.diag_embed(dRelu_fc1a) @ self.fc1a.weight
-
-        dRelu_fc3 = torch.sigmoid(h3) #torch.where(ld > 0, torch.ones(ld.shape), 0.0 * torch.ones(ld.shape))
-
-        dld_dh2 = torch.diag_embed(dRelu_fc3) @ self.fc3.weight
-        dlo_dh2 = self.fc4.weight
-        
-        dld_dq = dld_dh2 @ dh2_dh1 @ dh1_dq
-        dlo_dq = dlo_dh2 @ dh2_dh1 @ dh1_dq
-        dld_dqi = dld_dq.permute(0,2,1).view(n,d,d,1)
-        dlo_dqi = dlo_dq.permute(0,2,1).view(n,d,-1,1)
-
-        dld_dt = dld_dq @ q_dot.view(n,d,1)
-        dlo_dt = dlo_dq @ q_dot.view(n,d,1)
-
-        # Get L, dL matrices without inplace operations
-        L = []
-        dL_dt = []
-        dL_dqi = []
-        zeros = torch.zeros_like(ld)
-        zeros_2 = torch.zeros_like(dld_dqi)
-        lo_start = 0
-        lo_end = d - 1
-        for i in range(d):
-            l = torch.cat((zeros[:, :i].view(n, -1), ld[:, i].view(-1, 1), lo[:, lo_start:lo_end]), dim=1)
-            dl_dt = torch.cat((zeros[:, :i].view(n, -1), dld_dt[:, i].view(-1, 1),
-                               dlo_dt[:, lo_start:lo_end].view(n, -1)), dim=1)
-
-            dl_dqi = torch.cat((zeros_2[:, :, :i].view(n, d, -1), dld_dqi[:, :, i].view(n, -1, 1),
-                                dlo_dqi[:, :, lo_start:lo_end].view(n, d, -1)), dim=2)
-
-            lo_start = lo_start + lo_end
-            lo_end = lo_end + d - 2 - i
-            L.append(l)
-            dL_dt.append(dl_dt)
-            dL_dqi.append(dl_dqi)
-
-        L = torch.stack(L, dim=2)
-        dL_dt = torch.stack(dL_dt, dim=2)
-
-        # dL_dqi n x d x d x d -- last dim is index for qi
-        dL_dqi = torch.stack(dL_dqi, dim=3).permute(0, 2, 3, 1)
-
-        epsilon = 1e-9   #small number to ensure positive definiteness of H
-
-        H = L @ L.transpose(1, 2) + epsilon * torch.eye(d,device=self.device)
-
-        # Time derivative of Mass Matrix
-        dH_dt = L @ dL_dt.permute(0,2,1) + dL_dt @ L.permute(0,2,1)
-
-        quadratic_term = []
-        for i in range(d):
-            qterm = q_dot.view(n, 1, d) @ (dL_dqi[:, :, :, i] @ L.transpose(1, 2) +
-                                           L @ dL_dqi[:, :, :, i].transpose(1, 2)) @ q_dot.view(n, d, 1)
-            quadratic_term.append(qterm)
-
-        quadratic_term = torch.stack(quadratic_term, dim=1)
-
-        c = dH_dt @ q_dot.view(n,d,1) - 0.5 * quadratic_term.view(n,d,1)
-
-        tau = H @ q_ddot.view(n,d,1) + c + g.view(n,d,1)
-
-        # The loss layer will be applied outside Network class
-        return (tau.squeeze(), (H @ q_ddot.view(n,d,1)).squeeze(), c.squeeze(), g.squeeze())
-
-
-def train(model, criterion, loader, device, optimizer, scheduler, num_epoch=10): # Train the model
+def train(model, criterion, loader, device, optimizer, scheduler, num_epoch=10, checkpoint=None, monitor=None, mixed_precision=False,
+          valloader=None, early_stopping=None): # Train the model
     print("Start training...")
+    if valloader is None and (early_stopping is not None or isinstance(scheduler, optim.lr_scheduler.ReduceLROnPlateau)):
+        raise ValueError("Early stopping and ReduceLROnPlateau need a valloader")
+    monitor = TrainingMonitor(device=device) if monitor is None else monitor # per phase timings of every epoch
+    autocast_device = torch.device(device).type
     model.train() # Set the model to training mode
-    for i in range(num_epoch):
-        running_loss = []
-        for state, tau, _, _, _, _ in tqdm(loader):
-            state = state.to(device)
-            tau = tau.to(device)
-            optimizer.zero_grad() # Clear gradients from the previous iteration
-            pred_tau, pred_H, pred_c, pred_g = model(state) # This will call Network.forward() that you implement
-
-            loss = criterion(pred_tau, tau) # Calculate the loss
-            running_loss.append(loss.item())
-            loss.backward() # Backprop gradients to all tensors in the network
-            torch.nn.utils.clip_grad_norm(model.parameters(), 10.0)
-            optimizer.step() # Update trainable weights
-
-        scheduler.step()
-        print("Epoch {} loss:{}".format(i+1,np.mean(running_loss))) # Print the average loss for this epoch
-    
+    start_epoch = checkpoint.load(model, optimizer, scheduler, early_stopping) if checkpoint is not None else 0 # resume
+    for i in range(start_epoch, num_epoch):
+        for state, tau, _, _, _, _ in monitor.batches(tqdm(loader)):
+            with monitor.phase('data'):
+                state = state.to(device)
+                tau = tau.to(device)
+            # bfloat16 autocast, the inverse dynamics of DeLaN stay in float32 (see DeLaN_Network.hidden)
+            with monitor.phase('forward'), torch.autocast(autocast_device, torch.bfloat16, enabled=mixed_precision):
+                pred_tau, pred_H, pred_c, pred_g = model(state) # This will call Network.forward() that you implement
+
+                loss = criterion(pred_tau, tau) # Calculate the loss
+            with monitor.phase('backward'):
+                loss.backward() # Backprop gradients to all tensors in the network
+            with monitor.phase('optimizer'):
+                torch.nn.utils.clip_grad_norm(model.parameters(), 10.0)
+                optimizer.step() # Update trainable weights
+                optimizer.zero_grad() # Clear gradients for the next iteration
+            monitor.step(len(state), loss) # summed on the device, no sync
+
+        val_loss = validation_loss(model, criterion, valloader, device) if valloader is not None else None
+        if isinstance(scheduler, optim.lr_scheduler.ReduceLROnPlateau):
+            scheduler.step(val_loss) # lower the learning rate when the validation loss stops improving
+        else:
+            scheduler.step()
+        loss = monitor.epoch(i+1, validation_loss=val_loss)
+        print("Epoch {} loss:{}".format(i+1,loss) + ("" if val_loss is None else " validation loss:{}".format(val_loss))) # Print the average loss for this epoch (one sync)
+        stop = early_stopping is not None and early_stopping.step(i+1, val_loss, model)
+        if checkpoint is not None:
+            checkpoint.step(i+1, model, optimizer, scheduler, num_epoch, early_stopping)
+        if stop:
+            print("No improvement in {} epochs, stopping after epoch {}".format(early_stopping.patience, i+1))
+            break
+
+    if early_stopping is not None:
+        early_stopping.restore(model) # continue with the best model
+        if checkpoint is not None:
+            checkpoint.save(num_epoch, model, optimizer, scheduler, early_stopping) # saved as finished
+            checkpoint.wait()
     print("Done!")
 
 
-def evaluate(model, criterion, loader, device, show_plots=False, num_plots=1): # Evaluate accuracy on validation / test set
+def evaluate(model, criterion, loader, device, show_plots=False, num_plots=1, monitor=None, plot_dir=None, metrics=None): # Evaluate accuracy on validation / test set, plots are saved to plot_dir if given
     model.eval() # Set the model to evaluation mode
-    MSEs = []
+    monitor = TrainingMonitor(device=device) if monitor is None else monitor
+    metrics = MetricsAccumulator() if metrics is None else metrics # errors per label, component and joint
     i = 0
     with torch.no_grad(): # Do not calculate grident to speed up computation
-        for state, tau, g, c, h, label in tqdm(loader):
+        for state, tau, g, c, h, label in monitor.batches(tqdm(loader)):
             state = state.to(device)
             tau = tau.to(device)
             g = g.to(device)
             c = c.to(device)
             h = h.to(device)
-            pred_tau, pred_Hq_ddot, pred_c, pred_g = model(state)
+            with monitor.phase('forward'):
+                pred_tau, pred_Hq_ddot, pred_c, pred_g = model(state)
 
             MSE_error = criterion(pred_tau, tau)
-            MSEs.append(MSE_error.item())
+            monitor.step(len(state), MSE_error)
             Hq_ddot = (h @ state[:,-2:].unsqueeze(2)).squeeze()
+            metrics.update(label, {'tau': pred_tau, 'Hq_ddot': pred_Hq_ddot, 'c': pred_c, 'g': pred_g},
+                           {'tau': tau, 'Hq_ddot': Hq_ddot.view_as(tau), 'c': c.view_as(tau), 'g': g})
             # if label == 'a':
             #     np.savetxt('reacher_delan_15_char.txt', np.concatenate((tau,Hq_ddot,c,g,pred_tau,pred_Hq_ddot,pred_c,pred_g),axis=1))
             if show_plots:
@@ -195,42 +133,75 @@ def evaluate(model, criterion, loader, device, show_plots=False, num_plots=1): #
                     axs[1,3].plot(pred_g[:,1],label='Predicted',color='r')
                     axs[1,3].set_xlabel('Time Step')
                     fig.suptitle('Reacher DeLaN Network Trajectory {}'.format(str(label)))
-                    plt.show()
+                    if plot_dir is None:
+                        plt.show()
+                    else: # headless
+                        fig.savefig(os.path.join(plot_dir, 'trajectory_{}.png'.format(i)))
                     plt.close()
                     i += 1
 
-    Ave_MSE = np.mean(np.array(MSEs))
+    monitor.epoch(0, kind='evaluate')
+    Ave_MSE = metrics.mse('tau') # weighted by samples, not by trajectories
     print("Average Evaluation MSE: {}".format(Ave_MSE))
     return Ave_MSE
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ensemble', action='store_true', help='train num_models models at once as one Ensemble, each with its own shuffling')
+    parser.add_argument('--num-models', type=int, default=5)
+    args = parser.parse_args()
 
     # Load the dataset and train and test splits
     print("Loading dataset...")
-    data = np.load('../data/trajectories_joint_space.npz', allow_pickle=True)
+    fname = '../data/trajectories_joint_space.npz'
+    data = load_dataset(fname)
+    seed = 0
+    seed_everything(seed) # the character split and the initialization, so the trained model can be cached
     train_trajectories, train_labels, test_trajectories, test_labels = random_train_test_chars(data, num_train_chars=15, num_samples_per_char=1)
     print("Test Chars =",test_labels)
-    TRAJ_train = TrajectoryDataset(data, train_trajectories, train_labels)
-    TRAJ_test = TrajectoryDataset(data, test_trajectories, test_labels)
+    TRAJ_train = MmapTrajectoryDataset(data, train_trajectories, train_labels)
+    TRAJ_test = MmapTrajectoryDataset(data, test_trajectories, test_labels)
 
     print("Done!")
-    trainloader = DataLoader(TRAJ_train, batch_size=None)
+    trainloader = sample_loader(TRAJ_train, batch_size=1000) # shuffled mini-batches of samples
     testloader = DataLoader(TRAJ_test, batch_size=None)
 
     # create model and specify hyperparameters
     device = "cuda" if torch.cuda.is_available() else "cpu" # Configure device
-
-    model = Reacher_DeLaN_Network(device).to(device)
     criterion = nn.MSELoss() # Specify the loss layer
-    # Modify the line below, experiment with different optimizers and parameters (such as learning rate)
-    optimizer = optim.Adam(model.parameters(), lr=5e-3, weight_decay=1e-3) #Specify optimizer and assign trainable parameters to it, weight_decay is L2 regularization strength
-    scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=40, gamma=0.5)
-
     num_epoch = 200 # Choose an appropriate number of training epochs
-
-    # train and evaluate network
-    train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch)
-    evaluate(model, criterion, testloader, device, show_plots=False)
-    print("Training Labels =", train_labels)
-
+    mixed_precision = False # train under bfloat16 autocast
+    if args.ensemble:
+        # the models train on the same split in different orders and from different initializations
+        trainloader = ensemble_sample_loader(TRAJ_train, args.num_models, batch_size=1000)
+        model = Ensemble([Reacher_DeLaN_Network(device) for _ in range(args.num_models)]).to(device)
+        optimizer = optim.Adam(model.parameters(), lr=5e-3, weight_decay=1e-3)
+        scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=40, gamma=0.5)
+        config = {'model': 'Ensemble', 'members': 'Reacher_DeLaN_Network', 'num_models': args.num_models, 'optimizer': optimizer.defaults,
+                  'step_size': 40, 'gamma': 0.5, 'num_epoch': num_epoch, 'batch_size': 1000,
+                  'mixed_precision': mixed_precision}
+        cached_train(model, lambda: ensemble.train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, checkpoint=Checkpointer(checkpoint_path('reacher_delan_ensemble', config, fname, train_trajectories, seed)),
+                     monitor=TrainingMonitor('reacher_delan_ensemble.metrics.jsonl', device), mixed_precision=mixed_precision),
+                     config, fname, train_trajectories, seed)
+        MSEs = ensemble.evaluate(model, evaluate, criterion, testloader, device)
+        print('MSEs', MSEs)
+        print('MSE mean {} std {}'.format(MSEs.mean(), MSEs.std()))
+        print_summary(energy_diagnostics(model.member(0), TRAJ_test, device)[1]) # energy balance of the first model
+    else:
+        model = Reacher_DeLaN_Network(device).to(device)
+        # Modify the line below, experiment with different optimizers and parameters (such as learning rate)
+        optimizer = optim.Adam(model.parameters(), lr=5e-3, weight_decay=1e-3) #Specify optimizer and assign trainable parameters to it, weight_decay is L2 regularization strength
+        scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=40, gamma=0.5)
+
+        # train and evaluate network
+        config = {'model': 'Reacher_DeLaN_Network', 'optimizer': optimizer.defaults, 'step_size': 40, 'gamma': 0.5,
+                  'num_epoch': num_epoch, 'batch_size': 1000,
+                  'mixed_precision': mixed_precision}
+        cached_train(model, lambda: train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, checkpoint=Checkpointer(checkpoint_path('reacher_delan', config, fname, train_trajectories, seed)),
+                     monitor=TrainingMonitor('reacher_delan.metrics.jsonl', device), mixed_precision=mixed_precision),
+                     config, fname, train_trajectories, seed)
+        evaluate(model, criterion, testloader, device, show_plots=False)
+        print_summary(energy_diagnostics(model, TRAJ_test, device)[1])
+        print("Component MSEs:", evaluate_streaming(model, testloader, device, path='reacher_delan.predictions.npz'))
+        print("Training Labels =", train_labels)
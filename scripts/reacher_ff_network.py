@@ -1,3 +1,5 @@
+import os
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm # Displays a progress bar
@@ -6,7 +8,17 @@ from torch import nn
 from torch import optim
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from dataset import TrajectoryDataset
+from dataset import sample_loader, ensemble_sample_loader
+from trajectory_store import MmapTrajectoryDataset, load_dataset
+from checkpoint import Checkpointer
+from model_cache import cached_train, checkpoint_path
+from training_metrics import TrainingMonitor
+from metrics_accumulator import MetricsAccumulator
+from early_stopping import validation_loss
+from streaming_evaluation import evaluate_streaming
+from sweep_runner import seed_everything
+import ensemble
+from ensemble import Ensemble
 from trajectory_selection import random_train_test_chars
 # torch.manual_seed(0) # Fix random seed for reproducibility
 
@@ -28,37 +40,67 @@ class Reacher_FF_Network(nn.Module):
         # The loss layer will be applied outside Network class
         return x
 
-def train(model, criterion, loader, device, optimizer, scheduler, num_epoch = 10): # Train the model
+def train(model, criterion, loader, device, optimizer, scheduler, num_epoch=10, checkpoint=None, monitor=None, mixed_precision=False,
+          valloader=None, early_stopping=None): # Train the model
     print("Start training...")
+    if valloader is None and (early_stopping is not None or isinstance(scheduler, optim.lr_scheduler.ReduceLROnPlateau)):
+        raise ValueError("Early stopping and ReduceLROnPlateau need a valloader")
+    monitor = TrainingMonitor(device=device) if monitor is None else monitor # per phase timings of every epoch
+    autocast_device = torch.device(device).type
     model.train() # Set the model to training mode
-    for i in range(num_epoch):
-        running_loss = []
-        for state, tau, _, _, _, _ in tqdm(loader):
-            state = state.to(device)
-            tau = tau.to(device)
-            optimizer.zero_grad() # Clear gradients from the previous iteration
-            pred = model(state) # This will call Network.forward() that you implement
-            loss = criterion(pred, tau) # Calculate the loss
-            running_loss.append(loss.item())
-            loss.backward() # Backprop gradients to all tensors in the network
-            torch.nn.utils.clip_grad_norm(model.parameters(), 10.0)
-            optimizer.step() # Update trainable weights
+    start_epoch = checkpoint.load(model, optimizer, scheduler, early_stopping) if checkpoint is not None else 0 # resume
+    for i in range(start_epoch, num_epoch):
+        for state, tau, _, _, _, _ in monitor.batches(tqdm(loader)):
+            with monitor.phase('data'):
+                state = state.to(device)
+                tau = tau.to(device)
+            # bfloat16 autocast if mixed_precision is set
+            with monitor.phase('forward'), torch.autocast(autocast_device, torch.bfloat16, enabled=mixed_precision):
+                pred = model(state) # This will call Network.forward() that you implement
+                loss = criterion(pred, tau) # Calculate the loss
+            with monitor.phase('backward'):
+                loss.backward() # Backprop gradients to all tensors in the network
+            with monitor.phase('optimizer'):
+                torch.nn.utils.clip_grad_norm(model.parameters(), 10.0)
+                optimizer.step() # Update trainable weights
+                optimizer.zero_grad() # Clear gradients for the next iteration
+            monitor.step(len(state), loss) # summed on the device, no sync
         
-        scheduler.step()
-        print("Epoch {} loss:{}".format(i+1,np.mean(running_loss))) # Print the average loss for this epoch
+        val_loss = validation_loss(model, criterion, valloader, device) if valloader is not None else None
+        if isinstance(scheduler, optim.lr_scheduler.ReduceLROnPlateau):
+            scheduler.step(val_loss) # lower the learning rate when the validation loss stops improving
+        else:
+            scheduler.step()
+        loss = monitor.epoch(i+1, validation_loss=val_loss)
+        print("Epoch {} loss:{}".format(i+1,loss) + ("" if val_loss is None else " validation loss:{}".format(val_loss))) # Print the average loss for this epoch (one sync)
+        stop = early_stopping is not None and early_stopping.step(i+1, val_loss, model)
+        if checkpoint is not None:
+            checkpoint.step(i+1, model, optimizer, scheduler, num_epoch, early_stopping)
+        if stop:
+            print("No improvement in {} epochs, stopping after epoch {}".format(early_stopping.patience, i+1))
+            break
+
+    if early_stopping is not None:
+        early_stopping.restore(model) # continue with the best model
+        if checkpoint is not None:
+            checkpoint.save(num_epoch, model, optimizer, scheduler, early_stopping) # saved as finished
+            checkpoint.wait()
     print("Done!")
 
-def evaluate(model, criterion, loader, device, show_plots=False, num_plots=1): # Evaluate accuracy on validation / test set
+def evaluate(model, criterion, loader, device, show_plots=False, num_plots=1, monitor=None, plot_dir=None, metrics=None): # Evaluate accuracy on validation / test set, plots are saved to plot_dir if given
     model.eval() # Set the model to evaluation mode
-    MSEs = []
+    monitor = TrainingMonitor(device=device) if monitor is None else monitor
+    metrics = MetricsAccumulator() if metrics is None else metrics # errors per label, component and joint
     i = 0
     with torch.no_grad(): # Do not calculate grident to speed up computation
-        for state, tau, _, _, _, label in tqdm(loader):
+        for state, tau, _, _, _, label in monitor.batches(tqdm(loader)):
             state = state.to(device)
             tau = tau.to(device)
-            pred = model(state)
+            with monitor.phase('forward'):
+                pred = model(state)
             MSE_error = criterion(pred, tau)
-            MSEs.append(MSE_error.item())
+            monitor.step(len(state), MSE_error)
+            metrics.update(label, {'tau': pred}, {'tau': tau})
             if show_plots:
                 if i < num_plots:
                     if label == 'a':
@@ -73,34 +115,69 @@ def evaluate(model, criterion, loader, device, show_plots=False, num_plots=1): #
                     axs[1].set_xlabel('Time Step')
                     axs[1].set_ylabel(r'$\tau_2\,(N-m)$')
                     fig.suptitle('Reacher FF-NN Trajectory {}'.format(str(label)))
-                    plt.show()
+                    if plot_dir is None:
+                        plt.show()
+                    else: # headless
+                        fig.savefig(os.path.join(plot_dir, 'trajectory_{}.png'.format(i)))
                     plt.close()
                     i += 1
 
-    Ave_MSE = np.mean(np.array(MSEs))
+    monitor.epoch(0, kind='evaluate')
+    Ave_MSE = metrics.mse('tau') # weighted by samples, not by trajectories
     print("Average Evaluation MSE: {}".format(Ave_MSE))
     return Ave_MSE
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ensemble', action='store_true', help='train num_models models at once as one Ensemble, each with its own shuffling')
+    parser.add_argument('--num-models', type=int, default=5)
+    args = parser.parse_args()
+
     # Load the dataset and train and test splits
     print("Loading dataset...")
-    data = np.load('../data/trajectories_joint_space.npz', allow_pickle=True)
+    fname = '../data/trajectories_joint_space.npz'
+    data = load_dataset(fname)
+    seed = 0
+    seed_everything(seed) # the character split and the initialization, so the trained model can be cached
     train_trajectories, train_labels, test_trajectories, test_labels = random_train_test_chars(data, num_train_chars=1, num_samples_per_char=1)
-    TRAJ_train = TrajectoryDataset(data,train_trajectories, train_labels)
-    TRAJ_test = TrajectoryDataset(data,test_trajectories, test_labels)
+    TRAJ_train = MmapTrajectoryDataset(data, train_trajectories, train_labels)
+    TRAJ_test = MmapTrajectoryDataset(data, test_trajectories, test_labels)
     print("Done!")
-    trainloader = DataLoader(TRAJ_train, batch_size=None)
+    trainloader = sample_loader(TRAJ_train, batch_size=1000) # shuffled mini-batches of samples
     testloader = DataLoader(TRAJ_test, batch_size=None)
 
     # create model and specify hyperparameters
     device = "cuda" if torch.cuda.is_available() else "cpu" # Configure device
-    model = Reacher_FF_Network().to(device)
     criterion = nn.MSELoss() # Specify the loss layer
-    # Modify the line below, experiment with different optimizers and parameters (such as learning rate)
-    optimizer = optim.Adam(model.parameters(), lr=5e-3, weight_decay=1e-4) # Specify optimizer and assign trainable parameters to it, weight_decay is L2 regularization strength
-    scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=40, gamma=0.5)
     num_epoch = 200 # Choose an appropriate number of training epochs
+    mixed_precision = False # train under bfloat16 autocast
+    if args.ensemble:
+        # the models train on the same split in different orders and from different initializations
+        trainloader = ensemble_sample_loader(TRAJ_train, args.num_models, batch_size=1000)
+        model = Ensemble([Reacher_FF_Network() for _ in range(args.num_models)]).to(device)
+        optimizer = optim.Adam(model.parameters(), lr=5e-3, weight_decay=1e-4)
+        scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=40, gamma=0.5)
+        config = {'model': 'Ensemble', 'members': 'Reacher_FF_Network', 'num_models': args.num_models, 'optimizer': optimizer.defaults,
+                  'step_size': 40, 'gamma': 0.5, 'num_epoch': num_epoch, 'batch_size': 1000,
+                  'mixed_precision': mixed_precision}
+        cached_train(model, lambda: ensemble.train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, checkpoint=Checkpointer(checkpoint_path('reacher_ff_ensemble', config, fname, train_trajectories, seed)),
+                     monitor=TrainingMonitor('reacher_ff_ensemble.metrics.jsonl', device), mixed_precision=mixed_precision),
+                     config, fname, train_trajectories, seed)
+        MSEs = ensemble.evaluate(model, evaluate, criterion, testloader, device)
+        print('MSEs', MSEs)
+        print('MSE mean {} std {}'.format(MSEs.mean(), MSEs.std()))
+    else:
+        model = Reacher_FF_Network().to(device)
+        # Modify the line below, experiment with different optimizers and parameters (such as learning rate)
+        optimizer = optim.Adam(model.parameters(), lr=5e-3, weight_decay=1e-4) # Specify optimizer and assign trainable parameters to it, weight_decay is L2 regularization strength
+        scheduler = optim.lr_scheduler.StepLR(optimizer, step_size=40, gamma=0.5)
 
-    # train and evaluate network
-    train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch)
-    evaluate(model, criterion, testloader, device, show_plots=False)
\ No newline at end of file
+        # train and evaluate network
+        config = {'model': 'Reacher_FF_Network', 'optimizer': optimizer.defaults, 'step_size': 40, 'gamma': 0.5,
+                  'num_epoch': num_epoch, 'batch_size': 1000,
+                  'mixed_precision': mixed_precision}
+        cached_train(model, lambda: train(model, criterion, trainloader, device, optimizer, scheduler, num_epoch, checkpoint=Checkpointer(checkpoint_path('reacher_ff', config, fname, train_trajectories, seed)),
+                     monitor=TrainingMonitor('reacher_ff.metrics.jsonl', device), mixed_precision=mixed_precision),
+                     config, fname, train_trajectories, seed)
+        evaluate(model, criterion, testloader, device, show_plots=False)
+        evaluate_streaming(model, testloader, device, path='reacher_ff.predictions.npz')
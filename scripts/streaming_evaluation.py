@@ -0,0 +1,146 @@
+'''
+
+    Evaluation of large test sets in bounded memory: trajectories are cut into chunks of at most chunk_size samples
+    that are moved to the device one at a time, the squared errors of tau, H q_ddot, c and g are summed on the device
+    (weighted by samples, so long and short trajectories count by their length) and the predictions are written to a
+    compressed columnar file by a background thread, so the evaluation neither waits for the disk nor keeps the
+    predictions in memory
+
+    The file is a zip archive of .npy members '<column>/<chunk>.npy', readable with load_predictions (or np.load).
+    Columns: trajectory (index of the loader item), step (sample index within it), label, and tau, Hq_ddot, c, g with
+    their predictions pred_tau, pred_Hq_ddot, pred_c, pred_g (only tau and pred_tau for FF networks)
+
+    usage: MSEs = evaluate_streaming(model, testloader, device, path='cartpole_delan.predictions.npz')
+           predictions = load_predictions('cartpole_delan.predictions.npz')
+
+'''
+import queue
+import zipfile
+import threading
+from collections import defaultdict
+import numpy as np
+import torch
+from metrics_accumulator import MetricsAccumulator
+
+COMPONENTS = ['tau', 'Hq_ddot', 'c', 'g']
+
+
+class PredictionWriter:
+    def __init__(self, path, max_pending=4):
+        '''
+            writes the chunks passed to write into the zip archive path in a background thread. At most max_pending
+            chunks wait to be written, write blocks while the queue is full so memory stays bounded
+        '''
+        self.path = path
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.num_chunks = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        with zipfile.ZipFile(self.path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                if self.error is not None:
+                    continue # drain the queue after a failed write
+                chunk, columns = item
+                try:
+                    for name, values in columns.items():
+                        with zf.open('{}/{:06d}.npy'.format(name, chunk), 'w', force_zip64=True) as f:
+                            np.lib.format.write_array(f, np.ascontiguousarray(values), allow_pickle=False)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, columns):
+        ''' columns is a dict of numpy arrays with the same number of rows '''
+        if self.error is not None:
+            raise self.error
+        self.queue.put((self.num_chunks, columns))
+        self.num_chunks += 1
+
+    def close(self):
+        ''' waits until everything is written, raises the error of a failed write '''
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_predictions(path):
+    ''' the columns of a file written by PredictionWriter, each concatenated over all chunks '''
+    chunks = defaultdict(list)
+    with np.load(path) as f:
+        for name in sorted(f.files):
+            chunks[name.split('/')[0]].append(f[name])
+    return {name: np.concatenate(values) for name, values in chunks.items()}
+
+
+def chunks(loader, chunk_size):
+    ''' (trajectory, start, state, tau, g, c, h, label) with at most chunk_size samples of every loader item '''
+    for trajectory, (state, tau, g, c, h, label) in enumerate(loader):
+        labels = np.broadcast_to(np.asarray(label), (len(state),))
+        for start in range(0, len(state), chunk_size):
+            end = start + chunk_size
+            yield (trajectory, start, state[start:end], tau[start:end], g[start:end], c[start:end], h[start:end],
+                   labels[start:end])
+
+
+def coriolis(c, q_dot):
+    ''' c (n x d) from the dataset's c, which is either the vector c (characters) or the matrix C with c = C q_dot (cartpole) '''
+    n, d = q_dot.shape
+    if c[0].numel() == d:
+        return c.reshape(n, d)
+    return (c @ q_dot.unsqueeze(2)).view(n, d)
+
+
+def evaluate_streaming(model, loader, device, chunk_size=4096, path=None, max_pending=4, metrics=None):
+    '''
+        mean squared error of every component in COMPONENTS (only tau for networks returning tau alone) over all
+        samples of loader, which yields trajectories or concatenated batches of them. The errors are also merged
+        into metrics (a MetricsAccumulator, for the errors per label and joint) if given. With path, the targets and
+        predictions are written to that file (see the module docstring)
+    '''
+    was_training = model.training
+    model.eval()
+    evaluated = MetricsAccumulator()
+    writer = PredictionWriter(path, max_pending) if path is not None else None
+    try:
+        with torch.no_grad():
+            for trajectory, start, state, tau, g, c, h, labels in chunks(loader, chunk_size):
+                state = state.to(device, non_blocking=True)
+                n, d = tau.shape
+                pred = model(state)
+                if isinstance(pred, tuple):
+                    q_dot, q_ddot = state[:, d:2 * d], state[:, 2 * d:]
+                    target = (tau.to(device), (h.to(device) @ q_ddot.unsqueeze(2)).view(n, d),
+                              coriolis(c.to(device), q_dot), g.to(device))
+                else:
+                    pred, target = (pred,), (tau.to(device),)
+
+                predictions, targets = dict(zip(COMPONENTS, pred)), dict(zip(COMPONENTS, target))
+                evaluated.update(labels, predictions, targets)
+
+                if writer is not None:
+                    columns = {'trajectory': np.full(n, trajectory), 'step': np.arange(start, start + n),
+                               'label': np.asarray(labels)}
+                    for name, p, t in zip(COMPONENTS, pred, target):
+                        columns[name] = t.cpu().numpy()
+                        columns['pred_' + name] = p.float().cpu().numpy()
+                    writer.write(columns)
+    finally:
+        model.train(was_training)
+        if writer is not None:
+            writer.close()
+
+    if metrics is not None:
+        metrics.merge(evaluated)
+    return {component: evaluated.mse(component) for component in COMPONENTS if component in evaluated.components()}
@@ -0,0 +1,130 @@
+'''
+
+    Runs the cells of a parameter sweep (e.g. (num_train_trajs, seed, model)) over a process pool. Every finished
+    cell is appended to a JSON lines results file right away, and cells already in the file are skipped, so an
+    interrupted sweep continues where it stopped when restarted. Every record carries the key of the sweep's
+    training config and dataset, and records of another config are ignored, so changing the training settings
+    reruns the cells instead of mixing in their old results
+
+'''
+import os
+import json
+import random
+from multiprocessing import Pool
+import numpy as np
+import torch
+from model_cache import cache_key
+
+
+def seed_everything(seed):
+    ''' seeds python (trajectory_selection), numpy and torch so a cell gives the same result in any worker '''
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def cell_key(cell):
+    ''' hashable key of a cell, the same for a cell read back from the results file '''
+    return json.dumps([v.item() if isinstance(v, np.generic) else v for v in cell])
+
+
+def config_key(config, dataset_file):
+    ''' key of the settings every cell is trained with, config is a dict like the config of model_cache.cache_key '''
+    return cache_key(config, dataset_file, [], None)[0]
+
+
+def load_results(results_file, config=None):
+    '''
+        results of the cells completed so far with the config key config, {cell key: result}. A partly written
+        last line is ignored
+    '''
+    results = {}
+    num_stale = 0
+    if os.path.exists(results_file):
+        with open(results_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('config') != config:
+                    num_stale += 1
+                    continue
+                results[cell_key(record['cell'])] = record['result']
+    if num_stale:
+        print("Ignoring {} results of another config in {}".format(num_stale, results_file))
+    return results
+
+
+def _init_worker(threads_per_worker):
+    # keep the workers from oversubscribing the cores with intra-op threads
+    torch.set_num_threads(threads_per_worker)
+
+
+def _run_cell(args):
+    fn, cell = args
+    return cell, fn(cell)
+
+
+def run_sweep(cells, fn, results_file, num_workers=None, threads_per_worker=1, config=None):
+    '''
+        computes fn(cell) for every cell not yet in results_file with the config key config (see config_key),
+        num_workers cells at a time (defaults to the number of CPUs / threads_per_worker). fn must be a module
+        level function returning something JSON serializable. Returns {cell key: result} of all cells
+    '''
+    results = load_results(results_file, config)
+    todo = [cell for cell in cells if cell_key(cell) not in results]
+    print("{} of {} cells done, running {}".format(len(cells) - len(todo), len(cells), len(todo)))
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+    with open(results_file, 'a') as f, Pool(num_workers, initializer=_init_worker,
+                                             initargs=(threads_per_worker,)) as pool:
+        # start on a new line after a record cut off by a crash
+        if f.tell() > 0:
+            with open(results_file, 'rb') as g:
+                g.seek(-1, os.SEEK_END)
+                if g.read(1) != b'\n':
+                    f.write('\n')
+        for cell, result in pool.imap_unordered(_run_cell, [(fn, cell) for cell in todo]):
+            key = cell_key(cell)
+            results[key] = result
+            f.write(json.dumps({'cell': json.loads(key), 'config': config, 'result': result}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+            print("Finished {}: {}".format(key, result))
+    return results
+
+
+def results_array(results, rows, cols, *rest, value=float):
+    '''
+        len(rows) x len(cols) array of the results of the cells (row, col, *rest), NaN where missing. value turns
+        a result into a number, e.g. the MSE of a MetricsAccumulator state
+    '''
+    out = np.full((len(rows), len(cols)), np.nan)
+    for i, row in enumerate(rows):
+        for j, col in enumerate(cols):
+            key = cell_key((row, col) + rest)
+            if key in results:
+                out[i, j] = value(results[key])
+    return out
+
+
+def row_results(results, rows, cols, *rest):
+    ''' for every row, the list of the results of the cells (row, col, *rest) that are done, e.g. to merge them '''
+    return [[results[cell_key((row, col) + rest)] for col in cols if cell_key((row, col) + rest) in results]
+            for row in rows]
+
+
+def member_results(results, members, position=1):
+    '''
+        results of cells that ran several members at once (e.g. all seeds as one Ensemble) as results of one cell
+        per member: the list result of the cell (a, b, ...) becomes the cells (a, member, b, ...), with member
+        inserted at position, so results_array and row_results work on them unchanged
+    '''
+    out = {}
+    for key, result in results.items():
+        cell = json.loads(key)
+        for member, member_result in zip(members, result):
+            out[cell_key(cell[:position] + [member] + cell[position:])] = member_result
+    return out
@@ -0,0 +1,117 @@
+'''
+
+    Instrumentation of the train / evaluate loops: time spent loading data, in the forward and backward pass and in
+    the optimizer per step, samples/sec, peak memory and the mean loss, one row per epoch in a CSV or JSON lines
+    file. The loss is summed on the device and only synced once per epoch; on CUDA the phases are timed with
+    events, which are also only synchronized once per epoch
+
+    peak_mem_mb is the peak CUDA memory of the epoch (empty on the CPU, which has no per-epoch peak) and
+    process_peak_rss_mb the peak resident size of the process since it started, which never goes down
+
+'''
+import os
+import csv
+import json
+import time
+import resource
+from contextlib import contextmanager
+import torch
+
+PHASES = ['data', 'forward', 'backward', 'optimizer']
+FIELDS = ['kind', 'epoch', 'steps', 'samples', 'loss', 'validation_loss', 'time_s', 'samples_per_s', 'peak_mem_mb',
+          'process_peak_rss_mb'] + \
+         ['{}_ms_per_step'.format(p) for p in PHASES]
+
+
+def peak_memory_mb(device):
+    ''' peak allocated CUDA memory of device since the last reset, None for other devices '''
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return None
+
+
+def process_peak_rss_mb():
+    ''' peak resident size of the process over its whole lifetime, it is never reset '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10 # kB on Linux
+
+
+class TrainingMonitor:
+    def __init__(self, path=None, device='cpu'):
+        '''
+            path ending in .csv or .jsonl to write the rows to (appended), or None to only compute them
+        '''
+        self.path = path
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        if path is not None and path.endswith('.csv') and not os.path.exists(path):
+            with open(path, 'w', newline='') as f:
+                csv.DictWriter(f, FIELDS).writeheader()
+        self._reset()
+
+    def _reset(self):
+        self.steps = 0
+        self.samples = 0
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.times = {p: 0.0 for p in PHASES}
+        self.events = {p: [] for p in PHASES}
+        self.start = time.perf_counter()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def batches(self, loader):
+        ''' iterates over loader, timing how long every batch takes to arrive '''
+        iterator = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.times['data'] += time.perf_counter() - start
+            yield batch
+
+    @contextmanager
+    def phase(self, name):
+        ''' times the enclosed block as phase name (forward, backward, optimizer) '''
+        if self.cuda:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self.events[name].append((start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self.times[name] += time.perf_counter() - start
+
+    def step(self, batch_size, loss):
+        ''' counts a finished step, loss is added on the device without syncing '''
+        self.steps += 1
+        self.samples += batch_size
+        self.loss_sum += loss.detach()
+
+    def epoch(self, epoch, kind='train', validation_loss=None):
+        ''' syncs once, writes the row of the epoch (kind train or evaluate) and returns the mean loss per step '''
+        loss = self.loss_sum.item() / max(self.steps, 1)
+        if self.cuda:
+            for p, events in self.events.items():
+                self.times[p] += sum(start.elapsed_time(end) for start, end in events) / 1e3
+        elapsed = time.perf_counter() - self.start
+        row = {'kind': kind, 'epoch': epoch, 'steps': self.steps, 'samples': self.samples, 'loss': loss,
+               'validation_loss': validation_loss, 'time_s': elapsed, 'samples_per_s': self.samples / elapsed, 'peak_mem_mb': peak_memory_mb(self.device),
+               'process_peak_rss_mb': process_peak_rss_mb()}
+        for p in PHASES:
+            row['{}_ms_per_step'.format(p)] = 1e3 * self.times[p] / max(self.steps, 1)
+        self.last = row
+        self._write(row)
+        self._reset()
+        return loss
+
+    def _write(self, row):
+        if self.path is None:
+            return
+        with open(self.path, 'a', newline='') as f:
+            if self.path.endswith('.csv'):
+                csv.DictWriter(f, FIELDS).writerow(row)
+            else:
+                f.write(json.dumps(row) + '\n')
@@ -143,6 +143,32 @@ def select_train_test_trajectories(data, train_label_types=[1], num_samples_per_
 
     return train_trajectories, train_labels, test_trajectories, test_labels
 
+def validation_trajectories(data, train_trajectories, train_labels, num_samples_per_label=1):
+    '''
+    Use with cartpole dataset, after one of the functions above. Picks validation trajectories of the train labels
+    that are not trained on. The test sets only use the first trajectories of the other labels, so the three are disjoint.
+    '''
+    return _unused_trajectories(data['labels'].flatten(), train_trajectories, train_labels, num_samples_per_label)
+
+def validation_chars(data, train_trajectories, train_labels, num_samples_per_char=1):
+    '''
+    Use with character dataset, after random_train_test_chars. Picks validation samples of the train characters
+    that are not trained on.
+    '''
+    letters = [data['keys'][label[0]-1][0] for label in data['labels']]
+    return _unused_trajectories(letters, train_trajectories, train_labels, num_samples_per_char)
+
+def _unused_trajectories(labels, train_trajectories, train_labels, num_samples_per_label):
+    val_trajectories = []
+    val_labels = []
+    used = set(train_trajectories)
+    for train_label in sorted(set(train_labels)):
+        unused = [i for i, label in enumerate(labels) if label == train_label and i not in used]
+        val_trajectories += unused[:num_samples_per_label]
+        val_labels += [train_label] * len(unused[:num_samples_per_label])
+
+    return val_trajectories, val_labels
+
 # def generate_one_shot_train_test_indices(data, train_labels, test_label, num_samples_per_label=1):
 #     label_count = {}
 #     label_indices = {}
@@ -0,0 +1,149 @@
+'''
+
+    One-time conversion of the trajectory datasets (.mat / .npz) into a directory of contiguous float32 .npy
+    arrays with per-trajectory offsets, memory-mapped on load so slicing a trajectory is zero-copy
+
+    usage: python trajectory_store.py ../cartpole_traj_gen/data/cartpole_all_200hz.mat
+
+'''
+import os
+import sys
+import shutil
+import numpy as np
+from scipy.io import loadmat
+from dataset import TrajectoryDataset
+
+FIELDS = ['trajectories', 'torques', 'H', 'c', 'g']
+
+
+def load_source(fname):
+    ''' loads the original .mat (cartpole) or .npz (character) dataset '''
+    if fname.endswith('.mat'):
+        return loadmat(fname)
+    return np.load(fname, allow_pickle=True)
+
+
+def store_path(fname):
+    ''' directory the converted store of fname is written to '''
+    return os.path.splitext(fname)[0] + '_store'
+
+
+def convert_to_store(data, path):
+    '''
+        writes every field of data as one contiguous float32 array (total samples x ...) plus offsets.npy,
+        where trajectory i is rows offsets[i]:offsets[i+1]. labels and keys (if present) are kept as they are
+    '''
+    tmp_path = path + '.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    lengths = [len(traj) for traj in data['trajectories']]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+
+    for field in FIELDS:
+        first = np.asarray(data[field][0])
+        out = np.lib.format.open_memmap(os.path.join(tmp_path, field + '.npy'), mode='w+', dtype=np.float32,
+                                        shape=(int(offsets[-1]),) + first.shape[1:])
+        for i, values in enumerate(data[field]):
+            out[offsets[i]:offsets[i + 1]] = values
+        out.flush()
+        del out
+
+    np.save(os.path.join(tmp_path, 'labels.npy'), np.asarray(data['labels']))
+    if 'keys' in data:
+        np.save(os.path.join(tmp_path, 'keys.npy'), np.asarray(data['keys']))
+
+    # only replace a previous store once the new one is complete. The old one is moved aside first, so an opener
+    # sees either the complete old or the complete new store and never a half deleted one (files it already has
+    # open or memory-mapped stay readable until it closes them)
+    old_path = path + '.old'
+    if os.path.isdir(old_path):
+        shutil.rmtree(old_path) # left behind by an interrupted conversion
+    if os.path.isdir(path):
+        os.replace(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+class RaggedArray:
+    ''' sequence of per-trajectory views into one contiguous array '''
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+
+class TrajectoryStore:
+    '''
+        Memory-mapped store written by convert_to_store. Can be used wherever the loaded .mat / .npz dict is:
+        store['trajectories'][i] is trajectory i, store['labels'] and store['keys'] are the original arrays.
+        Arrays are opened lazily so the store can be sent to DataLoader workers without copying the data
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._arrays = None
+
+    def _open(self):
+        if self._arrays is None:
+            offsets = np.load(os.path.join(self.path, 'offsets.npy'))
+            # copy-on-write keeps the arrays writable for torch.from_numpy without touching the files
+            arrays = {field: RaggedArray(np.load(os.path.join(self.path, field + '.npy'), mmap_mode='c'), offsets)
+                      for field in FIELDS}
+            arrays['offsets'] = offsets
+            arrays['labels'] = np.load(os.path.join(self.path, 'labels.npy'), allow_pickle=True)
+            if os.path.exists(os.path.join(self.path, 'keys.npy')):
+                arrays['keys'] = np.load(os.path.join(self.path, 'keys.npy'), allow_pickle=True)
+            self._arrays = arrays
+        return self._arrays
+
+    def __getitem__(self, key):
+        return self._open()[key]
+
+    def __contains__(self, key):
+        return key in self._open()
+
+    def __getstate__(self):
+        return {'path': self.path, '_arrays': None}
+
+
+class MmapTrajectoryDataset(TrajectoryDataset):
+    '''
+        TrajectoryDataset over a TrajectoryStore (or its path). Items are float32 tensors viewing the memory map,
+        so no conversion or copy happens per access
+    '''
+    def __init__(self, store, indices, labels):
+        self.store = store if isinstance(store, TrajectoryStore) else TrajectoryStore(store)
+        self.indices = indices
+        self.labels = labels
+
+    trajectories = property(lambda self: self.store['trajectories'])
+    torques = property(lambda self: self.store['torques'])
+    g = property(lambda self: self.store['g'])
+    H = property(lambda self: self.store['H'])
+    c = property(lambda self: self.store['c'])
+
+    def lengths(self):
+        ''' number of samples in each trajectory '''
+        offsets = self.store['offsets']
+        return [int(offsets[i + 1] - offsets[i]) for i in self.indices]
+
+
+def load_dataset(fname):
+    '''
+        opens the store converted from fname, converting it first if it is missing or older than fname
+    '''
+    path = store_path(fname)
+    if not os.path.isdir(path) or os.path.getmtime(path) < os.path.getmtime(fname):
+        print("Converting {} to {}".format(fname, path))
+        convert_to_store(load_source(fname), path)
+    return TrajectoryStore(path)
+
+
+if __name__ == '__main__':
+    for fname in sys.argv[1:]:
+        convert_to_store(load_source(fname), store_path(fname))
+        print("Wrote", store_path(fname))